@@ -0,0 +1,305 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout, contextmanager
+import flashcard
+from flashcard import Context, Kanji, Word, ReviewEngine, JOYO, GRADE, LEVEL, OTHER
+from httpcache import CachedResponse
+from bitset import Bitset
+from resolver import Resolver
+
+# usage: python benchmark.py [-o results.json] [size ...]
+#        python benchmark.py compare old.json new.json
+SIZES = (1000, 10000, 100000)
+SEED = 1
+# quick scenarios run this many times and the fastest run counts
+REPEAT = 3
+REVIEW_CARDS = 200
+SERVER_CARDS = 100
+# a scenario counts as a regression when it got this much slower
+THRESHOLD = 1.1
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+OKURIGANA = ("", "", "る", "い", "く", "す", "つ", "む", "う", "しい", "な")
+
+# a context with n_words words made of n_kanji kanji (chr(0x4E00) onwards);
+# every kanji has up to 3 parts among the kanji before it, every word is in
+# one jlpt list and in each of n_lists user lists with probability 1/4, the
+# same seed always gives the same context
+def synthetic_context(n_words, n_kanji=None, n_lists=8, seed=SEED):
+    rng = random.Random(seed)
+    if n_kanji is None:
+        n_kanji = min(max(50, n_words // 5), 20000)
+    ctx = Context()
+    ctx.init_empty()
+    kanjis = []
+    for k_idx in range(n_kanji):
+        parts = rng.sample(range(k_idx), min(k_idx, rng.randint(0, 3)))
+        radical = parts[0] if parts else k_idx
+        if rng.random() < 0.8:
+            categories = {JOYO, GRADE + rng.randrange(6), LEVEL + rng.randrange(5)}
+        else:
+            categories = {OTHER}
+        meanings = [f"meaning {k_idx}"] + [f"sense {rng.randrange(1000)}" for _ in range(rng.randint(0, 2))]
+        kanjis.append((k_idx, Kanji(chr(0x4E00 + k_idx), meanings, categories, parts, radical)))
+    ctx.do_add_kanjis(kanjis, [])
+    for n_idx in range(n_lists):
+        ctx.do_list_add(flashcard.NUM_RESERVED_WORD_LISTS + n_idx, f"list {n_idx}")
+    single = set()
+    w_idx = 0
+    while w_idx < n_words:
+        # one single kanji word per kanji until every kanji has one
+        if len(single) < n_kanji and rng.random() < 0.3:
+            kanji_index = [rng.randrange(n_kanji)]
+            if kanji_index[0] in single:
+                continue
+            single.add(kanji_index[0])
+        else:
+            kanji_index = [rng.randrange(n_kanji) for _ in range(rng.randint(1, 3))]
+        text = "".join(chr(0x4E00 + k_idx) for k_idx in kanji_index)
+        if len(kanji_index) > 1 or kanji_index[0] not in single:
+            text += rng.choice(OKURIGANA)
+        if text in ctx.word_idx_by_symbols:
+            continue
+        furigana = ["".join(rng.choice(KANA) for _ in range(rng.randint(1, 3))) for _ in kanji_index]
+        meanings = [f"word {w_idx}"] + [f"gloss {rng.randrange(5000)}" for _ in range(rng.randint(0, 3))]
+        word_lists = [rng.randrange(flashcard.NUM_RESERVED_WORD_LISTS)]
+        word_lists += [flashcard.NUM_RESERVED_WORD_LISTS + n_idx for n_idx in range(n_lists) if rng.random() < 0.25]
+        w = Word(text, furigana, meanings, kanji_index, word_lists)
+        w.slot = rng.randrange(len(ctx.slots))
+        ctx.do_add_word(w_idx, w)
+        ctx.do_reschedule(w_idx, rng.uniform(-30, 30) * flashcard.DAY, flashcard.START_EASE, rng.randint(0, 30))
+        w_idx += 1
+    for k_idx in range(n_kanji):
+        if k_idx not in single:
+            ctx.do_no_single_kanji_word(chr(0x4E00 + k_idx))
+    return ctx
+
+# url -> page of the fixtures, everything else is a 404 like a missing page
+def load_fixtures(path=FIXTURES):
+    pages = {}
+    for kind, suffix in (("kanji", "%23kanji"), ("word", "")):
+        for name in os.listdir(os.path.join(path, kind)):
+            with open(os.path.join(path, kind, name)) as f:
+                pages[flashcard.BASE_URL + name.rsplit(".", 1)[0] + suffix] = f.read()
+    return pages
+
+def fixture_fetch(pages):
+    def fetch(url, negative=None):
+        text = pages.get(url)
+        if text is None:
+            return CachedResponse(404, "")
+        return CachedResponse(200, text)
+    return fetch
+
+# the terminal is fed from lines and its output is thrown away
+@contextmanager
+def terminal(lines=()):
+    stdin = sys.stdin
+    sys.stdin = io.StringIO("".join(line + "\n" for line in lines))
+    try:
+        with redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        sys.stdin = stdin
+
+def timed(results, name, run, repeat=1, setup=None):
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        run(arg) if setup else run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = best
+    print(f"  {name}: {best:.4f}s", file=sys.stderr)
+
+def bench_fixtures(pages):
+    results = {}
+    words = [url[len(flashcard.BASE_URL):] for url in pages if not url.endswith("%23kanji")]
+    kanjis = [url[len(flashcard.BASE_URL):-len("%23kanji")] for url in pages if url.endswith("%23kanji")]
+    def fetch_words():
+        with terminal():
+            for word in words:
+                Word.fetch(word, exact_match=len(word) > 1, single_kanji=len(word) == 1)
+    def scrape_kanji(ctx):
+        resolver = Resolver(flashcard.KANJI_WORKERS)
+        with terminal():
+            Kanji.resolve(kanjis, ctx, resolver)
+        resolver.close()
+    def empty_context():
+        ctx = Context()
+        ctx.init_empty()
+        return ctx
+    timed(results, "fetch words", fetch_words, REPEAT * 10)
+    timed(results, "scrape kanji", scrape_kanji, REPEAT * 10, empty_context)
+    return results
+
+def bench_size(n):
+    results = {}
+    ctx = None
+    def generate():
+        nonlocal ctx
+        ctx = synthetic_context(n)
+    timed(results, "generate", generate)
+    backend = flashcard.BACKEND
+    for flashcard.BACKEND in ("shelve", "sqlite"):
+        path = f"bench-{n}-{flashcard.BACKEND}"
+        def load():
+            loaded = Context()
+            with terminal():
+                loaded.read_from_file(path)
+            loaded.close(False)
+        timed(results, f"save {flashcard.BACKEND}", lambda: ctx.write_to_file(path, full=True))
+        ctx.close(True)
+        timed(results, f"load {flashcard.BACKEND}", load, REPEAT)
+    flashcard.BACKEND = backend
+    engine = ReviewEngine(ctx)
+    names = [name for name in ctx.word_list_names if name.startswith("list ")]
+    expr = f"({' | '.join(ctx.word_list_names)}) - {names[0]} & ({' | '.join(names[1:])})"
+    def select():
+        random.seed(SEED)
+        with terminal([expr, str(n), ""]):
+            flashcard.select_words(engine)
+    timed(results, "select", select, REPEAT)
+    # every card is answered right the first time, then the review ends
+    random.seed(SEED)
+    cards = Bitset(random.sample(range(n), min(n, REVIEW_CARDS)))
+    timed(results, "review", lambda: run_review(ctx, cards))
+    timed(results, "export", lambda: flashcard.export_words(ctx), REPEAT)
+    def kanji_only():
+        target = Context()
+        target.init_empty()
+        target.kanjis = ctx.kanjis
+        target.kanji_idx_by_symbol = dict(ctx.kanji_idx_by_symbol)
+        target.single_kanji_words = {k_idx: set() for k_idx in ctx.single_kanji_words}
+        return target
+    def import_words(target):
+        with terminal():
+            flashcard.import_words(target)
+    timed(results, "import", import_words, 1, kanji_only)
+    bench_server(ctx, results)
+    return results
+
+def run_review(ctx, cards):
+    with terminal(["", "y"] * len(cards) + ["n"]):
+        flashcard.review_words(ctx, cards)
+
+# the review of SERVER_CARDS cards through the pages without javascript,
+# timed per request; skipped without flask
+def bench_server(ctx, results):
+    try:
+        import server
+    except ImportError:
+        print("  server: flask is not installed, skipped", file=sys.stderr)
+        return
+    server.ctx = ctx
+    client = server.app.test_client()
+    groups = ReviewEngine(ctx).decks()
+    form = {str(i): "on" for i, name, _ in groups[1][1] if name != "all"}
+    form["number"] = str(SERVER_CARDS)
+    requests = 0
+    def review():
+        nonlocal requests
+        random.seed(SEED)
+        client.get("/")
+        client.post("/select", data=form)
+        requests = 2
+        while client.get("/view_front").status_code == 200:
+            client.post("/view_back", data={"submit": "yes"})
+            requests += 2
+        client.get("/abort")
+    timed(results, "server review", review)
+    results["server request"] = results["server review"] / requests
+    print(f"  server request: {results['server request']:.6f}s", file=sys.stderr)
+    deck = f"/deck?select={','.join(i for i in form if i != 'number')}&number={SERVER_CARDS}"
+    def bundle():
+        client.get(deck)
+        client.get("/abort")
+    timed(results, "server deck", bundle, REPEAT)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(sizes, out):
+    pages = load_fixtures()
+    fetch = flashcard.fetch
+    clear = flashcard.clear
+    flashcard.fetch = fixture_fetch(pages)
+    flashcard.clear = lambda: None
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "seed": SEED,
+        "fixtures": {},
+        "sizes": {},
+    }
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix="benchmark-")
+    os.chdir(work)
+    try:
+        print("fixtures", file=sys.stderr)
+        report["fixtures"] = bench_fixtures(pages)
+        for n in sizes:
+            print(f"{n} words", file=sys.stderr)
+            report["sizes"][str(n)] = bench_size(n)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+        flashcard.fetch = fetch
+        flashcard.clear = clear
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"results written to {out}", file=sys.stderr)
+
+# prints every scenario that both reports have with the ratio new / old
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    sections = [("fixtures", old["fixtures"], new["fixtures"])]
+    sections += [(f"{n} words", old["sizes"][n], new["sizes"][n]) for n in new["sizes"] if n in old["sizes"]]
+    regressions = 0
+    for heading, before, after in sections:
+        print(f"\n{heading}:")
+        for name, t in after.items():
+            if name not in before:
+                continue
+            ratio = t / before[name] if before[name] else float("inf")
+            mark = ""
+            if ratio > THRESHOLD:
+                mark = " slower"
+                regressions += 1
+            print(f"{name}: {before[name]:.4f}s -> {t:.4f}s ({ratio:.2f}x){mark}")
+    print(f"\n{regressions} regressions")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "compare":
+        if len(args) != 3:
+            print("Error: compare needs two result files")
+            sys.exit(1)
+        compare(args[1], args[2])
+        sys.exit(0)
+    out = "benchmark.json"
+    if len(args) >= 2 and args[0] == "-o":
+        out = args[1]
+        args = args[2:]
+    if not all(a.isdigit() for a in args):
+        print(f"Error: invalid sizes {' '.join(args)}")
+        sys.exit(1)
+    run([int(a) for a in args] or SIZES, out)
@@ -0,0 +1,122 @@
+import random
+from itertools import compress
+
+# offsets of the bits that are set in every possible byte
+BITS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+# a byte 0 or 1 as the ascii digit
+DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+# set of small non-negative ints (word indexes) with one bit per int, adding
+# and removing happen in place, union, intersection and difference go through
+# python ints and the number of elements is always known
+class Bitset:
+    __slots__ = ("data", "n")
+
+    def __init__(self, values=()):
+        self.data = bytearray()
+        self.n = 0
+        for i in values:
+            self.add(i)
+
+    def from_int(x):
+        b = Bitset()
+        b.data = bytearray(x.to_bytes((x.bit_length() + 7) // 8, "little"))
+        b.n = x.bit_count()
+        return b
+
+    # the indexes of the bytes of used that are 1 (like HoleArray.used)
+    def from_bytemap(used):
+        if not used:
+            return Bitset()
+        return Bitset.from_int(int(bytes(used).translate(DIGITS)[::-1], 2))
+
+    def to_int(self):
+        return int.from_bytes(self.data, "little")
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.data) and bool(self.data[byte] >> (i & 7) & 1)
+
+    def __iter__(self):
+        data = self.data
+        for byte in compress(range(len(data)), data):
+            base = byte << 3
+            for bit in BITS[data[byte]]:
+                yield base + bit
+
+    def __repr__(self):
+        return f"Bitset({list(self)})"
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte - len(self.data) + 1))
+        mask = 1 << (i & 7)
+        if not self.data[byte] & mask:
+            self.data[byte] |= mask
+            self.n += 1
+
+    def discard(self, i):
+        byte = i >> 3
+        if byte >= len(self.data):
+            return
+        mask = 1 << (i & 7)
+        if self.data[byte] & mask:
+            self.data[byte] &= ~mask
+            self.n -= 1
+
+    def update(self, values):
+        for i in values:
+            self.add(i)
+
+    def copy(self):
+        b = Bitset()
+        b.data = bytearray(self.data)
+        b.n = self.n
+        return b
+
+    def __or__(self, other):
+        return Bitset.from_int(self.to_int() | other.to_int())
+
+    def __and__(self, other):
+        return Bitset.from_int(self.to_int() & other.to_int())
+
+    def __sub__(self, other):
+        return Bitset.from_int(self.to_int() & ~other.to_int())
+
+    # n distinct elements chosen uniformly at random, in ascending order
+    def sample(self, n):
+        ranks = sorted(random.sample(range(self.n), n))
+        result = []
+        data = self.data
+        seen = 0
+        j = 0
+        for byte in compress(range(len(data)), data):
+            if j == len(ranks):
+                break
+            bits = BITS[data[byte]]
+            while j < len(ranks) and ranks[j] < seen + len(bits):
+                result.append((byte << 3) + bits[ranks[j] - seen])
+                j += 1
+            seen += len(bits)
+        return result
+
+def union(bitsets):
+    x = 0
+    for b in bitsets:
+        x |= b.to_int()
+    return Bitset.from_int(x)
+
+if __name__ == "__main__":
+    a = Bitset([1, 5, 9, 200])
+    b = Bitset([5, 200, 201])
+    print(list(a | b), len(a | b), "== [1, 5, 9, 200, 201] 5")
+    print(list(a & b), len(a & b), "== [5, 200] 2")
+    print(list(a - b), len(a - b), "== [1, 9] 2")
+    a.discard(5)
+    print(5 in a, 9 in a, len(a), "== False True 3")
+    s = Bitset(range(0, 1000, 3)).sample(10)
+    print(len(set(s)) == 10 and all(i % 3 == 0 for i in s), "== True")
@@ -0,0 +1,90 @@
+# the kanji -> parts graph, parts_of(k_idx) returns the direct parts of a
+# kanji; the closure of a kanji (everything that can be reached from it) is
+# kept as an int with one bit per k_idx and cached, adding kanji never changes
+# the closure of a kanji that is already in the graph since its parts are fixed
+class ComponentGraph:
+    def __init__(self, parts_of):
+        self.parts_of = parts_of
+        self.closures = {}
+
+    # Tarjan's algorithm without recursion, all kanji that are parts of each
+    # other (a cycle) share the same closure, which contains all of them
+    def closure(self, k_idx):
+        closure = self.closures.get(k_idx)
+        if closure is not None:
+            return closure
+        index = {k_idx: 0}
+        low = {k_idx: 0}
+        reach = {k_idx: 0}
+        members = [k_idx]
+        stack = [(k_idx, iter(self.parts_of(k_idx)))]
+        while stack:
+            k, parts = stack[-1]
+            for part in parts:
+                reach[k] |= 1 << part
+                c = self.closures.get(part)
+                if c is not None:
+                    reach[k] |= c
+                elif part not in index:
+                    index[part] = low[part] = len(index)
+                    reach[part] = 0
+                    members.append(part)
+                    stack.append((part, iter(self.parts_of(part))))
+                    break
+                else:
+                    low[k] = min(low[k], index[part])
+            else:
+                stack.pop()
+                if low[k] == index[k]:
+                    i = members.index(k)
+                    closure = 0
+                    for m in members[i:]:
+                        closure |= reach[m]
+                    for m in members[i:]:
+                        self.closures[m] = closure
+                    del members[i:]
+                    reach[k] = closure
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[k])
+                    reach[parent] |= reach[k]
+        return self.closures[k_idx]
+
+    # drops every part that can be reached through another part, a part that
+    # can reach itself is only dropped if the other part is not reachable from it
+    def reduce(self, parts):
+        covered = 0
+        for part in parts:
+            covered |= self.closure(part)
+        reduced = []
+        for part in parts:
+            bit = 1 << part
+            if not covered & bit:
+                reduced.append(part)
+            elif self.closure(part) & bit:
+                for other in parts:
+                    if other != part and self.closure(other) & bit and not self.closure(part) & (1 << other):
+                        break
+                else:
+                    reduced.append(part)
+        return reduced
+
+    # reduces all of k_idxs in one pass, returns (k_idx, parts) for every
+    # kanji whose parts change
+    def reduce_all(self, k_idxs):
+        changes = []
+        for k_idx in k_idxs:
+            parts = self.parts_of(k_idx)
+            reduced = self.reduce(parts)
+            if len(reduced) != len(parts):
+                changes.append((k_idx, reduced))
+        return changes
+
+if __name__ == "__main__":
+    # 0 has the parts 1, 2, 3 where 2 is a part of 1 and 3 a part of 2,
+    # 4 and 5 are parts of each other
+    graph = {0: (1, 2, 3), 1: (2,), 2: (3,), 3: (), 4: (5,), 5: (4,), 6: (4, 5, 3)}
+    g = ComponentGraph(graph.__getitem__)
+    print(g.reduce(graph[0]), "== [1]")
+    print(g.reduce(graph[6]), "== [4, 5, 3]")
+    print(g.reduce_all(graph), "== [(0, [1])]")
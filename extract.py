@@ -0,0 +1,358 @@
+from html.parser import HTMLParser
+
+CHUNK_SIZE = 8192
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr"}
+# text inside of these is not part of the text of their ancestors
+HIDDEN_TAGS = {"rt", "rp", "script", "style", "template"}
+PRESERVE_TAGS = {"pre", "textarea"}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+class StopParsing(Exception):
+    pass
+
+# same matching rules as BeautifulSoup: a class with a space in it
+# has to match the whole attribute, otherwise any of the classes
+def has_class(attrs, cls):
+    for name, value in attrs:
+        if name == "class" and value:
+            if ' ' in cls:
+                return value == cls
+            return cls in value.split()
+    return False
+
+def chunks(text):
+    for i in range(0, len(text), CHUNK_SIZE):
+        yield text[i:i+CHUNK_SIZE]
+
+def run(parser, text):
+    try:
+        for chunk in chunks(text):
+            parser.feed(chunk)
+        parser.close()
+    except StopParsing:
+        pass
+    return parser
+
+# joins the text between two tags and normalizes it the way BeautifulSoup does
+# before passing it on to text(data, hidden), hidden is the innermost open tag
+# out of HIDDEN_TAGS or None
+class Extractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.pending = []
+        self.open = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        self.start(tag, attrs)
+        if tag in HIDDEN_TAGS or tag in PRESERVE_TAGS:
+            self.open.append(tag)
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if self.open and self.open[-1] == tag:
+            self.open.pop()
+        self.end(tag)
+
+    def handle_data(self, data):
+        self.pending.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def close(self):
+        super().close()
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending)
+        self.pending = []
+        hidden = None
+        preserve = False
+        for tag in reversed(self.open):
+            if tag in PRESERVE_TAGS:
+                preserve = True
+            elif hidden is None:
+                hidden = tag
+        if not preserve and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        self.text(data, hidden)
+
+# collects the text of the first div with each of the given classes
+# and the text of every <a> in the second radicals div
+class KanjiParser(Extractor):
+    TARGETS = ("kanji-details__main-meanings", "grade", "jlpt")
+
+    def __init__(self):
+        super().__init__()
+        self.valid = False
+        self.texts = {}
+        self.radicals = []
+        self.parts = []
+        self.divs = []
+        self.capturing = []
+        self.in_part = False
+
+    def start(self, tag, attrs):
+        if tag == "a" and len(self.radicals) == 2 and "radicals" in self.capturing:
+            self.in_part = True
+            self.parts.append("")
+        if tag != "div":
+            return
+        target = None
+        if has_class(attrs, "kanji details"):
+            self.valid = True
+        elif has_class(attrs, "radicals"):
+            target = "radicals"
+            self.radicals.append("")
+        else:
+            for cls in KanjiParser.TARGETS:
+                if cls not in self.texts and has_class(attrs, cls):
+                    target = cls
+                    self.texts[cls] = ""
+                    break
+        if target:
+            self.capturing.append(target)
+        self.divs.append(target)
+
+    def end(self, tag):
+        if tag == "a":
+            self.in_part = False
+        if tag != "div" or not self.divs:
+            return
+        target = self.divs.pop()
+        if target:
+            self.capturing.remove(target)
+            if target == "radicals" and len(self.radicals) == 2:
+                raise StopParsing
+
+    def text(self, data, hidden):
+        if hidden:
+            return
+        for target in self.capturing:
+            if target == "radicals":
+                self.radicals[-1] += data
+            else:
+                self.texts[target] += data
+        if self.in_part:
+            self.parts[-1] += data
+
+# returns None if the page is not a kanji page, otherwise the texts of the
+# meanings, grade and jlpt divs (None if missing), the texts of the radicals
+# divs and the texts of the links in the second radicals div
+def extract_kanji(text):
+    parser = run(KanjiParser(), text)
+    if not parser.valid:
+        return None
+    return {
+        "meanings": parser.texts.get("kanji-details__main-meanings"),
+        "grade": parser.texts.get("grade"),
+        "jlpt": parser.texts.get("jlpt"),
+        "radicals": parser.radicals,
+        "parts": parser.parts,
+    }
+
+# parses concept_light results until accept(text) is true for a result
+# or depth results have been seen
+class WordParser(Extractor):
+    def __init__(self, accept, depth):
+        super().__init__()
+        self.accept = accept
+        self.depth = depth
+        self.count = 0
+        self.result = None
+        self.current = None
+
+    def begin(self):
+        self.current = {
+            "text": None,
+            "furigana": None,
+            "rt": None,
+            "meanings": [],
+            "level": None,
+        }
+        self.divs = 0
+        self.spans = []
+        self.furi_depth = 0
+        self.rt_depth = 0
+        self.furi_text = False
+        self.furi_child = None
+        self.capturing = []
+
+    def start(self, tag, attrs):
+        if self.current is None:
+            if tag == "div" and has_class(attrs, "concept_light clearfix"):
+                self.begin()
+            return
+        if tag in VOID_TAGS:
+            return
+        c = self.current
+        self.furi_text = False
+        if self.furi_depth:
+            if self.furi_depth == 1:
+                c["furigana"].append("")
+                self.furi_child = tag
+            self.furi_depth += 1
+        if self.rt_depth:
+            self.rt_depth += 1
+        if tag == "div":
+            self.divs += 1
+        elif tag == "rt" and self.furi_depth and c["rt"] is None:
+            c["rt"] = ""
+            self.rt_depth = 1
+            self.capturing.append("rt")
+        elif tag == "span":
+            target = None
+            if c["text"] is None and has_class(attrs, "text"):
+                target = "text"
+                c["text"] = ""
+            elif c["furigana"] is None and has_class(attrs, "furigana"):
+                target = "furigana"
+                c["furigana"] = []
+                self.furi_depth = 1
+            elif has_class(attrs, "meaning-meaning"):
+                target = "meaning"
+                c["meanings"].append("")
+            elif c["level"] is None and has_class(attrs, "concept_light-tag label"):
+                target = "level"
+                c["level"] = ""
+            self.spans.append(target)
+            if target and target != "furigana":
+                self.capturing.append(target)
+
+    def end(self, tag):
+        if self.current is None or tag in VOID_TAGS:
+            return
+        self.furi_text = False
+        if self.furi_depth:
+            self.furi_depth -= 1
+        if self.rt_depth:
+            self.rt_depth -= 1
+            if not self.rt_depth:
+                self.capturing.remove("rt")
+        if tag == "span" and self.spans:
+            target = self.spans.pop()
+            if target and target != "furigana":
+                self.capturing.remove(target)
+        elif tag == "div":
+            if self.divs:
+                self.divs -= 1
+                return
+            self.finish()
+
+    def text(self, data, hidden):
+        if self.current is None:
+            return
+        c = self.current
+        for target in self.capturing:
+            if hidden == ("rt" if target == "rt" else None):
+                if target == "meaning":
+                    c["meanings"][-1] += data
+                else:
+                    c[target] += data
+        if self.furi_depth == 1 and not self.furi_text:
+            c["furigana"].append(data)
+            self.furi_text = True
+        elif self.furi_depth and hidden in (None, self.furi_child):
+            c["furigana"][-1] += data
+
+    def finish(self):
+        result = self.current
+        self.current = None
+        self.count += 1
+        if result["text"] is not None:
+            result["text"] = result["text"].strip()
+            if self.accept(result["text"]):
+                self.result = result
+                raise StopParsing
+        if self.count == self.depth:
+            raise StopParsing
+
+# returns the number of results that have been looked at and the first of them
+# whose text is accepted (None if there is none), the furigana of a result are
+# the texts of the children of its furigana span, the level is the text of its
+# first tag label
+def extract_word(text, accept, depth):
+    parser = run(WordParser(accept, depth), text)
+    return parser.count, parser.result
+
+if __name__ == "__main__":
+    # checks the extraction against BeautifulSoup on the pages in fixtures/
+    import os
+    import sys
+    from bs4 import BeautifulSoup
+
+    def reference_kanji(text):
+        parsed = BeautifulSoup(text, "html.parser")
+        if not parsed.body.find("div", attrs={"class": "kanji details"}):
+            return None
+        def find_text(cls):
+            div = parsed.body.find("div", attrs={"class": cls})
+            return div.text if div else None
+        radical_info = parsed.body.find_all("div", attrs={"class": "radicals"})
+        return {
+            "meanings": find_text("kanji-details__main-meanings"),
+            "grade": find_text("grade"),
+            "jlpt": find_text("jlpt"),
+            "radicals": [div.text for div in radical_info[:2]],
+            "parts": list(map(BeautifulSoup.get_text, radical_info[1].find_all("a"))),
+        }
+
+    def reference_word(text, accept, depth):
+        parsed = BeautifulSoup(text, "html.parser")
+        results = parsed.body.find_all("div", attrs={"class": "concept_light clearfix"})
+        n = min(depth, len(results))
+        for i in range(n):
+            result = results[i]
+            text_container = result.find("span", attrs={"class": "text"})
+            if not text_container:
+                continue
+            text = text_container.text.strip()
+            if accept(text):
+                break
+        else:
+            return n, None
+        furigana = result.find("span", attrs={"class": "furigana"})
+        rt = furigana.find("rt") if furigana else None
+        level = result.find("span", attrs={"class": "concept_light-tag label"})
+        return i + 1, {
+            "text": text,
+            "furigana": list(map(BeautifulSoup.get_text, furigana)) if furigana else None,
+            "rt": rt.text if rt else None,
+            "meanings": list(map(BeautifulSoup.get_text,
+                result.find_all("span", attrs={"class": "meaning-meaning"}))),
+            "level": level.text if level else None,
+        }
+
+    fixtures = sys.argv[1] if len(sys.argv) > 1 else "fixtures"
+    failed = 0
+    for name in sorted(os.listdir(os.path.join(fixtures, "kanji"))):
+        with open(os.path.join(fixtures, "kanji", name)) as f:
+            text = f.read()
+        if extract_kanji(text) != reference_kanji(text):
+            print(f"kanji/{name}: mismatch")
+            failed += 1
+    for name in sorted(os.listdir(os.path.join(fixtures, "word"))):
+        with open(os.path.join(fixtures, "word", name)) as f:
+            text = f.read()
+        word = name.rsplit(".", 1)[0]
+        checks = [
+            (lambda t: t == word, 10),
+            (lambda t: True, 10),
+            (lambda t: len(t) == 1, 10),
+            (lambda t: False, 10),
+            (lambda t: False, 1),
+        ]
+        for accept, depth in checks:
+            if extract_word(text, accept, depth) != reference_word(text, accept, depth):
+                print(f"word/{name}: mismatch")
+                failed += 1
+                break
+    print(f"{failed} mismatches")
@@ -1,12 +1,31 @@
-import requests
-from bs4 import BeautifulSoup
 import sys
 import shelve
 import random
 import os
 import json
-from holelist import HoleList
+import unicodedata
+import gzip
+import zlib
+import time
+from holelist import HoleArray
+from httpcache import ResponseCache
+from httpclient import HttpClient
+from resolver import Resolver
+from extract import extract_kanji, extract_word
+from journal import Journal
+from sqlstore import SQLiteStore
+from lazy import LazyHoleArray
+from components import ComponentGraph
+from bitset import Bitset, union
+from reviewqueue import ReviewQueue
+from scheduler import Scheduler, DAY, START_EASE, SLOT_INTERVALS
+from render import CardBack, RenderCache
+from localdict import LocalDictionary, open_source
+import stats
+import script
+from script import filter_kanji
 import re
+from contextlib import nullcontext, contextmanager
 
 auto_add_word_lists = []
 
@@ -18,9 +37,85 @@ def display_auto_add_info(ctx):
 
 BASE_URL = "https://jisho.org/search/"
 SEARCH_DEPTH = 10
+NO_EXACT_MATCH = -2
+NO_SINGLE_KANJI_WORD = -3
 EDITOR = "nvim"
 DB_FILE = "flashcards"
-WORDS_FILE = "words.json"
+WORDS_FILE = "words.jsonl"
+# import reads the first of these that exists, gzipped or not
+IMPORT_FILES = (WORDS_FILE, WORDS_FILE + ".gz", "words.json")
+# an interrupted import continues from the position that is kept in here
+CHECKPOINT_FILE = "words.checkpoint"
+IMPORT_BATCH = 1000
+# number of changes after which a save writes a new snapshot
+JOURNAL_COMPACT = 10000
+# "shelve" keeps everything in DB_FILE.db, "sqlite" in DB_FILE.sqlite
+BACKEND = "shelve"
+# with the sqlite backend at most this many words and kanji are kept in memory
+OBJECT_CACHE = 1024
+# number of rendered card backs that are kept
+RENDER_CACHE = 4096
+# order in which the cards of a review are drawn: random, shuffle or priority
+REVIEW_ORDER = "random"
+CACHE_DIR = "cache"
+CACHE_SIZE = 256 * 2**20
+CACHE_TTL = 90 * 24 * 60 * 60
+CACHE_NEGATIVE_TTL = 24 * 60 * 60
+# only answer lookups from the cache, never touch the network
+OFFLINE = False
+KANJI_WORKERS = 8
+IMPORT_WORKERS = 16
+# jisho.org gets at most HTTP_RATE requests per second (HTTP_BURST at once)
+# over kept alive connections, failed requests are tried HTTP_RETRIES more times
+HTTP_RATE = 10
+HTTP_BURST = 20
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_TIMEOUT = 10
+# words and kanji are looked up in this file first if it exists, it is built
+# from JMdict, KANJIDIC2 and KRADFILE with localdict.py
+DICTIONARY = "dictionary.sqlite"
+
+http_cache = None
+
+def open_cache():
+    global http_cache
+    if http_cache is None:
+        client = HttpClient(HTTP_RATE, HTTP_BURST, HTTP_RETRIES, HTTP_BACKOFF, HTTP_TIMEOUT,
+                max(KANJI_WORKERS, IMPORT_WORKERS))
+        http_cache = ResponseCache(CACHE_DIR, CACHE_SIZE, CACHE_TTL, CACHE_NEGATIVE_TTL, client, OFFLINE)
+    return http_cache
+
+def close_cache():
+    global http_cache
+    if http_cache is not None:
+        http_cache.close()
+        http_cache = None
+
+def fetch(url, negative=None):
+    return open_cache().get(url, negative)
+
+local_dictionary = None
+
+def open_dictionary():
+    global local_dictionary
+    if local_dictionary is None and DICTIONARY and os.path.exists(DICTIONARY):
+        local_dictionary = LocalDictionary(DICTIONARY)
+    return local_dictionary
+
+def close_dictionary():
+    global local_dictionary
+    if local_dictionary is not None:
+        local_dictionary.close()
+        local_dictionary = None
+
+kanji_resolver = Resolver(KANJI_WORKERS)
+
+def is_missing_kanji_page(text):
+    return 'class="kanji details"' not in text
+
+def is_missing_word_page(text):
+    return 'id="no-matches"' in text
 
 def clear():
     if os.name == "nt":
@@ -32,28 +127,6 @@ def split_and_strip(s, at):
     words = [e.strip() for e in s.split(at)]
     return list(filter(None, words))
 
-PUNCTUATION = (0x3000, 0x303F)
-HIRAGANA = (0x3040, 0x309F)
-KATAKANA = (0x30A0, 0x30FF)
-KATAKANA_PHONETIC = (0x31F0, 0x31FF)
-KANA = [PUNCTUATION, HIRAGANA, KATAKANA, KATAKANA_PHONETIC]
-
-def is_kana(char):
-    code = ord(char)
-    for uni_range in KANA:
-        if uni_range[0] <= code and code <= uni_range[1]:
-            return True
-    return False
-
-LATIN_THRESHOLD = 0x036F
-
-def filter_kanji(s):
-    kanjis = []
-    for char in s:
-        if ord(char) > LATIN_THRESHOLD:
-            kanjis.append(char)
-    return kanjis
-
 def prompt(other=None):
     while True:
         choice = input("([y]es/[n]o): ").strip().lower()
@@ -122,94 +195,549 @@ OTHER = 13
 
 NUM_RESERVED_WORD_LISTS = 5
 
-class Context:
+# databases saved before Bitset existed hold sets
+def as_bitset(l):
+    if isinstance(l, Bitset):
+        return l
+    return Bitset(l)
+
+# databases saved before ReviewQueue existed hold lists of [w_idx, wrong] and
+# the words that have been deleted during the review in invalid
+def as_review_queue(cards, invalid=()):
+    if isinstance(cards, ReviewQueue):
+        return cards
+    return ReviewQueue(card for card in cards if card[0] not in invalid)
+
+# databases saved before HoleArray existed hold HoleLists
+def as_hole_array(l):
+    if isinstance(l, HoleArray):
+        return l
+    return HoleArray(l.data, bytearray(x is not None for x in l.data))
+
+# the cards of a review; Context is the review of the terminal and journals
+# every change, server.py keeps one for every learner in memory
+class ReviewState:
+    # the order of every shuffled review round follows from these
+    review_seed = 0
+    review_round = 0
+
+    def __init__(self):
+        self.correct = ReviewQueue()
+        self.incorrect = ReviewQueue()
+        self.stash = ReviewQueue()
+
+    def change(self, op, *args):
+        getattr(self, "do_" + op)(*args)
+
+    def do_review_start(self, w_idxs, seed=0):
+        self.review_seed = seed
+        self.review_round = 0
+        self.correct = ReviewQueue()
+        self.incorrect = ReviewQueue([w_idx, 0] for w_idx in w_idxs)
+        self.stash = ReviewQueue()
+        self.shuffle_round()
+
+    # the order only depends on the seed of the review and the number of the
+    # round so that replaying the journal shuffles the same way
+    def shuffle_round(self):
+        self.incorrect.shuffle(random.Random(f"{self.review_seed}:{self.review_round}"))
+        self.review_round += 1
+
+    def take_card(self, w_idx):
+        card = self.incorrect.remove(w_idx)
+        if not self.incorrect:
+            self.incorrect, self.stash = self.stash, ReviewQueue()
+            self.shuffle_round()
+        return card
+
+    # words that are deleted leave the review right away
+    def drop_card(self, w_idx):
+        self.correct.discard(w_idx)
+        self.stash.discard(w_idx)
+        if w_idx in self.incorrect:
+            self.take_card(w_idx)
+
+    def do_answer(self, w_idx, correct):
+        card = self.take_card(w_idx)
+        if correct:
+            self.correct.push(card)
+        else:
+            card[1] += 1
+            self.stash.push(card)
+
+    # journals written before deleted words left the review right away
+    def do_skip(self, w_idx):
+        self.drop_card(w_idx)
+
+    def do_repeat(self):
+        self.incorrect, self.correct = self.correct, self.incorrect
+        self.shuffle_round()
+
+    def do_review_end(self):
+        self.review_seed = 0
+        self.review_round = 0
+        self.correct = ReviewQueue()
+        self.incorrect = ReviewQueue()
+        self.stash = ReviewQueue()
+
+class Context(ReviewState):
+    journal = None
+    store = None
+    components = None
+    renders = None
+    # databases saved before the parts of kanji were reduced with the
+    # component graph are reduced once when they are loaded
+    parts_reduced = False
+    # databases saved before the scheduler existed have no schedule yet
+    schedule = None
+    # called with the w_idx of every deleted word, server.py drops the cards
+    # of its learners through them
+    delete_hooks = ()
+
     def init_empty(self):
         self.kanjis = []
         self.kanji_idx_by_symbol = {}
-        self.words = HoleList()
+        self.words = HoleArray()
         self.word_idx_by_symbols = {}
-        self.word_lists = {"jlpt n" + str(i): set() for i in range(1, 6)}
-        self.word_list_names = HoleList(["jlpt n" + str(i) for i in range(1, 6)])
-        self.single_kanji_word_lists = tuple([set() for _ in range(14)])
-        self.slots = tuple([set() for _ in range(6)])
-        self.invalid = set()
-        self.no_single_kanji_word_cache = set()
-        self.correct = []
-        self.incorrect = []
-        self.stash = []
-
-    def write_to_file(self, path):
-        with shelve.open(path) as db:
-            db["context"] = self
+        self.word_lists = {"jlpt n" + str(i): Bitset() for i in range(1, 6)}
+        self.word_list_names = HoleArray(["jlpt n" + str(i) for i in range(1, 6)])
+        self.single_kanji_word_lists = tuple([Bitset() for _ in range(14)])
+        self.single_kanji_words = {}
+        self.slots = tuple([Bitset() for _ in range(6)])
+        self.correct = ReviewQueue()
+        self.incorrect = ReviewQueue()
+        self.stash = ReviewQueue()
+        self.schedule = Scheduler()
+        self.parts_reduced = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("journal", None)
+        state.pop("store", None)
+        state.pop("components", None)
+        state.pop("renders", None)
+        state.pop("delete_hooks", None)
+        return state
+
+    def write_to_file(self, path, full=False):
+        with stats.timer("write " + BACKEND):
+            if BACKEND == "sqlite":
+                self.write_to_sqlite(path, full)
+            else:
+                self.write_to_shelve(path, full)
+
+    # writes a snapshot once the journal has grown too long or if full is set,
+    # otherwise only makes the changes in the journal permanent
+    def write_to_shelve(self, path, full=False):
+        with self.batch():
+            journal = self.journal
+            if not full and journal is not None and journal.base != "empty" and len(journal) < JOURNAL_COMPACT:
+                journal.commit()
+                return
+            base = os.urandom(8).hex()
+            with shelve.open(path) as db:
+                db["context"] = self
+                db["journal"] = base
+            if journal is not None:
+                journal.reset(base)
+            else:
+                self.open_journal(path, base)
+
+    # the changes in the journal (also the ones of other processes) are applied
+    # to the database in one transaction and the journal starts over
+    def write_to_sqlite(self, path, full=False):
+        if self.store is None:
+            self.store = SQLiteStore(path + ".sqlite")
+        with self.batch():
+            base = os.urandom(8).hex()
+            journal = self.journal
+            if full or journal is None or journal.base == "empty":
+                self.store.save(self, base)
+            else:
+                self.store.apply(journal.records(), self, base)
+            # only a context loaded from the database holds the lazy containers
+            if isinstance(self.words, LazyHoleArray):
+                self.words.saved()
+                self.kanjis.saved()
+            if journal is not None:
+                journal.reset(base)
+            else:
+                self.open_journal(path, base)
+
+    def read_from_sqlite(self, path):
+        self.store = SQLiteStore(path + ".sqlite")
+        base = self.store.load(self, Word, Kanji, OBJECT_CACHE)
+        self.open_journal(path, base)
+        self.reduce_all_parts()
+        self.schedule_all()
 
     def read_from_file(self, path):
+        with stats.timer("read " + BACKEND):
+            if BACKEND == "sqlite":
+                self.read_from_sqlite(path)
+            else:
+                self.read_from_shelve(path)
+
+    def read_from_shelve(self, path):
         with shelve.open(path) as db:
             ctx = db["context"]
+            base = db.get("journal", "legacy")
             self.kanjis = ctx.kanjis
             self.kanji_idx_by_symbol = ctx.kanji_idx_by_symbol
-            self.words = ctx.words
+            self.words = as_hole_array(ctx.words)
             self.word_idx_by_symbols = ctx.word_idx_by_symbols
-            self.word_lists = ctx.word_lists
-            self.word_list_names = ctx.word_list_names
-            self.single_kanji_word_lists = ctx.single_kanji_word_lists
-            self.slots = ctx.slots
-            self.invalid = ctx.invalid
-            self.no_single_kanji_word_cache = ctx.no_single_kanji_word_cache
-            self.correct = ctx.correct
-            self.incorrect = ctx.incorrect
-            self.stash = ctx.stash
+            self.word_lists = {name: as_bitset(l) for name, l in ctx.word_lists.items()}
+            self.word_list_names = as_hole_array(ctx.word_list_names)
+            self.single_kanji_word_lists = tuple(map(as_bitset, ctx.single_kanji_word_lists))
+            self.slots = tuple(map(as_bitset, ctx.slots))
+            if "single_kanji_words" in ctx.__dict__:
+                self.single_kanji_words = ctx.single_kanji_words
+            else:
+                self.build_single_kanji_words(ctx.no_single_kanji_word_cache)
+            invalid = ctx.__dict__.get("invalid", ())
+            self.correct = as_review_queue(ctx.correct, invalid)
+            self.incorrect = as_review_queue(ctx.incorrect, invalid)
+            self.stash = as_review_queue(ctx.stash, invalid)
+            self.review_seed = ctx.review_seed
+            self.review_round = ctx.review_round
+            self.schedule = ctx.schedule
+            self.parts_reduced = ctx.__dict__.get("parts_reduced", False)
+        self.open_journal(path, base)
+        self.reduce_all_parts()
+        self.schedule_all()
+
+    # replays the changes that have been made since the snapshot with the id base
+    def open_journal(self, path, base="empty"):
+        path += ".journal"
+        journal = Journal(path, base)
+        records = journal.read(base)
+        if records is None:
+            journal.close()
+            os.replace(path, path + ".old")
+            print(f"Warning: {path} does not belong to this database, moved it to {path}.old")
+            journal = Journal(path, base)
+            records = []
+        for op, args in records:
+            getattr(self, "do_" + op)(*args)
+        self.journal = journal
+
+    def close(self, save):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.journal is None:
+            return
+        if not save and not self.journal.rollback():
+            print("Warning: the changes were kept, another process has changed the database since")
+        self.journal.close()
+        self.journal = None
+
+    # applies a change and appends it to the journal,
+    # every change is a do_<op> method so that replaying is the same as applying
+    def change(self, op, *args):
+        with self.batch():
+            getattr(self, "do_" + op)(*args)
+            self.log(op, *args)
+
+    # appends a change that has already been applied
+    def log(self, op, *args):
+        if self.journal is not None:
+            with self.batch():
+                self.journal.append((op, args))
+
+    # groups changes so that the journal is only synced once; other processes
+    # can't append in the meantime and their changes are applied first, so
+    # indexes that are chosen inside of the batch are still free
+    @contextmanager
+    def batch(self):
+        if self.journal is None:
+            yield
+            return
+        with self.journal.batch():
+            for op, args in self.journal.updates():
+                getattr(self, "do_" + op)(*args)
+            yield
+
+    # applies the changes that other processes have made since
+    def catch_up(self):
+        with self.batch():
+            pass
+
+    # k_idx -> w_idxs of the words that consist of only this kanji, an empty set
+    # means that jisho.org does not have such a word, built once for databases
+    # that have been saved before the index existed
+    def build_single_kanji_words(self, no_single_kanji_words):
+        self.single_kanji_words = {}
+        for char in no_single_kanji_words:
+            k_idx = self.kanji_idx_by_symbol.get(char, -1)
+            if k_idx != -1:
+                self.single_kanji_words[k_idx] = set()
+        for w_idx in union(self.single_kanji_word_lists):
+            k_idx = self.words[w_idx].kanji_index[0]
+            self.single_kanji_words.setdefault(k_idx, set()).add(w_idx)
+
+    def component_graph(self):
+        if self.components is None:
+            self.components = ComponentGraph(lambda k_idx: self.kanjis[k_idx].parts)
+        return self.components
+
+    # reduces the parts of every kanji in one pass unless that has already
+    # happened, the result is made permanent right away
+    def reduce_all_parts(self):
+        if self.parts_reduced:
+            return
+        graph = self.component_graph()
+        k_idxs = [k_idx for k_idx, k in enumerate(self.kanjis) if k]
+        self.change("reduce_parts", graph.reduce_all(k_idxs))
+        self.journal.commit()
+
+    # every word gets an initial interval from its slot unless the database
+    # already has a schedule, the result is made permanent right away
+    def schedule_all(self):
+        if self.schedule is not None:
+            return
+        now = time.time()
+        entries = []
+        for slot in range(len(self.slots)):
+            interval = SLOT_INTERVALS[slot]
+            entries += [(w_idx, now + interval * DAY, START_EASE, interval) for w_idx in self.slots[slot]]
+        self.change("schedule", entries)
+        self.journal.commit()
+
+    # renumbers the words so that there are no holes, the journal refers to the
+    # old indexes, so the context has to be written with full=True right after
+    def compact(self):
+        remap = self.words.compact()
+        self.renders = None
+        def new(w_idx):
+            return remap[w_idx] if w_idx < len(remap) else -1
+        def apply(w_idxs):
+            return Bitset(remap[w_idx] for w_idx in w_idxs)
+        self.word_idx_by_symbols = {s: remap[w_idx] for s, w_idx in self.word_idx_by_symbols.items()}
+        self.word_lists = {name: apply(l) for name, l in self.word_lists.items()}
+        self.single_kanji_word_lists = tuple(map(apply, self.single_kanji_word_lists))
+        self.single_kanji_words = {k_idx: set(remap[w_idx] for w_idx in l)
+                for k_idx, l in self.single_kanji_words.items()}
+        self.slots = tuple(map(apply, self.slots))
+        self.correct = self.correct.remap(new)
+        self.incorrect = self.incorrect.remap(new)
+        self.stash = self.stash.remap(new)
+        self.schedule = self.schedule.remap(new)
+
+    def index_word(self, idx, w):
+        self.word_idx_by_symbols[w.word] = idx
+        self.slots[w.slot].add(idx)
+        for n_idx in w.word_lists:
+            self.word_lists[self.word_list_names[n_idx]].add(idx)
+        if len(w.kanji_index) == 1:
+            k = self.kanjis[w.kanji_index[0]]
+            for c in k.categories:
+                self.single_kanji_word_lists[c].add(idx)
+            self.single_kanji_words.setdefault(w.kanji_index[0], set()).add(idx)
+
+    def unindex_word(self, idx, w):
+        for i in w.word_lists:
+            l = self.word_lists[self.word_list_names[i]]
+            l.discard(idx)
+        if len(w.kanji_index) == 1:
+            k_idx = w.kanji_index[0]
+            single_kanji_word_lists = self.kanjis[k_idx].categories
+            for i in single_kanji_word_lists:
+                l = self.single_kanji_word_lists[i]
+                l.discard(idx)
+            l = self.single_kanji_words[k_idx]
+            l.discard(idx)
+            if not l:
+                del self.single_kanji_words[k_idx]
+        l = self.slots[w.slot]
+        l.discard(idx)
+        del self.word_idx_by_symbols[w.word]
+
+    # the rendered back of a word, kept until something that it shows changes
+    def render(self, w_idx):
+        if self.renders is None:
+            self.renders = RenderCache(lambda w_idx: self.words[w_idx].back(self), RENDER_CACHE)
+        return self.renders.get(w_idx)
+
+    def forget_render(self, w_idx):
+        if self.renders is not None:
+            self.renders.drop(w_idx)
+
+    def forget_kanji_render(self, k_idx):
+        if self.renders is not None:
+            self.renders.drop_kanji(k_idx)
+
+    def forget_list_render(self, name):
+        if self.renders is not None:
+            for w_idx in self.word_lists[name]:
+                self.renders.drop(w_idx)
+
+    def do_add_kanjis(self, kanjis, missing):
+        for idx, k in kanjis:
+            while len(self.kanjis) <= idx:
+                self.kanjis.append(None)
+            self.kanjis[idx] = k
+            self.forget_kanji_render(idx)
+            self.kanji_idx_by_symbol[k.char] = idx
+        for char in missing:
+            self.kanji_idx_by_symbol[char] = -1
+
+    def do_reduce_parts(self, changes):
+        for k_idx, parts in changes:
+            k = self.kanjis[k_idx]
+            k.parts = tuple(parts)
+            self.kanjis[k_idx] = k
+            self.forget_kanji_render(k_idx)
+        self.parts_reduced = True
+
+    def do_no_single_kanji_word(self, char):
+        k_idx = self.kanji_idx_by_symbol.get(char, -1)
+        if k_idx != -1:
+            self.single_kanji_words.setdefault(k_idx, set())
+
+    # new words are due right away
+    def do_add_word(self, idx, w):
+        self.words.put(idx, w)
+        self.index_word(idx, w)
+        self.forget_render(idx)
+        if self.schedule is not None:
+            self.schedule.set(idx, 0, START_EASE, 0)
+
+    def do_delete_word(self, idx):
+        self.drop_card(idx)
+        if self.schedule is not None:
+            self.schedule.remove(idx)
+        self.unindex_word(idx, self.words[idx])
+        del self.words[idx]
+        self.forget_render(idx)
+        for hook in self.delete_hooks:
+            hook(idx)
+
+    # words are stored back after changing them so that a lazily loaded
+    # context keeps them in memory until they have been saved
+    def do_meanings(self, idx, meanings):
+        w = self.words[idx]
+        w.meanings = tuple(meanings)
+        self.words[idx] = w
+        self.forget_render(idx)
+
+    def do_word_list_add(self, idx, n_idx):
+        w = self.words[idx]
+        w.add_to_list(n_idx)
+        self.words[idx] = w
+        self.forget_render(idx)
+        self.word_lists[self.word_list_names[n_idx]].add(idx)
+
+    def do_word_list_remove(self, idx, n_idx):
+        w = self.words[idx]
+        w.remove_from_list(n_idx)
+        self.words[idx] = w
+        self.forget_render(idx)
+        self.word_lists[self.word_list_names[n_idx]].discard(idx)
+
+    def do_list_add(self, n_idx, name):
+        self.word_list_names.put(n_idx, name)
+        self.word_lists[name] = Bitset()
+
+    def do_list_rename(self, n_idx, new_name):
+        name = self.word_list_names[n_idx]
+        self.forget_list_render(name)
+        self.word_list_names[n_idx] = new_name
+        self.word_lists[new_name] = self.word_lists.pop(name)
+
+    def do_list_delete(self, n_idx):
+        name = self.word_list_names[n_idx]
+        self.forget_list_render(name)
+        for w_idx in self.word_lists[name]:
+            w = self.words[w_idx]
+            w.remove_from_list(n_idx)
+            self.words[w_idx] = w
+        del self.word_lists[name]
+        del self.word_list_names[n_idx]
+
+    def do_slot(self, idx, slot):
+        w = self.words[idx]
+        self.slots[w.slot].discard(idx)
+        w.slot = slot
+        self.words[idx] = w
+        self.slots[slot].add(idx)
+
+    def do_schedule(self, entries):
+        self.schedule = Scheduler(entries)
+
+    def do_reschedule(self, idx, due, ease, interval):
+        self.schedule.set(idx, due, ease, interval)
+
+# sets of small ints (categories, word lists) are stored as the bits of an int
+def to_mask(values):
+    mask = 0
+    for v in values:
+        mask |= 1 << v
+    return mask
+
+def from_mask(mask):
+    values = []
+    i = 0
+    while mask:
+        if mask & 1:
+            values.append(i)
+        mask >>= 1
+        i += 1
+    return values
+
+# the same readings and meanings show up in many words
+def intern_all(strings):
+    return [sys.intern(s) for s in strings]
 
 class Kanji:
+    __slots__ = ("char", "meanings", "category_mask", "parts", "radical", "__weakref__")
+
     def __init__(self, char, meanings, categories, parts, radical):
-        self.char = char
-        self.meanings = meanings
-        self.categories = categories
-        self.parts = parts
+        self.char = sys.intern(char)
+        self.meanings = tuple(intern_all(meanings)) if meanings is not None else None
+        self.category_mask = to_mask(categories) if categories else 0
+        self.parts = tuple(parts) if parts is not None else None
         self.radical = radical
 
-    def scrape_radical_helper(radical, trim_stack, ctx):
-        k_idx = ctx.kanji_idx_by_symbol.get(radical)
-        if k_idx is None:
-            k_idx = Kanji.scrape(radical, trim_stack, ctx)
-        if k_idx == -1:
-            ctx.kanji_idx_by_symbol[radical] = -1
-            return -1
-        return k_idx
+    def __getstate__(self):
+        return (self.char, self.meanings, self.categories, self.parts, self.radical)
 
-    def trim_parts(trim_stack, ctx):
-        while trim_stack:
-            k_idx = trim_stack.pop()
-            k = ctx.kanjis[k_idx]
-            parts = k.parts
-            trimmed = parts.copy()
-            for k_idx_o in parts:
-                for k_idx_i in parts:
-                    k_i = ctx.kanjis[k_idx_i]
-                    if k_idx_o in k_i.parts:
-                        trimmed.remove(k_idx_o)
-                        break
-            k.parts = trimmed
-
-    # this does not prevent duplicates
-    def scrape(char, trim_stack, ctx):
-        print(f"Adding kanji {char}")
-        response = requests.get(BASE_URL + char + "%23kanji")
-        if response.status_code != 200:
-            print(f"Error: could not get data for kanji {char}")
-            return -1
-        parsed = BeautifulSoup(response.text, "html.parser")
-        if not parsed.body.find("div", attrs={"class": "kanji details"}):
+    # pickles from before __slots__ hold the __dict__ of the kanji
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = (state["char"], state["meanings"], state["categories"],
+                    state["parts"], state["radical"])
+        self.__init__(*state)
+
+    @property
+    def categories(self):
+        return from_mask(self.category_mask)
+
+    # runs in a worker thread, only touches the network and the cache
+    def fetch(char):
+        page = None
+        if local_dictionary is not None:
+            with stats.timer("local kanji"):
+                page = local_dictionary.kanji(char)
+        if page is None:
+            response = fetch(BASE_URL + char + "%23kanji", is_missing_kanji_page)
+            if response.status_code != 200:
+                print(f"Error: could not get data for kanji {char}")
+                return None
+            with stats.timer("parse kanji"):
+                page = extract_kanji(response.text)
+        if not page:
             print(f"Error: {char} is not a valid kanji")
-            return -1
-        meanings = parsed.body.find("div", attrs={"class": "kanji-details__main-meanings"}).text
-        meanings = split_and_strip(meanings, ",")
-        #meanings = choose_options(meanings, "Choose meanings")
+            return None
+        meanings = split_and_strip(page["meanings"] or "", ",")
         category = False
         categories = set()
-        grade = parsed.body.find("div", attrs={"class": "grade"})
-        if grade and not grade.text.isspace():
-            words = split_and_strip(grade.text, " ")
-            if words[0] == "Jōyō":
+        grade = page["grade"]
+        if grade and not grade.isspace():
+            # jisho.org writes "Jōyō" with combining macrons, localdict.py and
+            # the fixtures with precomposed letters
+            words = split_and_strip(unicodedata.normalize("NFC", grade), " ")
+            if words[0] == "Jōyō":
                 categories.add(JOYO)
                 category = True
             if words[-1].isdigit():
@@ -218,47 +746,85 @@ class Kanji:
             elif words[-1] == "high":
                 categories.add(HIGH)
                 category = True
-        jlpt = parsed.body.find("div", attrs={"class": "jlpt"})
-        if jlpt:
-            categories.add(LEVEL + int(jlpt.text.strip()[-1]) - 1)
+        jlpt = page["jlpt"]
+        if jlpt and not jlpt.isspace():
+            categories.add(LEVEL + int(jlpt.strip()[-1]) - 1)
             category = True
         if not category:
             categories.add(OTHER)
-        radical_info = parsed.body.find_all("div", attrs={"class": "radicals"})
-        radicals = list(map(BeautifulSoup.get_text, radical_info[1].find_all("a")))
-        idx = len(ctx.kanjis)
-        ctx.kanjis.append(Kanji(char, None, None, None, None))
-        ctx.kanji_idx_by_symbol[char] = idx
-        trim_stack.append(idx)
-        parts = []
-        for radical in radicals:
-            if radical == char:
-                continue
-            k_idx = Kanji.scrape_radical_helper(radical, trim_stack, ctx)
-            if k_idx != -1:
-                parts.append(k_idx)
-        radicals = filter_kanji(radical_info[0].text)
-        for k_idx in parts:
-            k = ctx.kanjis[k_idx]
-            if k.char in radicals:
-                radical = k_idx
-                break
-        else:
-            radical = re.sub("\(.*\)", "", radical_info[0].text).strip()[-1]
-            if radical != char:
-                radical = Kanji.scrape_radical_helper(radical, trim_stack, ctx)
-            else:
-                radical = idx
-        k = Kanji(char, meanings, categories, parts, radical)
-        ctx.kanjis[idx] = k
-        return idx
+        radical_info = page["radicals"]
+        return {
+            "meanings": meanings,
+            "categories": categories,
+            "parts": [p for p in page["parts"] if p != char],
+            "radicals": filter_kanji(radical_info[0]),
+            "radical": re.sub(r"\(.*\)", "", radical_info[0]).strip()[-1],
+        }
 
-    def display_with_meaning(self, radical):
+    # fetches all missing kanji in chars together with all of their missing parts
+    # and radicals concurrently, returns char -> k_idx (-1 if it could not be added)
+    def resolve(chars, ctx, resolver=None, progress=None):
+        def deps(char, data):
+            needed = data["parts"] + [data["radical"]]
+            return [c for c in needed if c != char and c not in ctx.kanji_idx_by_symbol]
+        roots = list(dict.fromkeys(c for c in chars if c not in ctx.kanji_idx_by_symbol))
+        resolver = resolver if resolver else kanji_resolver
+        with stats.timer("resolve kanji"):
+            results, order = resolver.resolve(roots, Kanji.fetch, deps, progress)
+        # kanji that another process has added in the meantime are left alone
+        with ctx.batch():
+            new = [char for char in order if results[char] is not None and char not in ctx.kanji_idx_by_symbol]
+            added = []
+            missing = []
+            for char in new:
+                if not progress:
+                    print(f"Adding kanji {char}")
+                idx = len(ctx.kanjis)
+                ctx.kanjis.append(Kanji(char, None, None, None, None))
+                ctx.kanji_idx_by_symbol[char] = idx
+                added.append(idx)
+            for char in order:
+                if results[char] is None and char not in roots and char not in ctx.kanji_idx_by_symbol:
+                    ctx.kanji_idx_by_symbol[char] = -1
+                    missing.append(char)
+            for char in new:
+                data = results[char]
+                idx = ctx.kanji_idx_by_symbol[char]
+                parts = []
+                for part in data["parts"]:
+                    k_idx = ctx.kanji_idx_by_symbol.get(part, -1)
+                    if k_idx != -1:
+                        parts.append(k_idx)
+                for k_idx in parts:
+                    if ctx.kanjis[k_idx].char in data["radicals"]:
+                        radical = k_idx
+                        break
+                else:
+                    radical = data["radical"]
+                    radical = ctx.kanji_idx_by_symbol.get(radical, -1) if radical != char else idx
+                k = Kanji(char, data["meanings"], data["categories"], parts, radical)
+                ctx.kanjis[idx] = k
+            graph = ctx.component_graph()
+            with stats.timer("reduce parts"):
+                for idx in added:
+                    k = ctx.kanjis[idx]
+                    k.parts = tuple(graph.reduce(k.parts))
+            if added or missing:
+                ctx.log("add_kanjis", [(idx, ctx.kanjis[idx]) for idx in added], missing)
+        return {c: ctx.kanji_idx_by_symbol.get(c, -1) for c in chars}
+
+    def scrape(char, ctx):
+        return Kanji.resolve([char], ctx)[char]
+
+    def meaning_line(self, radical):
         meanings = ", ".join(self.meanings)
         is_radical = " (radical)" if self.char == radical else ""
-        print(f"{self.char}{is_radical}: {meanings}")
+        return f"{self.char}{is_radical}: {meanings}"
 
-    def display_categories(self):
+    def display_with_meaning(self, radical):
+        print(self.meaning_line(radical))
+
+    def categories_line(self):
         cat_names = []
         for c in self.categories:
             if c == JOYO:
@@ -269,61 +835,135 @@ class Kanji:
                 cat_names.insert(1, f"taught in junior high")
             elif c >= LEVEL and c < LEVEL + 5:
                 cat_names.insert(2, f"jlpt n{c-LEVEL+1}")
-        print(", ".join(cat_names))
+        return ", ".join(cat_names)
 
-    def display_parts(self, ctx):
+    def display_categories(self):
+        print(self.categories_line())
+
+    def parts_lines(self, ctx):
+        lines = []
         r = ctx.kanjis[self.radical]
         radical = r.char
         if self.radical not in self.parts and radical != self.char:
-            r.display_with_meaning(radical)
+            lines.append(r.meaning_line(radical))
         for k_idx in self.parts:
             k = ctx.kanjis[k_idx]
-            k.display_with_meaning(radical)
+            lines.append(k.meaning_line(radical))
+        return lines
+
+    def display_parts(self, ctx):
+        for line in self.parts_lines(ctx):
+            print(line)
 
 class Word:
+    __slots__ = ("word", "furigana", "meanings", "kanji_index", "list_mask", "slot", "__weakref__")
+
     # does not prevent duplicates
     def __init__(self, word, furigana, meanings=None, kanji_index=None, word_lists=None):
         self.word = word
-        self.furigana = furigana
-        self.meanings = meanings if meanings else []
-        self.kanji_index = kanji_index if kanji_index else []
-        self.word_lists = word_lists if word_lists else set()
+        self.furigana = tuple(intern_all(furigana))
+        self.meanings = tuple(intern_all(meanings)) if meanings else ()
+        self.kanji_index = tuple(kanji_index) if kanji_index else ()
+        self.list_mask = to_mask(word_lists) if word_lists else 0
         self.slot = 0
-        self.upper = ""
-        self.lower = ""
+
+    def __getstate__(self):
+        return (self.word, self.furigana, self.meanings, self.kanji_index, self.word_lists, self.slot)
+
+    def __setstate__(self, state):
+        # pickles from before __slots__ hold the __dict__ of the word
+        if isinstance(state, dict):
+            state = (state["word"], state["furigana"], state["meanings"],
+                    state["kanji_index"], state["word_lists"], state["slot"])
+        self.__init__(*state[:5])
+        self.slot = state[5]
+
+    @property
+    def word_lists(self):
+        return from_mask(self.list_mask)
+
+    def add_to_list(self, n_idx):
+        self.list_mask |= 1 << n_idx
+
+    def remove_from_list(self, n_idx):
+        self.list_mask &= ~(1 << n_idx)
+
+    # the furigana line and the word line spaced to match it, computed when
+    # the word is displayed instead of being kept around for every word
+    def layout(self):
+        upper = ""
+        lower = ""
         furi_idx = 0
         diff = 0
-        i = 0
-        while i < len(word):
-            char = word[i]
-            if not is_kana(char):
+        for i, part in enumerate(script.split_kana(self.word)):
+            if i % 2:
+                if diff > 0:
+                    lower += ' ' * diff * 2
+                diff = 0
+                lower += part
+                upper += ' ' * 2 * len(part)
+                continue
+            for char in part:
                 if furi_idx < len(self.furigana):
-                    self.lower += ' ' * diff * 2 + char
+                    lower += ' ' * diff * 2 + char
                     furi = self.furigana[furi_idx]
-                    self.upper += furi
+                    upper += furi
                     diff = len(furi) - 1
                     furi_idx += 1
                 else:
-                    self.lower += char
+                    lower += char
                     if diff > 0:
                         diff -= 1
-            else:
-                if diff > 0:
-                    self.lower += ' ' * diff * 2
-                diff = 0
-                self.lower += char
-                self.upper += ' ' * 2
-            i += 1
         if diff > 0:
-            self.lower += ' ' * diff * 2
+            lower += ' ' * diff * 2
+        return upper, lower
 
     def calculate_kanji_positions(word):
-        kanji_positions = []
-        for i in range(len(word)):
-            char = word[i]
-            if not is_kana(char):
-                kanji_positions.append(i)
-        return kanji_positions
+        return script.kanji_positions(word)
+
+    # runs in a worker thread, only touches the network and the cache,
+    # returns the search result or one of the error codes below
+    def fetch(word, exact_match=True, single_kanji=False):
+        def accept(text):
+            if single_kanji and len(Word.calculate_kanji_positions(text)) != 1:
+                return False
+            return not exact_match or text == word
+        known, result = False, None
+        if local_dictionary is not None:
+            with stats.timer("local word"):
+                known, result = local_dictionary.search(word, accept)
+        # a kanji that the dictionary knows without a single kanji word has none
+        if result is None and not (known and single_kanji):
+            response = fetch(BASE_URL + word, is_missing_word_page)
+            if response.status_code != 200:
+                print(f"Error: could not get data for word {word}")
+                return -1
+            with stats.timer("parse word"):
+                count, result = extract_word(response.text, accept, SEARCH_DEPTH)
+            if not count:
+                print(f"Error: invalid word {word}")
+                return -1
+            if is_missing_word_page(response.text):
+                print(f"Error: no matches for word {word}")
+                return -1
+        if not result:
+            if exact_match:
+                print(f"Error: could not find exact match for {word}")
+                return NO_EXACT_MATCH
+            print(f"Error: could not find single kanji word for {word}")
+            return NO_SINGLE_KANJI_WORD
+        if result["rt"] is not None:
+            furigana = [result["rt"]]
+        else:
+            furigana = list(filter(lambda s: not s.isspace() and s, result["furigana"] or []))
+        meanings = split_and_strip(";".join(result["meanings"]), ";")
+        level = result["level"]
+        return {
+            "word": result["text"],
+            "furigana": furigana,
+            "meanings": meanings,
+            "level": level.strip() if level else "",
+        }
 
     def scrape(word, ctx, exact_match=True, single_kanji=False, data=None):
         w_data = None
@@ -332,55 +972,25 @@ class Word:
             if not w_data:
                 data = None
         if not w_data:
-            response = requests.get(BASE_URL + word)
-            if response.status_code != 200:
-                print(f"Error: could not get data for word {word}")
+            result = Word.fetch(word, exact_match, single_kanji)
+            if result == NO_EXACT_MATCH:
+                print("Do you want to input it manually?")
+                if prompt():
+                    return add_word_manual(word, ctx)
                 return -1
-            parsed = BeautifulSoup(response.text, "html.parser")
-            results = parsed.body.find_all("div", attrs={"class": "concept_light clearfix"}) 
-            if not results:
-                print(f"Error: invalid word {word}")
+            if result == NO_SINGLE_KANJI_WORD:
+                ctx.change("no_single_kanji_word", word[0])
                 return -1
-            if parsed.body.find("div", attrs={"id": "no-matches"}):
-                print(f"Error: no matches for word {word}")
+            if result == -1:
                 return -1
-            for i in range(min(SEARCH_DEPTH, len(results))):
-                result = results[i]
-                text_container = result.find("span", attrs={"class": "text"})
-                if text_container:
-                    text = text_container.text.strip()
-                else:
-                    continue
-                kanji_positions = Word.calculate_kanji_positions(text)
-                if single_kanji and len(kanji_positions) != 1:
-                    continue
-                if not exact_match or text == word:
-                    break
-            else:
-                if exact_match:
-                    print(f"Error: could not find exact match for {word}")
-                    print("Do you want to input it manually?")
-                    if prompt():
-                        return add_word_manual(word, ctx)
-                    return -1
-                elif single_kanji:
-                    print(f"Error: could not find single kanji word for {word}")
-                    ctx.no_single_kanji_word_cache.add(word[0])
-                    return -1
+            text = result["word"]
             if not exact_match and text != word:
                 k_idx = ctx.word_idx_by_symbols.get(text)
                 if (k_idx is not None) or (data and data.get(text)):
                     return -1
-            furigana = result.find("span", attrs={"class": "furigana"})
-            singles = furigana.find("rt")
-            if singles:
-                furigana = [singles.text]
-            else:
-                furigana = list(filter(lambda s: not s.isspace() and s,
-                    map(BeautifulSoup.get_text, furigana)))
             word = text
+            furigana = result["furigana"]
         else:
-            kanji_positions = Word.calculate_kanji_positions(word)
             furigana = w_data["furigana"]
         w = Word(word, furigana)
         w.display("Adding @")
@@ -391,109 +1001,128 @@ class Word:
 #           if (not prompt()):
 #               return -1
         if not w_data:
-            meanings = result.find_all("span", attrs={"class": "meaning-meaning"})
-            meanings = split_and_strip(";".join(map(BeautifulSoup.get_text, meanings)), ";")
-            w.meanings = choose_options(meanings, "Choose meanings")
-            if w.meanings is None:
+            meanings = choose_options(result["meanings"], "Choose meanings")
+            if meanings is None:
                 return -1
+            level = result["level"]
         else:
-            w.meanings = w_data["meanings"]
-        for i in kanji_positions:
-            char = word[i]
-            if not is_kana(char):
-                k_idx = ctx.kanji_idx_by_symbol.get(char)
-                if k_idx is None: 
-                    trim_stack = []
-                    k_idx = Kanji.scrape(char, trim_stack, ctx)
-                    Kanji.trim_parts(trim_stack, ctx)
-                    if k_idx == -1:
-                        return -1
-                w.kanji_index.append(k_idx)
-        idx = ctx.words.add(w)
-        ctx.word_idx_by_symbols[word] = idx
-        if w_data and "slot" in w_data:
-            slot = w_data["slot"]
-            w.slot = slot
-        else:
-            slot = 0
-        ctx.slots[slot].add(idx)
-        if not w_data:
-            jlpt = result.find("span", attrs={"class": "concept_light-tag label"})
-        else:
-            jlpt = w_data["level"]
-        if jlpt:
-            if not w_data:
-                jlpt = jlpt.text.strip()
-            if "JLPT" in jlpt:
-                level = jlpt[-1]
-                ctx.word_lists["jlpt n" + level].add(idx)
-                w.word_lists.add(int(level) - 1)
+            meanings = w_data["meanings"]
+            level = w_data["level"]
+        w.meanings = tuple(intern_all(meanings))
+        if not Word.link_kanji(w, Kanji.resolve(w.kanji_chars(), ctx)):
+            return -1
+        slot = w_data["slot"] if w_data and "slot" in w_data else 0
+        idx = Word.insert(w, level, slot, ctx)
+        for k_char in Word.missing_single_kanji_words(w, ctx):
+            Word.scrape(
+                    k_char,
+                    ctx,
+                    exact_match=False,
+                    single_kanji=True,
+                    data=data)
+        return idx
+
+    def kanji_chars(self):
+        return script.kanji_chars(self.word)
+
+    # k_idxs maps kanji chars to their k_idx (-1 if the kanji could not be added)
+    def link_kanji(self, k_idxs):
+        kanji_index = []
+        for char in self.kanji_chars():
+            k_idx = k_idxs.get(char, -1)
+            if k_idx == -1:
+                return False
+            kanji_index.append(k_idx)
+        self.kanji_index = tuple(kanji_index)
+        return True
+
+    # adds a word whose kanji have already been linked to all indexes
+    def insert(self, level, slot, ctx):
+        self.slot = slot
+        if "JLPT" in level:
+            self.add_to_list(int(level[-1]) - 1)
         for n_idx in auto_add_word_lists:
-            w.word_lists.add(n_idx)
-            name = ctx.word_list_names[n_idx]
-            ctx.word_lists[name].add(idx)
-        if len(w.kanji_index) == 1:
-            k = ctx.kanjis[w.kanji_index[0]]
-            for c in k.categories:
-                ctx.single_kanji_word_lists[c].add(idx)
-        else:
-            for i in w.kanji_index:
-                k = ctx.kanjis[i]
-                m = (-1, sys.maxsize)
-                for c in k.categories:
-                    l = len(ctx.single_kanji_word_lists[c])
-                    if l < m[1]:
-                        m = (c, l)
-                for y in ctx.single_kanji_word_lists[m[0]]:
-                    if i == ctx.words[y].kanji_index[0]:
-                        break
-                else:
-                    k_char = ctx.kanjis[i].char
-                    if k_char not in ctx.no_single_kanji_word_cache:
-                        Word.scrape(
-                                k_char,
-                                ctx,
-                                exact_match=False,
-                                single_kanji=True,
-                                data=data)
+            self.add_to_list(n_idx)
+        with ctx.batch():
+            # another process may have added the word in the meantime
+            idx = ctx.word_idx_by_symbols.get(self.word)
+            if idx is None:
+                idx = ctx.words.next_index()
+                ctx.change("add_word", idx, self)
         return idx
 
-    def display(self, surrounding="@"):
+    # chars of the kanji in a multi kanji word that do not have a single kanji word yet
+    def missing_single_kanji_words(self, ctx):
+        if len(self.kanji_index) < 2:
+            return []
+        missing = []
+        for i in self.kanji_index:
+            if i not in ctx.single_kanji_words:
+                char = ctx.kanjis[i].char
+                if char not in missing:
+                    missing.append(char)
+        return missing
+
+    def lines(self, surrounding="@"):
         pos = surrounding.find('@')
-        if self.upper and not self.upper.isspace():
-            print(' ' * pos + self.upper)
-        print(surrounding.replace('@', self.lower))
+        upper, lower = self.layout()
+        lines = []
+        if upper and not upper.isspace():
+            lines.append(' ' * pos + upper)
+        lines.append(surrounding.replace('@', lower))
+        return lines
 
-    def display_word_lists(self, ctx):
+    def display(self, surrounding="@"):
+        for line in self.lines(surrounding):
+            print(line)
+
+    def word_lists_line(self, ctx):
         wl_names = []
         for l in self.word_lists:
             wl_names.insert(l, ctx.word_list_names[l])
-        print(", ".join(wl_names))
+        return ", ".join(wl_names)
 
-    def display_full(self, ctx):
-        self.display()
-        print("Meaning:")
-        for meaning in self.meanings:
-            print(f"• {meaning}")
+    def display_word_lists(self, ctx):
+        print(self.word_lists_line(ctx))
+
+    # the back of the card as a CardBack, ctx.render() keeps it around
+    def back(self, ctx):
+        upper, lower = self.layout()
+        kanji = []
+        parts = []
+        categories = None
+        k_idxs = set(self.kanji_index)
         is_single = len(self.kanji_index) == 1
         if len(self.kanji_index) != 0:
             radical = ctx.kanjis[self.kanji_index[0]].radical
             radical = ctx.kanjis[radical].char if is_single else None
-            print("Kanji:")
             for k_idx in self.kanji_index:
                 k = ctx.kanjis[k_idx]
-                k.display_with_meaning(radical)
+                kanji.append((k.char, k.char == radical, k.meanings))
         if is_single:
             k = ctx.kanjis[self.kanji_index[0]]
             if k.parts:
-                print("Parts:")
-                k.display_parts(ctx)
+                r = ctx.kanjis[k.radical]
+                k_idxs.add(k.radical)
+                if k.radical not in k.parts and r.char != k.char:
+                    parts.append((r.char, True, r.meanings))
+                for k_idx in k.parts:
+                    part = ctx.kanjis[k_idx]
+                    k_idxs.add(k_idx)
+                    parts.append((part.char, part.char == r.char, part.meanings))
             if OTHER not in k.categories:
-                print("Categories: ", end="")
-                k.display_categories()
-        if len(self.word_lists) != 0:
-            print("Word lists: ", end="")
-            self.display_word_lists(ctx)
+                categories = k.categories_line()
+        word_lists = []
+        for l in self.word_lists:
+            word_lists.insert(l, ctx.word_list_names[l])
+        return CardBack(upper, lower, self.meanings, kanji, parts, categories, word_lists, k_idxs)
+
+    def full_lines(self, ctx):
+        return self.back(ctx).lines()
+
+    def display_full(self, ctx):
+        for line in self.full_lines(ctx):
+            print(line)
 
 
 def json_to_word_data(j, ctx):
@@ -602,11 +1231,12 @@ def edit_word_lists(ctx):
             return
         if cmd == 'a' or cmd == "add":
             name = input("Add word list: ").strip()
-            if name in ctx.word_lists:
-                print(f"Error: word list {name} already exists")
-                continue
-            ctx.word_list_names.add(name)
-            ctx.word_lists[name] = set()
+            with ctx.batch():
+                error = invalid_word_list_name(name, ctx)
+                if error:
+                    print(f"Error: {error}")
+                    continue
+                ctx.change("list_add", ctx.word_list_names.next_index(), name)
             updated = True
             continue
         parsed = parse_edit_cmd(cmd, names)
@@ -617,20 +1247,17 @@ def edit_word_lists(ctx):
         n_idx = ctx.word_list_names.index(name)
         if action == 'r' or action == "rename":
             new_name = input(f"{name} -> ").strip()
-            if new_name in ctx.word_lists:
-                print("Error: name collision with word list {new_name}")
-                continue
-            ctx.word_list_names[n_idx] = new_name
-            ctx.word_lists[new_name] = ctx.word_lists.pop(name)
+            with ctx.batch():
+                error = invalid_word_list_name(new_name, ctx)
+                if error:
+                    print(f"Error: {error}")
+                    continue
+                ctx.change("list_rename", n_idx, new_name)
         elif action == 'd' or action == "delete":
             print(f"Are you sure, that you want to delete word list {name}?")
             if not prompt():
                 continue
-            for w_idx in ctx.word_lists[name]:
-                w = ctx.words[w_idx]
-                w.word_lists.discard(n_idx)
-            del ctx.word_lists[name]
-            del ctx.word_list_names[n_idx]
+            ctx.change("list_delete", n_idx)
         elif action == "auto":
             if n_idx in auto_add_word_lists:
                 auto_add_word_lists.remove(n_idx)
@@ -667,8 +1294,7 @@ def add_to_word_lists(word, w_idx, ctx):
         for name in choices:
             n_idx = ctx.word_list_names.index(name)
             print(f"Adding {word.word} to word list {name}")
-            word.word_lists.add(n_idx)
-            ctx.word_lists[name].add(w_idx)
+            ctx.change("word_list_add", w_idx, n_idx)
             names.remove(name)
 
 def remove_from_word_lists(word, w_idx, ctx):
@@ -685,11 +1311,10 @@ def remove_from_word_lists(word, w_idx, ctx):
         for name in choices:
             n_idx = ctx.word_list_names.index(name)
             print(f"Removing {word.word} from word list {name}")
-            word.word_lists.discard(n_idx)
-            ctx.word_lists[name].discard(w_idx)
+            ctx.change("word_list_remove", w_idx, n_idx)
             names.remove(name)
 
-def edit_meaning(word):
+def edit_meaning(word, w_idx, ctx):
     updated = True
     while True:
         if updated:
@@ -702,7 +1327,7 @@ def edit_meaning(word):
             return
         if cmd == 'a' or cmd == "add":
             meaning = input("Add meaning: ").strip()
-            word.meanings.append(meaning)
+            ctx.change("meanings", w_idx, word.meanings + (meaning,))
             updated = True
             continue
         parsed = parse_edit_cmd(cmd, word.meanings)
@@ -711,12 +1336,16 @@ def edit_meaning(word):
         action, n = parsed
         if action == 'c' or action == "change":
             meaning = input(f"{word.meanings[n]} -> ").strip()
-            word.meanings[n] = meaning
+            meanings = list(word.meanings)
+            meanings[n] = meaning
+            ctx.change("meanings", w_idx, meanings)
         elif action == 'd' or action == "delete":
             if len(word.meanings) == 1:
                 print("Error: cannot delete last meaning of word")
                 continue
-            del word.meanings[n]
+            meanings = list(word.meanings)
+            del meanings[n]
+            ctx.change("meanings", w_idx, meanings)
         else:
             print(f"Error: unknown command {action}")
             continue
@@ -736,26 +1365,12 @@ def edit_words(ctx, sel=None, idx=-1):
             print("Are you sure?")
             if not prompt():
                 continue
-            ctx.invalid.add(idx)
-            word_lists = sel.word_lists
-            for i in word_lists:
-                l = ctx.word_lists[ctx.word_list_names[i]]
-                l.discard(idx)
-            if len(sel.kanji_index) == 1:
-                k_idx = sel.kanji_index[0]
-                single_kanji_word_lists = ctx.kanjis[k_idx].categories
-                for i in single_kanji_word_lists:
-                    l = ctx.single_kanji_word_lists[i]
-                    l.discard(idx)
-            l = ctx.slots[sel.slot]
-            l.discard(idx)
-            del ctx.words[idx]
-            del ctx.word_idx_by_symbols[sel.word]
+            ctx.change("delete_word", idx)
             sel = None
         elif word == 'm' or word == "meaning":
             if not sel:
                 continue
-            edit_meaning(sel)
+            edit_meaning(sel, idx, ctx)
         elif word == 'i' or word == "info":
             if not sel:
                 continue
@@ -782,258 +1397,681 @@ def edit_words(ctx, sel=None, idx=-1):
                 continue
         display_selected(sel)
 
+# (heading, [(number, name, size)]) for every group of word lists, the numbers
+# are the ones that word list expressions refer to
+def word_list_groups(ctx):
+    slots = [(f"slot {i+1}", ctx.slots[i]) for i in range(len(ctx.slots))]
+    word_lists = [(name, ctx.word_lists[name]) for name in ctx.word_list_names]
+    word_lists.append(("all", ctx.words))
+    single = [("jōyō kanji", JOYO)]
+    single += [(f"grade {y+1}", GRADE+y) for y in range(6)]
+    single.append(("junior high", HIGH))
+    single += [(f"kanji jlpt n{y+1}", LEVEL+y) for y in range(5)]
+    single.append(("other", OTHER))
+    single = [(name, ctx.single_kanji_word_lists[c]) for name, c in single]
+    groups = []
+    i = 0
+    for heading, lists in ((None, slots), ("Word lists", word_lists), ("Single kanji word lists", single)):
+        groups.append((heading, [(i+j+1, name, len(l)) for j, (name, l) in enumerate(lists)]))
+        i += len(lists)
+    return groups
+
+# why name can't be given to a word list, None if it can; word list expressions
+# refer to word lists by name, so a name must not be a number, contain an
+# operator or be the name of any other word list
+def invalid_word_list_name(name, ctx):
+    if not name:
+        return "empty word list name"
+    if re.search(r"[-,&|()]", name):
+        return f"word list name {name} contains one of - , & | ( )"
+    if re.fullmatch(r"[\d.]+", name):
+        return f"word list name {name} is a number"
+    for _, lists in word_list_groups(ctx):
+        for _, other, _ in lists:
+            if other.lower() == name.lower():
+                return f"word list {other} already exists"
+    return None
+
 def enumerate_all_word_lists(ctx):
     all_word_list_names = []
-    for i in range(len(ctx.slots)):
-        n = len(ctx.slots[i])
-        wl_name = f"slot {i+1}"
-        all_word_list_names.append(wl_name)
-        print(f"{i+1}. {wl_name}: {n}")
-    print("\nWord lists:")
-    i = len(ctx.slots)
-    for wl_name in ctx.word_list_names:
-        n = len(ctx.word_lists[wl_name])
-        i += 1
-        all_word_list_names.append(wl_name)
-        print(f"{i}. {wl_name}: {n}")
-    i += 1
-    n = len(ctx.words)
-    wl_name = "all"
-    all_word_list_names.append(wl_name)
-    print(f"{i}. {wl_name}: {n}")
-    print("\nSingle kanji word lists:")
-    i += 1
-    n = len(ctx.single_kanji_word_lists[JOYO])
-    wl_name = "jōyō kanji"
-    all_word_list_names.append(wl_name)
-    print(f"{i}. {wl_name}: {n}")
-    for y in range(6):
-        n = len(ctx.single_kanji_word_lists[GRADE+y])
-        i += 1
-        wl_name = f"grade {y+1}"
-        all_word_list_names.append(wl_name)
-        print(f"{i}. {wl_name}: {n}")
-    i += 1
-    n = len(ctx.single_kanji_word_lists[HIGH])
-    wl_name = "junior high"
-    all_word_list_names.append(wl_name)
-    print(f"{i}. {wl_name}: {n}")
-    for y in range(5):
-        n = len(ctx.single_kanji_word_lists[LEVEL+y])
-        i += 1
-        wl_name = f"jlpt n{y+1}" 
-        all_word_list_names.append(wl_name)
-        print(f"{i}. {wl_name}: {n}")
-    i += 1
-    n = len(ctx.single_kanji_word_lists[OTHER])
-    wl_name = "other"
-    all_word_list_names.append(wl_name)
-    print(f"{i}. {wl_name}: {n}")
+    for heading, lists in word_list_groups(ctx):
+        if heading:
+            print(f"\n{heading}:")
+        for i, name, n in lists:
+            all_word_list_names.append(name)
+            print(f"{i}. {name}: {n}")
     return all_word_list_names
 
-def select_word_lists(all_word_list_names, ctx):
-    word_lists = []
-    names = []
-    options = tuple(range(1, len(all_word_list_names)+1))
-    choices = choose_options(options, output=False, empty_is_first=False)
+# the word list with the given index in the list printed by enumerate_all_word_lists
+def word_list_by_index(idx, ctx):
+    n = len(ctx.slots)
+    if idx < n:
+        return ctx.slots[idx]
+    idx -= n
     word_list_names = list(ctx.word_list_names)
-    if not choices:
-        return choices
-    for idx in choices:
-        idx -= 1
-        names.append(all_word_list_names[idx])
-        n = len(ctx.slots)
-        if idx < n:
-            word_lists.append(ctx.slots[idx])
-            continue
-        idx -= n
-        n = len(word_list_names)
-        if idx < n:
-            word_lists.append(ctx.word_lists[word_list_names[idx]])
-            continue
-        idx -= n
-        if idx == 0:
-            word_lists.append(set(ctx.word_idx_by_symbols.values()))
-            continue
-        idx -= 1
-        if idx == 0:
-            word_lists.append(ctx.single_kanji_word_lists[JOYO])
-            continue
-        idx -= 1
-        if idx < 6:
-            word_lists.append(ctx.single_kanji_word_lists[GRADE+idx])
-            continue
-        idx -= 6
-        if idx == 0:
-            word_lists.append(ctx.single_kanji_word_lists[HIGH])
-            continue
-        idx -= 1
-        if idx < 5:
-            word_lists.append(ctx.single_kanji_word_lists[LEVEL+idx])
-            continue
-        idx -= 5
-        if idx == 0:
-            word_lists.append(ctx.single_kanji_word_lists[OTHER])
+    n = len(word_list_names)
+    if idx < n:
+        return ctx.word_lists[word_list_names[idx]]
+    idx -= n
+    if idx == 0:
+        return Bitset.from_bytemap(ctx.words.used)
+    idx -= 1
+    if idx == 0:
+        return ctx.single_kanji_word_lists[JOYO]
+    idx -= 1
+    if idx < 6:
+        return ctx.single_kanji_word_lists[GRADE+idx]
+    idx -= 6
+    if idx == 0:
+        return ctx.single_kanji_word_lists[HIGH]
+    idx -= 1
+    if idx < 5:
+        return ctx.single_kanji_word_lists[LEVEL+idx]
+    idx -= 5
+    return ctx.single_kanji_word_lists[OTHER]
+
+WORD_LIST_OPERATORS = {
+        "|": Bitset.__or__,
+        ",": Bitset.__or__,
+        "&": Bitset.__and__,
+        "-": Bitset.__sub__,
+        }
+
+WORD_LIST_RANGE = re.compile(r"(\d+)\.\.(\d+)")
+
+# combines word lists, given by their number, a range of numbers (4..6) or their
+# name, from left to right with | or , (union), & (intersection) and -
+# (difference), parentheses group; input that only consists of numbers and
+# ranges (1,4..6) is the union of those word lists, returns the words and a
+# description, raises ValueError
+def parse_word_list_expression(expr, all_word_list_names, ctx):
+    n = len(all_word_list_names)
+    def lookup(token):
+        if token.isdigit():
+            i = int(token) - 1
+            if i < 0 or n <= i:
+                raise ValueError(f"no such option {token}")
+            return i
+        for i in range(n):
+            if all_word_list_names[i].lower() == token:
+                return i
+        raise ValueError(f"no such word list {token}")
+    # the indexes of the word lists that token stands for
+    def lookup_all(token):
+        m = WORD_LIST_RANGE.fullmatch(token)
+        if not m:
+            return [lookup(token)]
+        first, last = int(m[1]), int(m[2])
+        if first > last:
+            raise ValueError(f"invalid range {token}")
+        return [lookup(str(i)) for i in range(first, last + 1)]
+    if re.fullmatch(r"\s*\d+(\.\.\d+)?(\s*,\s*\d+(\.\.\d+)?)*\s*", expr):
+        idxs = []
+        for s in split_and_strip(expr, ","):
+            idxs += lookup_all(s)
+        idxs = list(dict.fromkeys(idxs))
+        words = union(word_list_by_index(i, ctx) for i in idxs)
+        return words, ", ".join(all_word_list_names[i] for i in idxs)
+    tokens = [t.strip() for t in re.split(r"([|,&()-])", expr) if t.strip()]
+    pos = 0
+    def operand():
+        nonlocal pos
+        if pos == len(tokens):
+            raise ValueError("incomplete expression")
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            words = expression()
+            if pos == len(tokens) or tokens[pos] != ")":
+                raise ValueError("missing )")
+            pos += 1
+            return words
+        if token == ")" or token in WORD_LIST_OPERATORS:
+            raise ValueError(f"unexpected {token}")
+        return union(word_list_by_index(i, ctx) for i in lookup_all(token))
+    def expression():
+        nonlocal pos
+        words = operand()
+        while pos < len(tokens) and tokens[pos] in WORD_LIST_OPERATORS:
+            op = WORD_LIST_OPERATORS[tokens[pos]]
+            pos += 1
+            words = op(words, operand())
+        return words
+    words = expression()
+    if pos != len(tokens):
+        raise ValueError(f"unexpected {tokens[pos]}")
+    return words, expr
+
+# the review without any input or output, review_words drives it from the
+# terminal and server.py from the browser; review is the ReviewState the cards
+# come from (ctx itself by default), with a lock (sessions.RWLock) the shared
+# ctx is only read under its read lock and only changed under its write lock
+class ReviewEngine:
+    def __init__(self, ctx, review=None, lock=None):
+        self.ctx = ctx
+        self.review = review if review is not None else ctx
+        self.lock = lock
+        # w_idxs of the words that other threads have deleted from ctx (through
+        # Context.delete_hooks), their cards leave review before it is used next
+        self.deleted = []
+
+    def reading(self):
+        return self.lock.read() if self.lock else nullcontext()
+
+    def writing(self):
+        return self.lock.write() if self.lock else nullcontext()
+
+    def decks(self):
+        with self.reading():
+            return word_list_groups(self.ctx)
+
+    # the words of a word list expression that are not in words yet and a
+    # description of the expression, raises ValueError
+    def select(self, expr, words=None):
+        names = [name for _, lists in self.decks() for _, name, _ in lists]
+        with self.reading(), stats.timer("select"):
+            word_list, description = parse_word_list_expression(expr.strip().lower(), names, self.ctx)
+        if words:
+            word_list = word_list - words
+        if not word_list:
+            raise ValueError("can't select from empty word list")
+        return word_list, description
+
+    # adds n random words of word_list to words
+    def pick(self, word_list, n, words):
+        with stats.timer("pick"):
+            words.update(word_list.sample(min(n, len(word_list))))
+
+    # the first n words that are due now, most overdue first
+    def due(self, n):
+        # due() pushes the entries it pops back onto the heap
+        with self.writing():
+            return self.ctx.schedule.due(time.time(), n)
+
+    def drop_deleted(self):
+        while self.deleted:
+            self.review.drop_card(self.deleted.pop())
+
+    # an unfinished review is continued instead of starting a new one
+    def active(self):
+        self.drop_deleted()
+        return bool(self.review.incorrect or self.review.correct)
+
+    def start(self, w_idxs):
+        # words that have been deleted since they were picked are left out
+        with self.reading():
+            self.deleted.clear()
+            w_idxs = [w_idx for w_idx in w_idxs if self.ctx.words.occupied(w_idx)]
+        self.review.change("review_start", w_idxs, random.getrandbits(32))
+
+    # the w_idx of the next card, None once the round is over; with skip the
+    # card that comes after skip, None if that depends on the answer to skip
+    def next_card(self, skip=None):
+        self.drop_deleted()
+        return self.review.incorrect.draw(REVIEW_ORDER, skip)
+
+    # a card leaves the round when it is answered or its word is deleted
+    def has_card(self, w_idx):
+        self.drop_deleted()
+        return w_idx in self.review.incorrect
+
+    # front, back and back_html return None if the word has been deleted
+    def front(self, w_idx):
+        with self.reading():
+            if self.ctx.words.occupied(w_idx):
+                return self.ctx.words[w_idx].word
+
+    def back(self, w_idx):
+        with self.reading():
+            if self.ctx.words.occupied(w_idx):
+                return self.ctx.render(w_idx).text
+
+    def back_html(self, w_idx):
+        with self.reading():
+            if self.ctx.words.occupied(w_idx):
+                return self.ctx.render(w_idx).html
+
+    def answer(self, w_idx, correct):
+        self.review.change("answer", w_idx, correct)
+
+    def repeat(self):
+        self.review.change("repeat")
+
+    # moves the cards between the slots and reschedules them unless the
+    # review is aborted
+    def finish(self, abort=False):
+        with self.writing(), self.ctx.batch():
+            self.drop_deleted()
+            if not abort:
+                finish_review(self.ctx, self.review)
+            self.review.change("review_end")
+
+    def save(self):
+        with self.writing():
+            self.ctx.write_to_file(DB_FILE)
+
+    # everything a client needs to review w_idxs on its own: the cards as
+    # [w_idx, front, back, k_idxs] and their kanji as k_idx -> [char, meanings]
+    def bundle(self, w_idxs):
+        cards = []
+        kanji = {}
+        with self.reading():
+            for w_idx in w_idxs:
+                if not self.ctx.words.occupied(w_idx):
+                    continue
+                w = self.ctx.words[w_idx]
+                cards.append([w_idx, w.word, self.ctx.render(w_idx).text, list(w.kanji_index)])
+                for k_idx in w.kanji_index:
+                    if k_idx not in kanji:
+                        k = self.ctx.kanjis[k_idx]
+                        kanji[k_idx] = [k.char, list(k.meanings)]
+        return {"cards": cards, "kanji": kanji}
+
+    # finishes a review that happened somewhere else with the same rules as
+    # review_words: cards are the [w_idx, front] that were reviewed, log the
+    # [w_idx, correct] answers in order; cards whose word has been deleted or
+    # renumbered since are left out, raises ValueError if the log can't have
+    # come from the cards, returns the number of cards that were applied
+    def sync(self, cards, log):
+        with self.writing():
+            words = self.ctx.words
+            w_idxs = set()
+            for w_idx, front in cards:
+                if words.occupied(w_idx) and words[w_idx].word == front:
+                    w_idxs.add(w_idx)
+            review = ReviewState()
+            review.do_review_start(sorted(w_idxs))
+            for w_idx, correct in log:
+                if w_idx not in w_idxs:
+                    continue
+                if w_idx not in review.incorrect:
+                    raise ValueError(f"card {w_idx} was answered out of turn")
+                review.do_answer(w_idx, bool(correct))
+            with self.ctx.batch():
+                finish_review(self.ctx, review)
+        return len(review.correct)
+
+def select_word_lists(engine, words):
+    while True:
+        resp = input("Select: ").strip().lower()
+        if resp == 'b' or resp == "back":
+            return None
+        if not resp:
+            return []
+        try:
+            word_list, description = engine.select(resp, words)
+        except ValueError as e:
+            print(f"Error: {e}")
             continue
-        print("Fatal error: reached unreachable code")
-    if names:
-        print("Selected", ", ".join(names))
-    return word_lists
+        print("Selected", description)
+        return word_list
 
-def select_words(ctx):
+def select_words(engine):
     clear()
-    all_word_list_names = enumerate_all_word_lists(ctx)
-    words = set()
+    enumerate_all_word_lists(engine.ctx)
+    words = Bitset()
     while True:
-        word_lists = select_word_lists(all_word_list_names, ctx)
-        if word_lists is None:
+        word_list = select_word_lists(engine, words)
+        if word_list is None:
             return None
-        if word_lists == []:
+        if word_list == []:
             if not words:
                 print("Error: can't review empty word list")
                 continue
             break
-        word_list = set.union(*word_lists)
-        word_list.difference_update(words)
-        if not word_list:
-            print("Error: can't select from empty word list")
-            continue
-        n = 0
         while True:
             n = input("Number of cards: ").strip()
             if not n.isdigit():
                 print(f"Error: invalid number {n}")
                 continue
-            n = min(int(n), len(word_list))
             break
-        words.update(random.sample(tuple(word_list), n))
+        engine.pick(word_list, int(n), words)
     return words
 
-def review_words(ctx):
-    incorrect = ctx.incorrect
-    if not incorrect:
-        ctx.invalid.clear()
-        word_list = select_words(ctx)
-        if not word_list:
+def review_words(ctx, w_idxs=None):
+    engine = ReviewEngine(ctx)
+    if not engine.active():
+        if w_idxs is None:
+            w_idxs = select_words(engine)
+        if not w_idxs:
             return
-        incorrect = [[w_idx, 0] for w_idx in word_list]
-    correct = ctx.correct
-    stash = ctx.stash
+        engine.start(w_idxs)
     abort = False
     while True:
-        while incorrect or stash:
-            if not incorrect:
-                incorrect = stash
-                stash = []
+        while True:
+            with stats.timer("card front"):
+                w_idx = engine.next_card()
+                front = engine.front(w_idx) if w_idx is not None else None
+            if w_idx is None:
+                break
             clear()
-            c_idx = random.randrange(len(incorrect))
-            card = incorrect[c_idx]
-            w_idx = card[0]
-            if w_idx in ctx.invalid:
-                del incorrect[c_idx]
-                ctx.invalid.discard(w_idx)
-                continue
             w = ctx.words[w_idx]
-            print(w.word)
+            print(front)
             usr = input("[Check] ").strip().lower()
             if usr == 'b' or usr == "back":
-                ctx.correct = correct
-                ctx.incorrect = incorrect
-                ctx.stash = stash
                 return
             elif usr == 'a' or usr == "abort":
                 abort = True
                 break
-            del incorrect[c_idx]
             err = 0
             while True:
                 if not err: clear()
                 else: print()
                 err = 0
-                w.display_full(ctx)
+                with stats.timer("card back"):
+                    print(engine.back(w_idx))
                 print("Were you able to answer?")
                 cmd = prompt([("e", "edit"), ("a", "add"), ("r", "remove")])
                 if cmd == "e":
                     edit_words(ctx, sel=w, idx=w_idx)
-                    if w_idx in ctx.invalid:
-                        ctx.invalid.discard(w_idx)
+                    # the word has been deleted
+                    if not engine.has_card(w_idx):
                         break
                 elif cmd == "a":
                     err = add_to_word_lists(w, w_idx, ctx)
                 elif cmd == "r":
                     err = remove_from_word_lists(w, w_idx, ctx)
-                elif cmd:
-                    correct.append(card)
-                    break
                 else:
-                    card[1] += 1
-                    stash.append(card)
+                    with stats.timer("card answer"):
+                        engine.answer(w_idx, cmd)
                     break
         if abort:
             break
         print("Repeat with same deck?")
         if not prompt():
             break
-        incorrect, correct = correct, incorrect
-    if not abort:
-        for card in correct:
-            wrong = card[1]
-            if wrong == 1:
-                continue
-            w_idx = card[0]
-            w = ctx.words[w_idx]
-            #if wrong >= 2:
-            #    if w.slot > 0:
-            #        ctx.slots[w.slot].discard(w_idx)
-            #        w.slot = max(w.slot - wrong + 1, 0)
-            #        ctx.slots[w.slot].add(w_idx)
-            #elif w.slot < len(ctx.slots) - 1:
-            #    ctx.slots[w.slot].discard(w_idx)
-            #    w.slot += 1
-            #    ctx.slots[w.slot].add(w_idx)
-            if wrong > 0:
-                if w.slot > 0:
-                    ctx.slots[w.slot].discard(w_idx)
-                    w.slot = 0
-                    ctx.slots[0].add(w_idx)
-            elif w.slot < len(ctx.slots) - 1:
-                ctx.slots[w.slot].discard(w_idx)
-                w.slot += 1
-                ctx.slots[w.slot].add(w_idx)
-    ctx.invalid.clear()
-    ctx.correct = []
-    ctx.incorrect = []
-    ctx.stash = []
+        engine.repeat()
+    engine.finish(abort)
+
+# reviews the words that are due now, most overdue first, an unfinished
+# review is continued instead
+def review_due(ctx):
+    clear()
+    engine = ReviewEngine(ctx)
+    if engine.active():
+        review_words(ctx)
+        return
+    if not engine.due(1):
+        next_due = ctx.schedule.next_due()
+        if next_due is None:
+            print("Error: there are no words to review")
+        else:
+            hours = (next_due - time.time()) / 3600
+            print(f"Nothing is due, the next word is due in {hours:.1f} hours")
+        return
+    while True:
+        n = input("Number of cards: ").strip().lower()
+        if n == 'b' or n == "back":
+            return
+        if not n.isdigit():
+            print(f"Error: invalid number {n}")
+            continue
+        break
+    review_words(ctx, engine.due(int(n)))
 
+def finish_review(ctx, review):
+    now = time.time()
+    for card in review.correct:
+        w_idx, wrong = card
+        # SM-2 quality: right the first time, right after one mistake, forgotten
+        quality = 5 if wrong == 0 else 3 if wrong == 1 else 1
+        ctx.change("reschedule", w_idx, *ctx.schedule.review(w_idx, quality, now))
+        if wrong == 1:
+            continue
+        w = ctx.words[w_idx]
+        #if wrong >= 2:
+        #    if w.slot > 0:
+        #        ctx.slots[w.slot].discard(w_idx)
+        #        w.slot = max(w.slot - wrong + 1, 0)
+        #        ctx.slots[w.slot].add(w_idx)
+        #elif w.slot < len(ctx.slots) - 1:
+        #    ctx.slots[w.slot].discard(w_idx)
+        #    w.slot += 1
+        #    ctx.slots[w.slot].add(w_idx)
+        if wrong > 0:
+            if w.slot > 0:
+                ctx.change("slot", w_idx, 0)
+        elif w.slot < len(ctx.slots) - 1:
+            ctx.change("slot", w_idx, w.slot + 1)
+
+# one json object per line and word, read and written one line at a time;
+# the level and slot are in the format of the old words.json
 def export_words(ctx):
-    data = {}
-    for w in ctx.words:
-        w_data = {}
-        w_data["furigana"] = w.furigana
-        w_data["meanings"] = w.meanings
-        level = list(filter(lambda l: l < NUM_RESERVED_WORD_LISTS, w.word_lists))
-        level = level[0] + 1 if level else 0
-        w_data["level"] = "JLPT n" + str(level) if level else ""
-        w_data["slot"] = w.slot
-        data[w.word] = w_data
-    with open(WORDS_FILE, "w+") as f:
-        json.dump(data, f)
+    opener = gzip.open if WORDS_FILE.endswith(".gz") else open
+    with opener(WORDS_FILE, "wt", encoding="utf-8") as f:
+        for w_idx, w in ctx.words.items():
+            level = list(filter(lambda l: l < NUM_RESERVED_WORD_LISTS, w.word_lists))
+            level = level[0] + 1 if level else 0
+            w_data = {
+                "word": w.word,
+                "furigana": w.furigana,
+                "meanings": w.meanings,
+                "level": "JLPT n" + str(level) if level else "",
+                "slot": w.slot,
+                "lists": [ctx.word_list_names[l] for l in w.word_lists if l >= NUM_RESERVED_WORD_LISTS],
+            }
+            schedule = ctx.schedule.get(w_idx) if ctx.schedule is not None else None
+            if schedule is not None:
+                w_data["schedule"] = schedule
+            f.write(json.dumps(w_data, ensure_ascii=False) + "\n")
+
+def print_progress(what, done, total):
+    print(f"\r{what}: {done}/{total}", end="", flush=True)
+    if done == total:
+        print()
+
+# links the kanji of the words in pending, which are (word, data), fetching the
+# missing ones concurrently; returns the entries whose kanji could all be added
+def link_words(pending, ctx, resolver, failed):
+    chars = script.kanji_chars_all([w.word for w, _ in pending])
+    k_idxs = Kanji.resolve(chars, ctx, resolver,
+            lambda done, total: print_progress("Fetching kanji", done, total))
+    linked = []
+    for entry in pending:
+        if Word.link_kanji(entry[0], k_idxs):
+            linked.append(entry)
+        else:
+            failed.append((entry[0].word, "could not add all kanji"))
+    return linked
+
+def insert_words(words, ctx):
+    with ctx.batch():
+        for w, w_data in words:
+            for name in w_data.get("lists", ()):
+                if name not in ctx.word_lists:
+                    ctx.change("list_add", ctx.word_list_names.next_index(), name)
+                w.add_to_list(ctx.word_list_names.index(name))
+            idx = w.insert(w_data["level"], w_data.get("slot", 0), ctx)
+            if w_data.get("schedule") and ctx.schedule is not None:
+                ctx.change("reschedule", idx, *w_data["schedule"])
 
+# imports all (word, data) entries without prompting, the kanji pages are
+# fetched concurrently on the threads of resolver and ctx is only touched once
+# everything has been fetched; the chars of the kanji of multi kanji words are
+# added to needed, their single kanji words are added at the very end by
+# add_single_kanji_words, when every entry of the file had its chance; returns
+# the number of imported words and (word, reason) of the ones that failed
+def bulk_import(entries, ctx, resolver, needed):
+    seen = set()
+    pending = []
+    for word, w_data in entries:
+        if word in ctx.word_idx_by_symbols or word in seen:
+            continue
+        seen.add(word)
+        pending.append((Word(word, w_data["furigana"], w_data["meanings"]), w_data))
+    skipped = len(entries) - len(pending)
+    if skipped:
+        print(f"Already added {skipped} words -> skipping")
+    failed = []
+    words = link_words(pending, ctx, resolver, failed)
+    insert_words(words, ctx)
+    for w, _ in words:
+        if len(w.kanji_index) > 1:
+            needed.update(ctx.kanjis[k_idx].char for k_idx in w.kanji_index)
+    return len(words), failed
+
+# fetches the single kanji words that are still missing for chars concurrently
+# and adds them with all of their meanings
+def add_single_kanji_words(chars, ctx, resolver):
+    missing = [char for char in sorted(chars) if ctx.kanji_idx_by_symbol[char] not in ctx.single_kanji_words]
+    results, _ = resolver.resolve(
+            missing,
+            lambda char: Word.fetch(char, exact_match=False, single_kanji=True),
+            lambda char, result: [],
+            lambda done, total: print_progress("Fetching single kanji words", done, total))
+    failed = []
+    symbols = set()
+    pending = []
+    for char in missing:
+        result = results[char]
+        if result == NO_SINGLE_KANJI_WORD:
+            ctx.change("no_single_kanji_word", char)
+        if not isinstance(result, dict):
+            failed.append((char, "could not get single kanji word"))
+            continue
+        text = result["word"]
+        if text in symbols or text in ctx.word_idx_by_symbols:
+            continue
+        symbols.add(text)
+        w = Word(text, result["furigana"], result["meanings"])
+        pending.append((w, {"level": result["level"]}))
+    words = link_words(pending, ctx, resolver, failed)
+    insert_words(words, ctx)
+    return len(words), failed
+
+# why the entry of word can't be imported, None if it can
+def entry_error(word, w_data, ctx):
+    def strings(value):
+        return isinstance(value, list) and all(isinstance(s, str) for s in value)
+    if not isinstance(word, str) or not word:
+        return "no word"
+    if not isinstance(w_data, dict):
+        return "not an object"
+    if not strings(w_data.get("furigana")):
+        return "invalid furigana"
+    if not strings(w_data.get("meanings")):
+        return "invalid meanings"
+    level = w_data.get("level")
+    if not isinstance(level, str) or ("JLPT" in level and level[-1] not in "12345"):
+        return "invalid level"
+    slot = w_data.get("slot", 0)
+    if type(slot) is not int or not 0 <= slot < len(ctx.slots):
+        return "invalid slot"
+    if not strings(w_data.get("lists", [])):
+        return "invalid word lists"
+    schedule = w_data.get("schedule")
+    if schedule is not None and not (isinstance(schedule, list) and len(schedule) == 3
+            and all(type(x) in (int, float) for x in schedule)):
+        return "invalid schedule"
+    return None
+
+# (offset to continue from, word, data, error) for every entry of f from offset
+# on, error is why the entry can't be imported or None; a line holding a whole
+# old words.json is read as all of its entries
+def read_entries(f, offset, ctx):
+    f.seek(offset)
+    for line in f:
+        start = offset
+        offset += len(line)
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield offset, f"line at byte {start}", None, "invalid json"
+            continue
+        if not isinstance(data, dict):
+            yield offset, f"line at byte {start}", None, "not an object"
+            continue
+        if "word" in data:
+            yield offset, data["word"], data, entry_error(data["word"], data, ctx)
+            continue
+        # the line can only be continued from its start until its last entry
+        entries = list(data.items())
+        for i, (word, w_data) in enumerate(entries):
+            yield offset if i == len(entries) - 1 else start, word, w_data, entry_error(word, w_data, ctx)
+
+# (offset, needed kanji) to continue the import of path from, (0, set()) unless
+# the checkpoint is for this very file and the last word it imported is still there
+def read_checkpoint(path, ctx):
+    try:
+        with open(CHECKPOINT_FILE, "r") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0, set()
+    st = os.stat(path)
+    if [checkpoint.get("file"), checkpoint.get("size"), checkpoint.get("mtime")] != [path, st.st_size, st.st_mtime_ns]:
+        return 0, set()
+    last = checkpoint.get("last")
+    if last is not None and last not in ctx.word_idx_by_symbols:
+        return 0, set()
+    return checkpoint.get("offset", 0), set(checkpoint.get("kanji", ()))
+
+def write_checkpoint(path, offset, last, needed):
+    st = os.stat(path)
+    with open(CHECKPOINT_FILE + ".tmp", "w") as f:
+        json.dump({"file": path, "size": st.st_size, "mtime": st.st_mtime_ns, "offset": offset, "last": last,
+                "kanji": sorted(needed)}, f, ensure_ascii=False)
+    os.replace(CHECKPOINT_FILE + ".tmp", CHECKPOINT_FILE)
+
+# the entries are imported IMPORT_BATCH at a time and after every batch the
+# position in the file and the kanji that need a single kanji word are
+# remembered, an interrupted import continues there
 def import_words(ctx):
+    path = next(filter(os.path.exists, IMPORT_FILES), None)
+    if path is None:
+        print(f"Error: could not open {WORDS_FILE}")
+        return
+    offset, needed = read_checkpoint(path, ctx)
+    if offset:
+        print(f"Resuming the import of {path}")
+    imported = 0
+    failed = []
+    last = None
+    n_kanjis = len(ctx.kanjis)
+    # one pool of workers for all batches
+    resolver = Resolver(IMPORT_WORKERS)
+    def flush(batch, offset):
+        nonlocal imported, last
+        n, batch_failed = bulk_import(batch, ctx, resolver, needed)
+        imported += n
+        failed.extend(batch_failed)
+        last = next((word for word, _ in reversed(batch) if word in ctx.word_idx_by_symbols), last)
+        write_checkpoint(path, offset, last, needed)
     try:
-        with open(WORDS_FILE, "r") as f:
-            data = json.load(f)
-    except:
-        print("Error: could not open {WORDS_FILE}")
-    for word, w_data in data.items():
-        w_idx = ctx.word_idx_by_symbols.get(word)
-        if w_idx is not None:
-            print(f"Already added {word} -> skipping")
-            continue
-        Word.scrape(word, ctx, data=data)
+        with open_source(path) as f:
+            batch = []
+            for offset, word, w_data, error in read_entries(f, offset, ctx):
+                if error:
+                    failed.append((word, error))
+                    continue
+                batch.append((word, w_data))
+                if len(batch) >= IMPORT_BATCH:
+                    flush(batch, offset)
+                    batch = []
+            if batch:
+                flush(batch, offset)
+        n, single_failed = add_single_kanji_words(needed, ctx, resolver)
+        imported += n
+        failed.extend(single_failed)
+    # a damaged file, the entries themselves can't make the import fail
+    except (OSError, EOFError, zlib.error) as e:
+        print(f"Error: could not read {path} ({e}), import it again to continue")
+    else:
+        if os.path.exists(CHECKPOINT_FILE):
+            os.remove(CHECKPOINT_FILE)
+    finally:
+        resolver.close()
+    print(f"Imported {imported} words and {len(ctx.kanjis) - n_kanjis} kanji")
+    if failed:
+        print(f"Failed to import {len(failed)} words:")
+        for word, reason in failed:
+            print(f"{word}: {reason}")
 
 def main():
     clear()
+    open_cache()
+    open_dictionary()
     ctx = Context()
     try: 
         ctx.read_from_file(DB_FILE)
@@ -1041,44 +2079,67 @@ def main():
         print(f"Warning: could not read from {DB_FILE}.db")
         print("Warning: if you don't want to lose everything when exiting, kill the program")
         ctx.init_empty()
+        ctx.open_journal(DB_FILE)
     abort = False
     while True:
         display_auto_add_info(ctx)
         choice = input("Action: ").strip().lower()
-        if choice == 'a' or choice == "add":
-            add_words(ctx)
-        elif choice == 'l' or choice == "list":
-            edit_word_lists(ctx)
-        elif choice == 'e' or choice == "edit":
-            edit_words(ctx)
-        elif choice == 'r' or choice == "review":
-            review_words(ctx)
-        elif choice == "exit":
-            break
-        elif choice == "abort":
-            abort = True
-            break
-        elif choice == "write":
-            clear()
-            print("Saving changes...")
-            ctx.write_to_file(DB_FILE)
-            continue
-        elif choice == "export":
-            clear()
-            print(f"Exporting words to file {WORDS_FILE}...")
-            export_words(ctx)
-            continue
-        elif choice == "import":
-            clear()
-            print(f"Importing words from {WORDS_FILE}...")
-            import_words(ctx)
-            continue
-        else:
-            print(f"Error: invalid action {choice}")
-            continue
+        # the server may have changed words while waiting for input
+        ctx.catch_up()
+        with stats.profile(choice):
+            if choice == 'a' or choice == "add":
+                add_words(ctx)
+            elif choice == 'l' or choice == "list":
+                edit_word_lists(ctx)
+            elif choice == 'e' or choice == "edit":
+                edit_words(ctx)
+            elif choice == 'r' or choice == "review":
+                review_words(ctx)
+            elif choice == 'd' or choice == "due":
+                review_due(ctx)
+            elif choice == "exit":
+                break
+            elif choice == "abort":
+                abort = True
+                break
+            elif choice == "write":
+                clear()
+                print("Saving changes...")
+                ctx.write_to_file(DB_FILE)
+                continue
+            elif choice == "compact":
+                clear()
+                # the other processes would still use the old indexes
+                if ctx.journal is not None and not ctx.journal.alone():
+                    print("Error: the database is used by another process")
+                    continue
+                print("Renumbering words and saving changes...")
+                ctx.compact()
+                ctx.write_to_file(DB_FILE, full=True)
+                continue
+            elif choice == "export":
+                clear()
+                print(f"Exporting words to file {WORDS_FILE}...")
+                export_words(ctx)
+                continue
+            elif choice == "import":
+                clear()
+                print(f"Importing words from {WORDS_FILE}...")
+                import_words(ctx)
+                continue
+            elif choice == "stats":
+                clear()
+                stats.display()
+                continue
+            else:
+                print(f"Error: invalid action {choice}")
+                continue
         clear()
     if not abort:
         ctx.write_to_file(DB_FILE)
-    
+    ctx.close(not abort)
+    close_cache()
+    close_dictionary()
+
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
 from collections import UserList
+from itertools import compress
 
 class HoleList(UserList):
     def __init__(self, data=[]):
@@ -28,6 +29,23 @@ class HoleList(UserList):
                     yield element
         return iterator()
 
+    def next_index(self):
+        return self.free[-1] if self.free else len(self.data)
+
+    # stores element at index i, which has to be a hole or past the end
+    def put(self, i, element):
+        if i == self.next_index():
+            self.add(element)
+            return
+        while len(self.data) < i:
+            self.free.append(len(self.data))
+            self.data.append(None)
+        if i == len(self.data):
+            self.data.append(element)
+        else:
+            self.free.remove(i)
+            self.data[i] = element
+
     def add(self, element):
         if self.free:
             i = self.free.pop()
@@ -37,6 +55,115 @@ class HoleList(UserList):
             self.data.append(element)
         return i
 
+# same index semantics as HoleList, but which slots are taken is kept in a
+# bytearray with one byte per slot, so an element that is falsy is not a hole;
+# free slots are kept in a stack and the last freed one is reused first like
+# in HoleList, not the lowest one: that would need a heap and make add and
+# delete O(log n); a hole that is filled by put() stays in the stack and is
+# skipped later, so every operation is O(1) (amortized); deleting the last
+# element doesn't rebuild anything, HoleList rebuilds its free list
+class HoleArray:
+    def __init__(self, data=(), used=None):
+        self.data = list(data)
+        self.used = used if used is not None else bytearray([1]) * len(self.data)
+        self.free = [i for i in range(len(self.data) - 1, -1, -1) if not self.used[i]]
+        self.holes = len(self.free)
+
+    def __len__(self):
+        return len(self.data) - self.holes
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __setitem__(self, i, element):
+        if not self.used[i]:
+            raise IndexError(f"{i} is a hole")
+        self.data[i] = element
+
+    def __delitem__(self, i):
+        if not self.used[i]:
+            raise IndexError(f"{i} is a hole")
+        self.data[i] = None
+        self.used[i] = 0
+        self.free.append(i)
+        self.holes += 1
+
+    def __iter__(self):
+        return compress(self.data, self.used)
+
+    def __contains__(self, element):
+        return element in iter(self)
+
+    def indexes(self):
+        return compress(range(len(self.data)), self.used)
+
+    # (idx, element) for every element
+    def items(self):
+        return compress(enumerate(self.data), self.used)
+
+    # whether there is an element at index i
+    def occupied(self, i):
+        return 0 <= i < len(self.used) and bool(self.used[i])
+
+    def index(self, element):
+        for i, x in self.items():
+            if x == element:
+                return i
+        raise ValueError(f"{element} is not in list")
+
+    # drops the slots on top of the stack that have been filled by put()
+    def skip_filled(self):
+        while self.free and self.used[self.free[-1]]:
+            self.free.pop()
+
+    def next_index(self):
+        self.skip_filled()
+        return self.free[-1] if self.free else len(self.data)
+
+    # stores element at index i, which has to be a hole or past the end
+    def put(self, i, element):
+        while len(self.data) < i:
+            self.free.append(len(self.data))
+            self.holes += 1
+            self.data.append(None)
+            self.used.append(0)
+        if i == len(self.data):
+            self.data.append(element)
+            self.used.append(1)
+            return
+        if self.used[i]:
+            raise IndexError(f"{i} is not a hole")
+        self.data[i] = element
+        self.used[i] = 1
+        self.holes -= 1
+        # the filled slots are dropped from the stack once they make up most of it
+        if len(self.free) > 2 * self.holes + 64:
+            self.free = list(dict.fromkeys(i for i in self.free if not self.used[i]))
+
+    def add(self, element):
+        self.skip_filled()
+        if self.free:
+            i = self.free.pop()
+            self.data[i] = element
+            self.used[i] = 1
+            self.holes -= 1
+            return i
+        self.data.append(element)
+        self.used.append(1)
+        return len(self.data) - 1
+
+    # closes all holes while keeping the order of the elements, returns a list
+    # that maps every old index to its new one (-1 for holes)
+    def compact(self):
+        remap = [-1] * len(self.data)
+        for new, old in enumerate(self.indexes()):
+            remap[old] = new
+        self.data = list(self)
+        self.used = bytearray([1]) * len(self.data)
+        self.free = []
+        self.holes = 0
+        return remap
+
 if __name__ == "__main__":
     x = HoleList([1,2,3,4,5,6])
     del x[1]
@@ -54,3 +181,48 @@ if __name__ == "__main__":
     del x[1]
     print(x.data, x.free)
     x.add(1)
+
+    # 1M adds and deletes on a list that holds about 100k elements, either at
+    # random positions or mostly at the end
+    import random
+    import time
+    def benchmark(cls, tail):
+        rng = random.Random(0)
+        x = cls()
+        live = []
+        t = time.perf_counter()
+        for i in range(100000):
+            live.append(x.add(i))
+        for _ in range(1000000):
+            if live and rng.random() < 0.5:
+                j = len(live) - 1 if tail and rng.random() < 0.9 else rng.randrange(len(live))
+                live[j], live[-1] = live[-1], live[j]
+                del x[live.pop()]
+            else:
+                live.append(x.add(1))
+        ops = time.perf_counter() - t
+        t = time.perf_counter()
+        for _ in range(10):
+            for element in x:
+                pass
+        return ops, (time.perf_counter() - t) / 10
+    for tail in (False, True):
+        for cls in (HoleList, HoleArray):
+            ops, it = benchmark(cls, tail)
+            pattern = "tail" if tail else "random"
+            print(f"{cls.__name__} ({pattern}): 1M add/delete {ops:.2f}s, iteration {it*1000:.1f}ms")
+
+    # a word is added and deleted again behind 50k holes, every delete of the
+    # last element makes HoleList rebuild its free list
+    def tail_delete(cls, holes=50000, n=2000):
+        x = cls(list(range(1, 2 * holes + 1)))
+        for i in range(0, 2 * holes, 2):
+            del x[i]
+        t = time.perf_counter()
+        for _ in range(n):
+            i = len(x.data)
+            x.put(i, 1)
+            del x[i]
+        return time.perf_counter() - t
+    for cls in (HoleList, HoleArray):
+        print(f"{cls.__name__} (tail delete behind 50k holes): 2000 put/delete {tail_delete(cls):.3f}s")
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import shelve
+import threading
+import time
+import zlib
+import stats
+
+# status used when a page is missing from the cache in offline mode
+OFFLINE_MISS = 504
+
+class CachedResponse:
+    def __init__(self, status_code, text, cached=False):
+        self.status_code = status_code
+        self.text = text
+        self.cached = cached
+
+# entries are stored as url -> (digest, status, expires, last_used) in a shelve
+# index, the bodies are stored once per distinct content under objects/<digest>;
+# misses are fetched with client (an httpclient.HttpClient)
+class ResponseCache:
+    def __init__(self, path, max_size, ttl, negative_ttl, client, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.client = client
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.objects = os.path.join(path, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        self.index = shelve.open(os.path.join(path, "index"))
+        self.refs = {}
+        for entry in self.index.values():
+            digest = entry[0]
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+        self.size = 0
+        for f in os.scandir(self.objects):
+            if f.name not in self.refs:
+                os.remove(f.path)
+                continue
+            self.size += f.stat().st_size
+
+    def close(self):
+        with self.lock:
+            self.index.close()
+        self.client.close()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            digest, status, expires, _ = entry
+            if not self.offline and expires < time.time():
+                return None
+            try:
+                with open(self.object_path(digest), "rb") as f:
+                    text = zlib.decompress(f.read()).decode()
+            except OSError:
+                self.drop(url)
+                return None
+            self.index[url] = (digest, status, expires, time.time())
+            return CachedResponse(status, text, cached=True)
+
+    def store(self, url, status, text, negative):
+        ttl = self.negative_ttl if negative else self.ttl
+        body = text.encode()
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self.lock:
+            if url in self.index:
+                self.drop(url)
+            if digest not in self.refs:
+                data = zlib.compress(body)
+                with open(self.object_path(digest), "wb") as f:
+                    f.write(data)
+                self.size += len(data)
+                self.refs[digest] = 0
+            self.refs[digest] += 1
+            self.index[url] = (digest, status, now + ttl, now)
+            if self.size > self.max_size:
+                self.evict()
+
+    # must be called with lock held
+    def drop(self, url):
+        digest = self.index.pop(url)[0]
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return
+        del self.refs[digest]
+        path = self.object_path(digest)
+        try:
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+
+    # must be called with lock held, evicts least recently used entries
+    # until the cache is 10% below its size cap
+    def evict(self):
+        target = self.max_size * 9 // 10
+        entries = sorted(self.index.items(), key=lambda e: e[1][3])
+        for url, _ in entries:
+            if self.size <= target:
+                break
+            self.drop(url)
+
+    # negative(text) decides whether a successful page is a "no matches" page
+    def get(self, url, negative=None):
+        response = self.lookup(url)
+        stats.cache("http cache", response is not None)
+        if response:
+            return response
+        if self.offline:
+            return CachedResponse(OFFLINE_MISS, "")
+        status, text = self.client.get(url)
+        if status == 200:
+            self.store(url, status, text, negative is not None and negative(text))
+        elif status == 404:
+            self.store(url, status, text, True)
+        return CachedResponse(status, text)
@@ -0,0 +1,118 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import stats
+
+# status of a request that got no response at all, not even after the retries
+UNREACHABLE = 599
+# statuses that are worth another try, everything else is returned as it is
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# allows rate requests per second on average and up to burst of them at once
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # blocks until a request may be made
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        # the token is already taken, the requests behind this one wait longer
+        if wait:
+            time.sleep(wait)
+
+# one keep-alive session shared by all worker threads, pool_size connections
+# are kept open; a request that times out, can't connect or gets a status in
+# RETRY_STATUS is tried again up to retries times, waiting backoff, 2 * backoff,
+# ... (with some jitter) in between; every request is passed to the hooks as
+# hook(url, status, seconds, attempt)
+class HttpClient:
+    def __init__(self, rate, burst, retries, backoff, timeout, pool_size):
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.hooks = []
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def close(self):
+        self.session.close()
+
+    def request(self, url, attempt):
+        self.bucket.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            status, text = response.status_code, response.text
+        except (requests.ConnectionError, requests.Timeout):
+            status, text = UNREACHABLE, ""
+        seconds = time.perf_counter() - start
+        if stats.ENABLED:
+            stats.record("http request", seconds)
+        for hook in self.hooks:
+            hook(url, status, seconds, attempt)
+        return status, text
+
+    # (status, text) of the page at url
+    def get(self, url):
+        for attempt in range(self.retries + 1):
+            status, text = self.request(url, attempt)
+            if status != UNREACHABLE and status not in RETRY_STATUS:
+                break
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(1, 1.5))
+        return status, text
+
+if __name__ == "__main__":
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    # a stand-in for jisho.org: /flaky fails twice before it works, /down
+    # always fails, the port of every connection is counted
+    ports = set()
+    hits = {}
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_GET(self):
+            ports.add(self.client_address[1])
+            hits[self.path] = hits.get(self.path, 0) + 1
+            status = 200
+            if self.path == "/down" or (self.path == "/flaky" and hits[self.path] <= 2):
+                status = 503
+            body = f"page {self.path}".encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    client = HttpClient(rate=50, burst=5, retries=2, backoff=0.01, timeout=5, pool_size=4)
+    log = []
+    client.hooks.append(lambda url, status, seconds, attempt: log.append((status, attempt)))
+    print(client.get(base + "/flaky"), "== (200, 'page /flaky')")
+    print(log, "== [(503, 0), (503, 1), (200, 2)]")
+    print(client.get(base + "/down")[0], hits["/down"], "== 503 3")
+    start = time.monotonic()
+    for i in range(30):
+        client.get(base + f"/page{i}")
+    # after the burst of 5 the other requests come at 50 per second
+    print(time.monotonic() - start >= 0.5, len(ports), "== True 1")
+    client.close()
+    server.shutdown()
+    server.server_close()
+    print(HttpClient(50, 5, 1, 0.01, 5, 4).get(base + "/gone")[0], "== 599")
@@ -0,0 +1,199 @@
+import os
+import pickle
+import struct
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LENGTH = struct.Struct("<I")
+
+# append-only log of pickled records that all processes working on the same
+# database share, a ("base", base) record names the snapshot the records after
+# it have to be replayed over; records are only appended inside of batch(),
+# which holds an exclusive lock on the file, and after the records that other
+# processes have appended have been read with updates(); every append is
+# fsync'd unless it happens inside of batch()
+class Journal:
+    def __init__(self, path, base):
+        self.path = path
+        self.f = open(path, "a+b")
+        # every process holds a shared lock on this file for as long as it
+        # uses the journal, so a process can tell whether it is alone
+        self.users = open(path + ".lock", "a+b")
+        lock(self.users, "shared")
+        self.depth = 0
+        self.dirty = False
+        self.n = 0
+        self.base = base
+        # offset after the current base record and offset up to which the
+        # records have been read
+        self.start = 0
+        self.pos = 0
+        self.committed = 0
+        self.n_committed = 0
+        # whether this and other processes appended records since the last commit
+        self.own = False
+        self.foreign = False
+        with self.batch():
+            self.f.seek(0, os.SEEK_END)
+            if self.f.tell() == 0:
+                self.reset(base)
+
+    def close(self):
+        self.f.close()
+        self.users.close()
+
+    def __len__(self):
+        return self.n
+
+    # (record, offset after it) from offset on, stops at a torn record at the
+    # end (crash in the middle of an append) and cuts it off
+    def scan(self, offset, end=None):
+        self.f.seek(offset)
+        while end is None or offset < end:
+            header = self.f.read(LENGTH.size)
+            if len(header) < LENGTH.size:
+                break
+            data = self.f.read(LENGTH.unpack(header)[0])
+            try:
+                record = pickle.loads(data)
+            except Exception:
+                break
+            offset = self.f.tell()
+            yield record, offset
+        if end is None:
+            self.f.truncate(offset)
+
+    # returns the records after the last base record, returns None if the
+    # journal does not belong to base
+    def read(self, base):
+        with self.batch():
+            records = None
+            self.pos = 0
+            for record, offset in self.scan(0):
+                if record[0] == "base":
+                    records = [] if record[1] == base else None
+                    self.start = offset
+                elif records is not None:
+                    records.append(record)
+                self.pos = offset
+            if records is None:
+                return None
+            self.base = base
+            self.n = len(records)
+            self.commit()
+            return records
+
+    # the records since the current base, must be called inside of batch()
+    def records(self):
+        return [record for record, _ in self.scan(self.start, self.pos) if record[0] != "base"]
+
+    # whether other processes have appended records that updates() would return
+    def behind(self):
+        return os.fstat(self.f.fileno()).st_size != self.pos
+
+    # the records that other processes have appended since the last call, must
+    # be called inside of batch(); a base record means that another process
+    # has saved everything before it
+    def updates(self):
+        if not self.behind():
+            return []
+        records = []
+        for record, offset in self.scan(self.pos):
+            if record[0] == "base":
+                self.base = record[1]
+                self.start = self.committed = offset
+                self.n = self.n_committed = 0
+                self.own = self.foreign = False
+            else:
+                records.append(record)
+                self.n += 1
+                self.foreign = True
+            self.pos = offset
+        return records
+
+    def write(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(LENGTH.pack(len(data)) + data)
+        self.pos = self.f.tell()
+        self.dirty = True
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.dirty = False
+
+    def append(self, record):
+        with self.batch():
+            self.write(record)
+            self.n += 1
+            self.own = True
+
+    @contextmanager
+    def batch(self):
+        if not self.depth:
+            lock(self.f, "exclusive")
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                if self.dirty:
+                    self.sync()
+                lock(self.f, "unlock")
+
+    # whether no other process uses the journal
+    def alone(self):
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self.users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+        finally:
+            # converting the lock can drop it, so it is taken again either way
+            lock(self.users, "shared")
+
+    # everything that has been appended so far survives rollback()
+    def commit(self):
+        self.sync()
+        self.committed = self.pos
+        self.n_committed = self.n
+        self.own = self.foreign = False
+
+    # throws away the records since the last commit, unless other processes
+    # have appended records after them; returns whether it did
+    def rollback(self):
+        with self.batch():
+            self.updates()
+            if not self.own:
+                return True
+            if self.foreign:
+                return False
+            self.f.truncate(self.committed)
+            self.pos = self.committed
+            self.n = self.n_committed
+            self.own = False
+            self.sync()
+            return True
+
+    # starts over after a new snapshot has been written, the records of the
+    # other processes are only kept while they use the journal
+    def reset(self, base):
+        with self.batch():
+            if self.alone():
+                self.f.truncate(0)
+            self.base = base
+            self.n = 0
+            self.write(("base", base))
+            self.start = self.pos
+            self.commit()
+
+def lock(f, mode):
+    if fcntl is not None:
+        fcntl.flock(f, {"shared": fcntl.LOCK_SH, "exclusive": fcntl.LOCK_EX, "unlock": fcntl.LOCK_UN}[mode])
@@ -0,0 +1,150 @@
+import weakref
+import threading
+from collections import OrderedDict, UserList
+from holelist import HoleArray
+import stats
+
+# placeholder for an element that exists but has not been loaded yet
+UNLOADED = object()
+
+# keeps at most size unchanged elements of data loaded, the least recently used
+# ones are set back to UNLOADED; changed elements stay loaded until saved() and
+# elements that are still referenced somewhere else are handed out again
+# instead of loading a second copy; readers in several threads (server.py)
+# may share a cache, so changing the bookkeeping is serialized
+class ObjectCache:
+    def __init__(self, data, load, size):
+        self.data = data
+        self.load = load
+        self.size = size
+        self.lru = OrderedDict()
+        self.dirty = set()
+        self.alive = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def get(self, i):
+        with self.lock:
+            x = self.data[i]
+            if x is UNLOADED:
+                x = self.alive.get(i)
+                stats.cache("object cache", x is not None)
+                if x is None:
+                    with stats.timer("load object"):
+                        x = self.load(i)
+                    self.alive[i] = x
+            else:
+                stats.cache("object cache", True)
+                self.data[i] = x
+            if x is not None and i not in self.dirty:
+                self.lru[i] = None
+                self.lru.move_to_end(i)
+                self.evict()
+            return x
+
+    def set(self, i, x):
+        with self.lock:
+            self.data[i] = x
+            self.lru.pop(i, None)
+            self.dirty.add(i)
+            self.alive[i] = x
+
+    def drop(self, i):
+        with self.lock:
+            self.lru.pop(i, None)
+            self.dirty.discard(i)
+            self.alive.pop(i, None)
+
+    def evict(self):
+        while len(self.lru) > self.size:
+            i, _ = self.lru.popitem(last=False)
+            self.data[i] = UNLOADED
+
+    # the changed elements have been written and may be unloaded again
+    def saved(self):
+        with self.lock:
+            for i in sorted(self.dirty):
+                self.lru[i] = None
+            self.dirty.clear()
+            self.evict()
+
+# HoleArray whose elements are loaded on access, data holds UNLOADED for every
+# element that exists and None for every hole
+class LazyHoleArray(HoleArray):
+    def __init__(self, data, load, size):
+        super().__init__(data, bytearray(x is not None for x in data))
+        self.load = load
+        self.size = size
+        self.cache = ObjectCache(self.data, load, size)
+
+    def __getitem__(self, i):
+        return self.cache.get(i)
+
+    def __setitem__(self, i, element):
+        if not self.used[i]:
+            raise IndexError(f"{i} is a hole")
+        self.cache.set(i, element)
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.cache.drop(i)
+
+    def __iter__(self):
+        def iterator():
+            for i in self.indexes():
+                yield self[i]
+        return iterator()
+
+    def items(self):
+        def iterator():
+            for i in self.indexes():
+                yield i, self[i]
+        return iterator()
+
+    def put(self, i, element):
+        super().put(i, element)
+        self.cache.set(i, element)
+
+    def add(self, element):
+        i = super().add(element)
+        self.cache.set(i, element)
+        return i
+
+    # every element is loaded and stays loaded until the renumbered
+    # elements have been saved
+    def compact(self):
+        for i in self.indexes():
+            self.cache.set(i, self.cache.get(i))
+        remap = super().compact()
+        self.cache = ObjectCache(self.data, self.load, self.size)
+        for i in range(len(self.data)):
+            self.cache.set(i, self.data[i])
+        return remap
+
+    def saved(self):
+        self.cache.saved()
+
+# list whose elements are loaded on access, elements are never removed
+class LazyList(UserList):
+    def __init__(self, data, load, size):
+        super().__init__(data)
+        self.cache = ObjectCache(self.data, load, size)
+
+    def __getitem__(self, i):
+        return self.cache.get(i)
+
+    def __setitem__(self, i, element):
+        self.cache.set(i, element)
+
+    def __iter__(self):
+        def iterator():
+            for i in range(len(self.data)):
+                yield self[i]
+        return iterator()
+
+    def append(self, element):
+        self.data.append(element)
+        if element is not None:
+            self.cache.set(len(self.data) - 1, element)
+
+    def saved(self):
+        self.cache.saved()
@@ -0,0 +1,360 @@
+import re
+import sys
+import gzip
+import json
+import sqlite3
+import threading
+import unicodedata
+import xml.etree.ElementTree as ET
+import script
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS words (
+    text TEXT PRIMARY KEY,
+    reading TEXT NOT NULL,
+    meanings TEXT NOT NULL,
+    common INTEGER NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS single (
+    char TEXT NOT NULL,
+    text TEXT NOT NULL,
+    common INTEGER NOT NULL,
+    PRIMARY KEY (char, text)
+);
+CREATE TABLE IF NOT EXISTS kanji (
+    char TEXT PRIMARY KEY,
+    meanings TEXT NOT NULL,
+    grade INTEGER,
+    jlpt INTEGER,
+    radical TEXT,
+    readings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    char TEXT PRIMARY KEY,
+    parts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS components (
+    char TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS jlpt (
+    text TEXT PRIMARY KEY,
+    level INTEGER NOT NULL
+);
+"""
+
+# priorities that jisho.org shows as "common word"
+COMMON = {"news1", "ichi1", "spec1", "spec2", "gai1"}
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+USUALLY_KANA = "word usually written using kana alone"
+# the old jlpt levels of KANJIDIC (4 easiest) as the current ones (5 easiest)
+OLD_JLPT = {1: 1, 2: 2, 3: 4, 4: 5}
+BATCH = 5000
+
+TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+VOICED = dict(zip("かきくけこさしすせそたちつてとはひふへほ", "がぎぐげござじずぜぞだぢづでどばびぶべぼ"))
+VOICED.update(zip("はひふへほ", "ぱぴぷぺぽ"))
+GEMINATED = set("つくちき")
+
+def to_hiragana(s):
+    return s.translate(TO_HIRAGANA)
+
+def open_source(path):
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if gzipped else open(path, "rb")
+
+# the elements called tag one after another, each one is dropped together with
+# everything before it once it has been handled, so memory stays constant
+def elements(f, tag):
+    root = None
+    for event, elem in ET.iterparse(f, events=("start", "end")):
+        if root is None:
+            root = elem
+        elif event == "end" and elem.tag == tag:
+            yield elem
+            root.clear()
+
+def progress(what, n):
+    print(f"\r{what}: {n}", end="", flush=True)
+
+# the reading of a word split over its kanji, one reading per kanji char, the
+# kana of the word have to show up in the reading as they are; readings(char)
+# gives the readings of a kanji, None if the reading can't be split
+def align(text, reading, readings):
+    runs = script.split_kana(text)
+    pattern = "".join("(.+?)" if i % 2 == 0 and run else re.escape(to_hiragana(run))
+            for i, run in enumerate(runs))
+    m = re.fullmatch(pattern, to_hiragana(reading))
+    if not m:
+        return None
+    furigana = []
+    for run, run_reading in zip((run for i, run in enumerate(runs) if i % 2 == 0 and run), m.groups()):
+        if len(run) == 1:
+            furigana.append(run_reading)
+            continue
+        split = split_run(run, run_reading, readings)
+        if split is None:
+            return None
+        furigana += split
+    return furigana
+
+# spellings of a reading inside a word: as it is, voiced at the start and with
+# a small tsu at the end
+def variants(reading):
+    result = {reading}
+    if reading[0] in VOICED:
+        result.add(VOICED[reading[0]] + reading[1:])
+    if len(reading) > 1 and reading[-1] in GEMINATED:
+        result.update(r[:-1] + "っ" for r in list(result))
+    return result
+
+# one kanji of the run may have a reading that the dictionary does not list
+# (like に in 日本), it gets whatever the others leave over
+def split_run(run, reading, readings, guesses=1):
+    if not run:
+        return [] if not reading else None
+    for r in sorted(set().union(*map(variants, filter(None, readings(run[0])))), key=len, reverse=True):
+        if reading.startswith(r):
+            rest = split_run(run[1:], reading[len(r):], readings, guesses)
+            if rest is not None:
+                return [r] + rest
+    if guesses:
+        for end in range(1, len(reading) - len(run) + 2):
+            rest = split_run(run[1:], reading[end:], readings, guesses - 1)
+            if rest is not None:
+                return [reading[:end]] + rest
+    return None
+
+# answers the questions that jisho.org answers from an sqlite file built by
+# importing JMdict, KANJIDIC2 and KRADFILE; results have the format of the
+# parsed pages of extract.py so that they take the same way through flashcard
+class LocalDictionary:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.readings_cache = {}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def readings(self, char):
+        readings = self.readings_cache.get(char)
+        if readings is None:
+            row = self.db.execute("SELECT readings FROM kanji WHERE char = ?", (char,)).fetchone()
+            readings = self.readings_cache[char] = json.loads(row[0]) if row else []
+        return readings
+
+    # (known, result): result is the first word that accept() takes, where a
+    # single char is looked up like a search for the words with only that
+    # kanji; known says whether the dictionary knows word or the kanji at all
+    def search(self, word, accept):
+        with self.lock:
+            rows = self.db.execute("SELECT text, reading, meanings FROM words WHERE text = ?", (word,)).fetchall()
+            known = bool(rows)
+            if len(word) == 1:
+                rows += self.db.execute("""
+                    SELECT w.text, w.reading, w.meanings FROM single s JOIN words w ON w.text = s.text
+                    WHERE s.char = ? AND s.text != ? ORDER BY s.common DESC, length(s.text), w.seq
+                    """, (word, word)).fetchall()
+                known = known or bool(rows) or self.db.execute(
+                        "SELECT 1 FROM kanji WHERE char = ?", (word,)).fetchone() is not None
+            for text, reading, meanings in rows:
+                if accept(text):
+                    return True, self.result(text, reading, json.loads(meanings))
+        return known, None
+
+    # must be called with lock held
+    def result(self, text, reading, meanings):
+        furigana = []
+        rt = None
+        if script.kanji_chars(text):
+            furigana = align(text, reading, self.readings)
+            if furigana is None:
+                furigana = []
+                rt = reading
+        level = self.db.execute("SELECT level FROM jlpt WHERE text = ?", (text,)).fetchone()
+        return {
+            "text": text,
+            "furigana": furigana,
+            "rt": rt,
+            "meanings": meanings,
+            "level": f"JLPT N{level[0]}" if level else None,
+        }
+
+    # the kanji page of char, None if the dictionary does not know char and
+    # {} if it only knows it as a part of other kanji
+    def kanji(self, char):
+        with self.lock:
+            row = self.db.execute("SELECT meanings, grade, jlpt, radical FROM kanji WHERE char = ?",
+                    (char,)).fetchone()
+            if row is None:
+                known = self.db.execute("SELECT 1 FROM components WHERE char = ?", (char,)).fetchone()
+                return {} if known else None
+            meanings, grade, jlpt, radical = row
+            radical = radical or char
+            parts = self.db.execute("SELECT parts FROM parts WHERE char = ?", (char,)).fetchone()
+            parts = list(parts[0]) if parts else [char]
+            radical_meanings = self.db.execute("SELECT meanings FROM kanji WHERE char = ?",
+                    (radical,)).fetchone()
+        if grade is not None and grade <= 6:
+            grade = f"Jōyō kanji, taught in grade {grade}"
+        elif grade == 8:
+            grade = "Jōyō kanji, taught in junior high"
+        elif grade is not None:
+            grade = "Jinmeiyō kanji, used in names"
+        radical_meaning = ", ".join(json.loads(radical_meanings[0])) if radical_meanings else ""
+        return {
+            "meanings": ", ".join(json.loads(meanings)),
+            "grade": grade,
+            "jlpt": f"JLPT level N{jlpt}" if jlpt else None,
+            "radicals": [f"Radical:{radical_meaning} {radical}", "Parts:" + "".join(parts)],
+            "parts": parts,
+        }
+
+    def import_jmdict(self, f):
+        words = []
+        singles = []
+        def flush():
+            self.db.executemany("""
+                INSERT INTO words VALUES (?, ?, ?, ?, ?) ON CONFLICT (text) DO UPDATE SET
+                reading = excluded.reading, meanings = excluded.meanings, common = excluded.common,
+                seq = excluded.seq WHERE excluded.common > words.common
+                """, words)
+            self.db.executemany("INSERT OR REPLACE INTO single VALUES (?, ?, ?)", singles)
+            words.clear()
+            singles.clear()
+        n = 0
+        for entry in elements(f, "entry"):
+            seq = int(entry.findtext("ent_seq"))
+            kebs = [(k.findtext("keb"), any(p.text in COMMON for p in k.iter("ke_pri")))
+                    for k in entry.iter("k_ele")]
+            rebs = [(r.findtext("reb"), r.find("re_nokanji") is not None,
+                    [x.text for x in r.iter("re_restr")], any(p.text in COMMON for p in r.iter("re_pri")))
+                    for r in entry.iter("r_ele")]
+            senses = []
+            usually_kana = False
+            for sense in entry.iter("sense"):
+                glosses = [g.text for g in sense.iter("gloss") if g.text and g.get(XML_LANG, "eng") == "eng"]
+                if glosses:
+                    senses.append(([s.text for s in sense.iter("stagk")], "; ".join(glosses)))
+                usually_kana = usually_kana or any(m.text == USUALLY_KANA for m in sense.iter("misc"))
+            if not senses or not rebs:
+                continue
+            for keb, common in kebs:
+                reading = next((reb for reb, nokanji, restr, _ in rebs
+                        if not nokanji and (not restr or keb in restr)), rebs[0][0])
+                meanings = [gloss for stagk, gloss in senses if not stagk or keb in stagk]
+                words.append((keb, reading, json.dumps(meanings, ensure_ascii=False), int(common), seq))
+                chars = script.kanji_chars(keb)
+                if len(chars) == 1:
+                    singles.append((chars[0], keb, int(common)))
+            if not kebs or usually_kana:
+                meanings = json.dumps([gloss for _, gloss in senses], ensure_ascii=False)
+                for reb, _, _, common in rebs:
+                    words.append((reb, reb, meanings, int(common), seq))
+            n += 1
+            if len(words) >= BATCH:
+                flush()
+                progress("Importing JMdict entries", n)
+        flush()
+        self.db.commit()
+        progress("Importing JMdict entries", n)
+        print()
+
+    def import_kanjidic(self, f):
+        rows = []
+        n = 0
+        for character in elements(f, "character"):
+            char = character.findtext("literal")
+            meanings = [m.text for m in character.iter("meaning") if m.get("m_lang") is None]
+            readings = set()
+            for r in character.iter("reading"):
+                if r.get("r_type") == "ja_on":
+                    readings.add(to_hiragana(r.text))
+                elif r.get("r_type") == "ja_kun":
+                    kun = r.text.strip("-")
+                    readings.add(kun.replace(".", ""))
+                    readings.add(kun.split(".")[0])
+            radical = None
+            for rad in character.iter("rad_value"):
+                if rad.get("rad_type") == "classical":
+                    # the kangxi radicals block normalizes to the kanji themselves
+                    radical = unicodedata.normalize("NFKC", chr(0x2F00 + int(rad.text) - 1))
+            grade = character.findtext("misc/grade")
+            jlpt = character.findtext("misc/jlpt")
+            rows.append((char, json.dumps(meanings, ensure_ascii=False), int(grade) if grade else None,
+                    OLD_JLPT.get(int(jlpt)) if jlpt else None, radical,
+                    json.dumps(sorted(readings), ensure_ascii=False)))
+            n += 1
+            if len(rows) >= BATCH:
+                self.db.executemany("INSERT OR REPLACE INTO kanji VALUES (?, ?, ?, ?, ?, ?)", rows)
+                rows.clear()
+                progress("Importing KANJIDIC characters", n)
+        self.db.executemany("INSERT OR REPLACE INTO kanji VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+        self.readings_cache.clear()
+        progress("Importing KANJIDIC characters", n)
+        print()
+
+    # lines "kanji : part part ...", the original file is EUC-JP
+    def import_kradfile(self, f):
+        rows = []
+        components = set()
+        for line in f:
+            try:
+                line = line.decode("utf-8")
+            except UnicodeDecodeError:
+                line = line.decode("euc_jis_2004")
+            if line.startswith("#") or " : " not in line:
+                continue
+            char, parts = line.split(" : ", 1)
+            parts = "".join(parts.split())
+            rows.append((char.strip(), parts))
+            components.update(parts)
+        self.db.executemany("INSERT OR REPLACE INTO parts VALUES (?, ?)", rows)
+        self.db.executemany("INSERT OR IGNORE INTO components VALUES (?)", ((c,) for c in components))
+        self.db.commit()
+        print(f"Imported the parts of {len(rows)} kanji")
+
+    # lines "word level" where level is 1-5 or N1-N5, JMdict has no levels
+    def import_jlpt(self, f):
+        rows = []
+        for line in f:
+            fields = line.decode("utf-8").split()
+            if len(fields) == 2 and fields[1].upper().lstrip("N") in ("1", "2", "3", "4", "5"):
+                rows.append((fields[0], int(fields[1].upper().lstrip("N"))))
+        self.db.executemany("INSERT OR REPLACE INTO jlpt VALUES (?, ?)", rows)
+        self.db.commit()
+        print(f"Imported the jlpt levels of {len(rows)} words")
+
+    # the kind of file is told from its start: JMdict and KANJIDIC2 (also
+    # gzipped) by their doctype, KRADFILE by its "kanji : parts" lines,
+    # anything else is a list of jlpt levels
+    def import_file(self, path):
+        with open_source(path) as f:
+            head = f.read(4096)
+        with open_source(path) as f:
+            if b"<JMdict" in head:
+                self.import_jmdict(f)
+            elif b"<kanjidic2" in head:
+                self.import_kanjidic(f)
+            elif b" : " in head:
+                self.import_kradfile(f)
+            else:
+                self.import_jlpt(f)
+
+if __name__ == "__main__":
+    # python3 localdict.py JMdict_e.gz kanjidic2.xml.gz kradfile [jlpt.txt]
+    import flashcard
+    if len(sys.argv) < 2:
+        print("Error: no dictionary files given")
+        sys.exit(1)
+    dictionary = LocalDictionary(flashcard.DICTIONARY)
+    dictionary.db.execute("PRAGMA synchronous=OFF")
+    for path in sys.argv[1:]:
+        print(f"Importing {path} into {flashcard.DICTIONARY}...")
+        dictionary.import_file(path)
+    dictionary.close()
@@ -0,0 +1,136 @@
+import threading
+from html import escape
+from collections import OrderedDict
+import stats
+
+# the back of a card: upper and lower are the furigana and word lines, kanji
+# and parts are (char, is_radical, meanings), categories is a string and
+# word_lists are names; text and html are built once together with it and
+# k_idxs are the kanji it shows, so that it can be dropped when one changes
+class CardBack:
+    __slots__ = ("upper", "lower", "meanings", "kanji", "parts", "categories",
+            "word_lists", "k_idxs", "text", "html")
+
+    def __init__(self, upper, lower, meanings, kanji, parts, categories, word_lists, k_idxs):
+        self.upper = upper
+        self.lower = lower
+        self.meanings = meanings
+        self.kanji = kanji
+        self.parts = parts
+        self.categories = categories
+        self.word_lists = word_lists
+        self.k_idxs = k_idxs
+        self.text = "\n".join(self.lines())
+        self.html = self.to_html()
+
+    def kanji_line(kanji):
+        char, is_radical, meanings = kanji
+        return f"{char}{' (radical)' if is_radical else ''}: {', '.join(meanings)}"
+
+    def lines(self):
+        lines = []
+        if self.upper and not self.upper.isspace():
+            lines.append(self.upper)
+        lines.append(self.lower)
+        lines.append("Meaning:")
+        lines += [f"• {meaning}" for meaning in self.meanings]
+        if self.kanji:
+            lines.append("Kanji:")
+            lines += map(CardBack.kanji_line, self.kanji)
+        if self.parts:
+            lines.append("Parts:")
+            lines += map(CardBack.kanji_line, self.parts)
+        if self.categories is not None:
+            lines.append("Categories: " + self.categories)
+        if self.word_lists:
+            lines.append("Word lists: " + ", ".join(self.word_lists))
+        return lines
+
+    def to_html(self):
+        def section(title, items):
+            lis = "".join(f"<li>{escape(item)}</li>" for item in items)
+            return f"<p>{title}:</p><ul>{lis}</ul>"
+        word = escape(self.lower)
+        if self.upper and not self.upper.isspace():
+            word = escape(self.upper) + "\n" + word
+        html = [f'<p style="white-space:pre;">{word}</p>', section("Meaning", self.meanings)]
+        if self.kanji:
+            html.append(section("Kanji", map(CardBack.kanji_line, self.kanji)))
+        if self.parts:
+            html.append(section("Parts", map(CardBack.kanji_line, self.parts)))
+        if self.categories is not None:
+            html.append(f"<p>Categories: {escape(self.categories)}</p>")
+        if self.word_lists:
+            html.append(f"<p>Word lists: {escape(', '.join(self.word_lists))}</p>")
+        return "".join(html)
+
+# w_idx -> CardBack made by render(w_idx) for the size most recently shown
+# words; words are dropped when they change and drop_kanji drops every word
+# that shows the kanji, rendering happens outside of the lock so that
+# readers in several threads don't wait for each other
+class RenderCache:
+    def __init__(self, render, size):
+        self.render = render
+        self.size = size
+        self.backs = OrderedDict()
+        self.by_kanji = {}
+        self.lock = threading.Lock()
+
+    def get(self, w_idx):
+        with self.lock:
+            back = self.backs.get(w_idx)
+            stats.cache("render cache", back is not None)
+            if back is not None:
+                self.backs.move_to_end(w_idx)
+                return back
+        with stats.timer("render back"):
+            back = self.render(w_idx)
+        with self.lock:
+            self.put(w_idx, back)
+        return back
+
+    def put(self, w_idx, back):
+        self.remove(w_idx)
+        self.backs[w_idx] = back
+        for k_idx in back.k_idxs:
+            self.by_kanji.setdefault(k_idx, set()).add(w_idx)
+        while len(self.backs) > self.size:
+            self.remove(next(iter(self.backs)))
+
+    def remove(self, w_idx):
+        back = self.backs.pop(w_idx, None)
+        if back is None:
+            return
+        for k_idx in back.k_idxs:
+            w_idxs = self.by_kanji[k_idx]
+            w_idxs.discard(w_idx)
+            if not w_idxs:
+                del self.by_kanji[k_idx]
+
+    def drop(self, w_idx):
+        with self.lock:
+            self.remove(w_idx)
+
+    def drop_kanji(self, k_idx):
+        with self.lock:
+            for w_idx in list(self.by_kanji.get(k_idx, ())):
+                self.remove(w_idx)
+
+if __name__ == "__main__":
+    calls = []
+    def render(w_idx):
+        calls.append(w_idx)
+        return CardBack("", str(w_idx), ("meaning",), [("日", False, ("sun",))], [], None, [], {w_idx % 2})
+    cache = RenderCache(render, 2)
+    cache.get(0)
+    cache.get(0)
+    cache.get(1)
+    print(calls, "== [0, 1]")
+    cache.drop_kanji(0)
+    cache.get(0)
+    cache.get(1)
+    print(calls, "== [0, 1, 0]")
+    cache.get(2)
+    cache.get(0)
+    print(calls, len(cache.backs), "== [0, 1, 0, 2, 0] 2")
+    print(cache.get(0).text.split("\n"), "== ['0', 'Meaning:', '• meaning', 'Kanji:', '日: sun']")
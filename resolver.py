@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+
+# fetches a dependency frontier with a bounded thread pool,
+# a key that is already being fetched is never requested twice
+class Resolver:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def close(self):
+        self.pool.shutdown()
+
+    def submit(self, key, fetch):
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                return future
+            future = self.pool.submit(fetch, key)
+            self.in_flight[key] = future
+        # a future that is already done runs the callback right here, so it
+        # can't be added while the lock is held
+        future.add_done_callback(lambda _: self.done(key, future))
+        return future
+
+    def done(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    # fetch(key) returns the data for key or None on failure,
+    # deps(key, data) returns the keys that have to be fetched as well,
+    # progress(done, total) is called whenever a key has been fetched,
+    # returns (key -> data, keys in the order they were discovered)
+    def resolve(self, roots, fetch, deps, progress=None):
+        results = {}
+        order = []
+        futures = {}
+        def schedule(key):
+            if key in results:
+                return
+            results[key] = None
+            order.append(key)
+            futures[self.submit(key, fetch)] = key
+        for key in roots:
+            schedule(key)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                data = future.result()
+                results[key] = data
+                if data is not None:
+                    for dep in deps(key, data):
+                        schedule(dep)
+                if progress:
+                    progress(len(order) - len(futures), len(order))
+        return results, order
@@ -0,0 +1,131 @@
+import pickle
+import random
+from heapq import heapify, heappop, heappush
+
+RANDOM = "random"
+SHUFFLE = "shuffle"
+PRIORITY = "priority"
+
+# cards of a review round as [w_idx, wrong] pairs; drawing a random card and
+# removing any card are O(1) because the last card takes the place of the
+# removed one, in shuffle order the cards are drawn from the back so that
+# removing the drawn card keeps the order of the others and in priority order
+# the cards that have been answered wrong most often come first
+class ReviewQueue:
+    __slots__ = ("cards", "pos", "heap")
+
+    def __init__(self, cards=()):
+        self.cards = [list(card) for card in cards]
+        self.pos = {card[0]: i for i, card in enumerate(self.cards)}
+        self.heap = None
+
+    def from_lists(lists):
+        w_idxs, wrongs = lists
+        return ReviewQueue(zip(w_idxs, wrongs))
+
+    def to_lists(self):
+        return [[card[0] for card in self.cards], [card[1] for card in self.cards]]
+
+    def __getstate__(self):
+        return self.to_lists()
+
+    def __setstate__(self, lists):
+        self.__init__(zip(*lists))
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __contains__(self, w_idx):
+        return w_idx in self.pos
+
+    def __repr__(self):
+        return f"ReviewQueue({self.cards})"
+
+    def push(self, card):
+        self.pos[card[0]] = len(self.cards)
+        self.cards.append(card)
+        if self.heap is not None:
+            heappush(self.heap, (-card[1], random.random(), card[0]))
+
+    def remove(self, w_idx):
+        i = self.pos.pop(w_idx)
+        card = self.cards[i]
+        last = self.cards.pop()
+        if last is not card:
+            self.cards[i] = last
+            self.pos[last[0]] = i
+        return card
+
+    def discard(self, w_idx):
+        if w_idx in self.pos:
+            self.remove(w_idx)
+
+    # the w_idx of the next card, which stays in the queue until it is removed;
+    # with skip the card that comes after skip, None if there is no other card
+    def draw(self, order=RANDOM, skip=None):
+        n = len(self.cards)
+        skipped = self.pos.get(skip)
+        if skipped is not None:
+            n -= 1
+        if not n:
+            return None
+        if order == SHUFFLE:
+            return self.cards[-2 if skipped == len(self.cards) - 1 else -1][0]
+        if order == PRIORITY:
+            if self.heap is None:
+                self.heap = [(-wrong, random.random(), w_idx) for w_idx, wrong in self.cards]
+                heapify(self.heap)
+            # entries of removed cards are only dropped once they come up
+            held = []
+            while True:
+                entry = self.heap[0]
+                wrong, _, w_idx = entry
+                i = self.pos.get(w_idx)
+                if i is not None and self.cards[i][1] == -wrong:
+                    if w_idx != skip:
+                        break
+                    held.append(entry)
+                heappop(self.heap)
+            for entry in held:
+                heappush(self.heap, entry)
+            return w_idx
+        i = random.randrange(n)
+        if skipped is not None and i >= skipped:
+            i += 1
+        return self.cards[i][0]
+
+    def shuffle(self, rng):
+        rng.shuffle(self.cards)
+        self.pos = {card[0]: i for i, card in enumerate(self.cards)}
+        self.heap = None
+
+    # new maps every w_idx to its new one or -1 if the card is dropped
+    def remap(self, new):
+        return ReviewQueue([new(w_idx), wrong] for w_idx, wrong in self.cards if new(w_idx) != -1)
+
+if __name__ == "__main__":
+    q = ReviewQueue([w_idx, w_idx % 3] for w_idx in range(10))
+    q.remove(2)
+    q.remove(9)
+    print(sorted(card[0] for card in q), "== [0, 1, 3, 4, 5, 6, 7, 8]")
+    print(all(q.cards[q.pos[w_idx]][0] == w_idx for w_idx in q.pos), "== True")
+    print(q.draw(PRIORITY) in (5, 8), "== True")
+    q.remove(5)
+    q.remove(8)
+    print(q.draw(PRIORITY) in (1, 4, 7), "== True")
+    q.shuffle(random.Random(1))
+    copy = pickle.loads(pickle.dumps(q))
+    order = []
+    while q:
+        order.append(q.remove(q.draw(SHUFFLE))[0])
+    same = []
+    while copy:
+        same.append(copy.remove(copy.draw(SHUFFLE))[0])
+    print(order == same, "== True")
+    q = ReviewQueue([w_idx, w_idx] for w_idx in range(3))
+    print(set(q.draw(RANDOM, 1) for _ in range(50)), "== {0, 2}")
+    print(q.draw(PRIORITY), q.draw(PRIORITY, 2), q.draw(PRIORITY), "== 2 1 2")
+    print(q.draw(SHUFFLE), q.draw(SHUFFLE, 2), ReviewQueue([[5, 0]]).draw(RANDOM, 5), "== 2 1 None")
@@ -0,0 +1,116 @@
+import pickle
+from heapq import heapify, heappop, heappush
+
+DAY = 24 * 60 * 60
+START_EASE = 2.5
+MIN_EASE = 1.3
+# interval in days that the words of each slot start with when a database
+# that only knows slots is scheduled for the first time
+SLOT_INTERVALS = (0, 1, 3, 7, 14, 30)
+
+# due timestamp, ease and interval (in days) of every scheduled word and a
+# min-heap of (due, w_idx); entries of words that have been rescheduled or
+# removed stay in the heap until they come up and are skipped then
+class Scheduler:
+    __slots__ = ("entries", "heap")
+
+    # entries are (w_idx, due, ease, interval)
+    def __init__(self, entries=()):
+        self.entries = {w_idx: (due, ease, interval) for w_idx, due, ease, interval in entries}
+        self.rebuild()
+
+    def __getstate__(self):
+        return list(self.items())
+
+    def __setstate__(self, entries):
+        self.__init__(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, w_idx):
+        return w_idx in self.entries
+
+    def get(self, w_idx):
+        return self.entries.get(w_idx)
+
+    def items(self):
+        for w_idx, (due, ease, interval) in self.entries.items():
+            yield w_idx, due, ease, interval
+
+    def rebuild(self):
+        self.heap = [(due, w_idx) for w_idx, (due, _, _) in self.entries.items()]
+        heapify(self.heap)
+
+    def set(self, w_idx, due, ease, interval):
+        old = self.entries.get(w_idx)
+        self.entries[w_idx] = (due, ease, interval)
+        if old is None or old[0] != due:
+            heappush(self.heap, (due, w_idx))
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.rebuild()
+
+    def remove(self, w_idx):
+        self.entries.pop(w_idx, None)
+
+    def is_current(self, due, w_idx):
+        entry = self.entries.get(w_idx)
+        return entry is not None and entry[0] == due
+
+    # the first n words that are due at now, most overdue first; only the
+    # popped entries are touched, so this is O(n log len) and not a scan
+    def due(self, now, n):
+        heap = self.heap
+        taken = []
+        result = []
+        seen = set()
+        while heap and len(result) < n and heap[0][0] <= now:
+            due, w_idx = heappop(heap)
+            if self.is_current(due, w_idx) and w_idx not in seen:
+                taken.append((due, w_idx))
+                result.append(w_idx)
+                seen.add(w_idx)
+        for x in taken:
+            heappush(heap, x)
+        return result
+
+    # timestamp at which the next word is due, None if nothing is scheduled
+    def next_due(self):
+        heap = self.heap
+        while heap and not self.is_current(*heap[0]):
+            heappop(heap)
+        return heap[0][0] if heap else None
+
+    # SM-2: quality from 0 (forgotten) to 5 (perfect), below 3 the interval
+    # starts over; returns the new (due, ease, interval) without applying it
+    def review(self, w_idx, quality, now):
+        _, ease, interval = self.entries.get(w_idx, (0, START_EASE, 0))
+        if quality < 3:
+            interval = 1
+        elif interval == 0:
+            interval = 1
+        elif interval == 1:
+            interval = 6
+        else:
+            interval = round(interval * ease)
+        ease = max(MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        return now + interval * DAY, ease, interval
+
+    # new maps every w_idx to its new one or -1 if the word is dropped
+    def remap(self, new):
+        return Scheduler((new(w_idx), due, ease, interval)
+                for w_idx, due, ease, interval in self.items() if new(w_idx) != -1)
+
+if __name__ == "__main__":
+    s = Scheduler((w_idx, w_idx * 10, START_EASE, 1) for w_idx in range(100))
+    print(s.due(35, 10), "== [0, 1, 2, 3]")
+    s.set(2, 1000, START_EASE, 6)
+    s.remove(0)
+    print(s.due(35, 10), "== [1, 3]")
+    print(s.due(10000, 3), "== [1, 3, 4]")
+    print(s.next_due(), "== 10")
+    due, ease, interval = s.review(3, 5, 0)
+    print(interval, round(ease, 2), due == 6 * DAY, "== 6 2.6 True")
+    print(s.review(3, 1, 0)[2], "== 1")
+    t = pickle.loads(pickle.dumps(s))
+    print(t.due(10000, 5) == s.due(10000, 5), len(t), "== True 99")
@@ -0,0 +1,75 @@
+import re
+
+# character classes as regex ranges, a character belongs to the first class
+# that contains it; iteration marks come first because they lie inside the
+# punctuation, hiragana and katakana blocks
+CLASSES = (
+    ("iteration", "i", "々〻ゝゞヽヾ"),
+    ("punctuation", "p", "　-〿"),
+    ("hiragana", "h", "぀-ゟ"),
+    ("katakana", "k", "゠-ヿㇰ-ㇿ"),
+    ("halfwidth", "w", "｡-ﾟ"),
+    ("kanji", "c", "㐀-䶿一-鿿豈-﫿\U00020000-\U0003134f"),
+)
+
+# everything that is not written with kanji, as far as furigana and kanji
+# lookups are concerned
+KANA = "".join(ranges for name, _, ranges in CLASSES if name != "kanji")
+LATIN_THRESHOLD = 0x036F
+
+KANA_RUN = re.compile(f"[{KANA}]+")
+KANA_SPLIT = re.compile(f"([{KANA}]+)")
+NON_KANA = re.compile(f"[^{KANA}]")
+NON_LATIN = re.compile(f"[^\\x00-\\u{LATIN_THRESHOLD:04x}]")
+# characters outside of all classes are "other" with code "o"
+RUNS = re.compile("|".join(f"(?P<{name}>[{ranges}]+)" for name, _, ranges in CLASSES)
+        + f"|(?P<other>[^{''.join(ranges for _, _, ranges in CLASSES)}]+)")
+CODES = {name: code for name, code, _ in CLASSES}
+CODES["other"] = "o"
+
+def is_kana(char):
+    return KANA_RUN.fullmatch(char) is not None
+
+def is_all_kana(s):
+    return KANA_RUN.fullmatch(s) is not None
+
+# (class name, text) of every run of characters of the same class
+def runs(s):
+    return [(m.lastgroup, m.group()) for m in RUNS.finditer(s)]
+
+# one class code per character, e.g. "chh" for 食べる
+def classify(s):
+    return "".join(CODES[m.lastgroup] * (m.end() - m.start()) for m in RUNS.finditer(s))
+
+def classify_all(strings):
+    return [classify(s) for s in strings]
+
+# alternating runs of kanji and kana, starting and ending with a (maybe
+# empty) run of kanji
+def split_kana(s):
+    return KANA_SPLIT.split(s)
+
+def kanji_positions(s):
+    return [m.start() for m in NON_KANA.finditer(s)]
+
+def kanji_positions_all(strings):
+    return [kanji_positions(s) for s in strings]
+
+def kanji_chars(s):
+    return NON_KANA.findall(s)
+
+# the kanji of all strings in one scan over them joined by a kana separator
+def kanji_chars_all(strings):
+    return NON_KANA.findall("　".join(strings))
+
+def filter_kanji(s):
+    return NON_LATIN.findall(s)
+
+if __name__ == "__main__":
+    print(classify("食べる"), classify("人々"), classify("ｶﾀｶﾅ、テスト!"), "== chh ci wwwwpkkko")
+    print(runs("お茶々"), "== [('hiragana', 'お'), ('kanji', '茶'), ('iteration', '々')]")
+    print(split_kana("お茶を飲む"), "== ['', 'お', '茶', 'を', '飲', 'む', '']")
+    print(kanji_positions("お茶を飲む"), kanji_positions_all(["日本", "すし"]), "== [1, 3] [[0, 1], []]")
+    print(kanji_chars_all(["日本語", "食べる", "ひらがな"]), "== ['日', '本', '語', '食']")
+    print(is_kana("ー"), is_kana("日"), is_all_kana("ﾃｽﾄ"), "== True False True")
+    print(filter_kanji("abc 一 (いち)"), "== ['一', 'い', 'ち']")
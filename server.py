@@ -1,11 +1,17 @@
 from flask import *
 from flask_socketio import *
-from threading import Lock
 import random as rng
+import threading
+from functools import wraps
 from os import sys
-from subprocess import Popen, PIPE
 from enum import *
-import re
+from flashcard import Context, ReviewState, ReviewEngine, DB_FILE
+from bitset import Bitset
+from sessions import RWLock, SessionManager
+
+# learners that have been idle for this many seconds lose their unfinished review
+SESSION_TIMEOUT = 30 * 60
+MAX_SESSIONS = 64
 
 class State(IntEnum):
     START = auto()
@@ -13,158 +19,286 @@ class State(IntEnum):
     REVIEW_FRONT = auto()
     REVIEW_BACK = auto()
 
-lock = Lock()
-owner = None
-p = None
-out = ""
-word_lists = []
+# the words are shared by all learners and only changed under the write lock,
+# every learner reviews their own cards
+lock = RWLock()
+ctx = Context()
+
+class Learner:
+    def __init__(self):
+        self.engine = ReviewEngine(ctx, ReviewState(), lock)
+        # socket.io handlers run in threads of their own, so two quick answers
+        # of the same learner could interleave; it is always taken before lock
+        self.lock = threading.Lock()
+        self.state = State.START
+        self.card = None
+        # the card after card, rendered while the front of card is shown
+        self.upcoming = None
+
+sessions = SessionManager(Learner, SESSION_TIMEOUT, MAX_SESSIONS)
+
+# the terminal can delete words that learners are reviewing, the deletes are
+# applied under the write lock, so the cards are only dropped once the
+# learner uses its engine again
+def drop_cards(w_idx):
+    for learner in sessions.states():
+        learner.engine.deleted.append(w_idx)
+
+ctx.delete_hooks = [drop_cards]
 
 app = Flask(__name__)
 app.secret_key = "1234"
 socketio = SocketIO(app)
 
-ansi_escape = re.compile(br'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-
-def read_and_decode(until="\n"):
-    global p, out
-    until = until.encode()
-    n = len(until)
-    s = b""
-    t = len(s)
-    while s[t-n:] != until:
-        s += p.stdout.read(1)
-        t = len(s)
-    out = re.sub(ansi_escape, b'', s).decode().strip()
-
-def send(msg):
-    global p
-    p.stdin.write(msg.encode())
-    p.stdin.flush()
+def load():
+    try:
+        ctx.read_from_file(DB_FILE)
+    except Exception:
+        print(f"Warning: could not read from {DB_FILE}.db")
+        ctx.init_empty()
+        ctx.open_journal(DB_FILE)
 
 @app.before_request
-def check_lock():
-    global owner, lock
+def find_learner():
     if "favicon" in request.base_url: 
         return
     sid = session.get("sid")
     if sid is None:
         sid = rng.randint(0, sys.maxsize)
         session["sid"] = sid
-        session["state"] = State.START
-    lock.acquire()
-    if owner is not None and owner != sid:
-        lock.release()
-        abort(403)
-    owner = sid
-    lock.release()
+    g.learner = sessions.get(sid)
+    if g.learner is None:
+        abort(503)
+    catch_up()
+
+# the terminal may have changed words in the meantime
+def catch_up():
+    if ctx.journal is not None and ctx.journal.behind():
+        with lock.write():
+            ctx.catch_up()
+
+# routes that use the learner run under its lock
+def with_learner_lock(route):
+    @wraps(route)
+    def locked(*args, **kwargs):
+        with g.learner.lock:
+            return route(*args, **kwargs)
+    return locked
 
 #@socketio.on("disconnect")
-def cleanup(wait):
-    global p, owner
-    if p:
-        if wait:
-            try: p.wait()
-            except: p.kill()
-        else:
-            p.kill()
-    p = None
-    owner = None
-    session["state"] = State.START
+def cleanup():
+    sessions.drop(session["sid"])
 
 @app.route("/")
+@with_learner_lock
 def start():
-    global p, out
-    state = session["state"]
-    if state != State.START:
+    learner = g.learner
+    if learner.state != State.START:
         abort(403)
-    if not p:
-        p = Popen(["python3", "flashcard.py"], stdout=PIPE, stdin=PIPE)
-    read_and_decode("Action: ")
-    send("r\n")
-    read_and_decode("Select: ")
-    session["state"] = State.SELECT
+    learner.state = State.SELECT
     return render_template("start.html")
 
 @app.route("/select", methods=["GET", "POST"])
+@with_learner_lock
 def select():
-    global out, word_lists
-    state = session["state"]
-    if state != State.SELECT:
+    learner = g.learner
+    engine = learner.engine
+    if learner.state != State.SELECT:
         abort(403)
+    # an unfinished review is continued
+    if engine.active():
+        learner.state = State.REVIEW_FRONT
+        return redirect("review")
     if request.method == "POST":
         selected = ",".join(filter(lambda k: k.isdigit(), request.form.keys()))
-        if selected:
-            send(selected + '\n')
-            read_and_decode()
-            read_and_decode(": ")
-            if out == "Error:":
-                tmp = out
-                read_and_decode('\n')
-                tmp += out
-                flash(tmp)
-            else:
-                n = request.form["number"]
-                send(n + '\n')
-                read_and_decode("Select: ")
-                send('\n')
-                session["state"] = State.REVIEW_FRONT
-                return redirect("view_front")
-        else:
+        n = request.form.get("number", "")
+        if not selected:
             flash("Error: no word list selected")
-    else:
-        word_lists = []
-        for line in out.split('\n')[:-2]:
-            parts = line.split(". ")
-            if len(parts) == 1:
-                word_lists.append((0, parts[0]))
+        elif not n.isdigit():
+            flash(f"Error: invalid number {n}")
+        elif "offline" in request.form:
+            return redirect(url_for("offline", select=selected, number=n))
+        else:
+            try:
+                word_list, _ = engine.select(selected)
+            except ValueError as e:
+                flash(f"Error: {e}")
             else:
-                word_lists.append((int(parts[0]), parts[1]))
+                words = Bitset()
+                engine.pick(word_list, int(n), words)
+                engine.start(words)
+                learner.state = State.REVIEW_FRONT
+                return redirect("review")
+    word_lists = []
+    for heading, lists in engine.decks():
+        if heading:
+            word_lists.append((0, heading + ":"))
+        word_lists += [(i, f"{name}: {n}") for i, name, n in lists]
     return render_template("select.html", word_lists=word_lists)
 
+# the review page gets its cards over socket.io, view_front and view_back
+# are the same review without javascript
+@app.route("/review")
+@with_learner_lock
+def review():
+    if g.learner.state != State.REVIEW_FRONT:
+        abort(403)
+    return render_template("review.html")
+
+# None if there is no card or its word has been deleted
+def render_card(engine, w_idx):
+    if w_idx is None:
+        return None
+    front, back = engine.front(w_idx), engine.back(w_idx)
+    if front is None or back is None:
+        return None
+    return {"id": w_idx, "front": front, "back": back}
+
+# the current card and the one after it, card is the already rendered
+# current card if there is one; the review ends when there are no cards left
+def current_cards(learner, card=None):
+    engine = learner.engine
+    if card is not None and not engine.has_card(card["id"]):
+        card = None
+    # the card of a word that is deleted while it is rendered is left out
+    # by the next draw
+    while card is None:
+        w_idx = engine.next_card()
+        if w_idx is None:
+            break
+        card = render_card(engine, w_idx)
+    if card is None:
+        engine.finish()
+        learner.state = State.START
+        learner.card = learner.upcoming = None
+        return {"card": None, "next": None}
+    learner.card = card["id"]
+    learner.upcoming = render_card(engine, engine.next_card(skip=learner.card))
+    return {"card": card, "next": learner.upcoming}
+
+# socket.io events don't go through find_learner
+def socket_learner():
+    sid = session.get("sid")
+    learner = sessions.get(sid) if sid is not None else None
+    catch_up()
+    return learner
+
+# must be called with the lock of learner held
+def learner_cards(learner):
+    if learner.state != State.REVIEW_FRONT:
+        return {"error": "no review"}
+    card = None
+    if learner.card is not None:
+        card = render_card(learner.engine, learner.card)
+    return current_cards(learner, card)
+
+@socketio.on("cards")
+def cards():
+    learner = socket_learner()
+    if learner is None:
+        return {"error": "no review"}
+    with learner.lock:
+        return learner_cards(learner)
+
+# the client already shows the next card that it got with the last answer,
+# the acknowledgement brings the card after that one
+@socketio.on("answer")
+def answer(data):
+    if not isinstance(data, dict) or not isinstance(data.get("id"), int) or not isinstance(data.get("correct"), bool):
+        return {"error": "invalid answer"}
+    learner = socket_learner()
+    if learner is None:
+        return {"error": "no review"}
+    with learner.lock:
+        if learner.state != State.REVIEW_FRONT:
+            return {"error": "no review"}
+        if data["id"] != learner.card or not learner.engine.has_card(learner.card):
+            return learner_cards(learner)
+        learner.engine.answer(learner.card, data["correct"])
+        return current_cards(learner, learner.upcoming)
+
 @app.route("/view_front")
+@with_learner_lock
 def view_front():
-    global out
-    state = session["state"]
-    if state != State.REVIEW_FRONT:
+    learner = g.learner
+    engine = learner.engine
+    if learner.state != State.REVIEW_FRONT:
         abort(403)
-    read_and_decode()
-    front = out
-    if out.find('?') != -1:
-        read_and_decode(": ")
-        send("n\n")
-        session["state"] = State.START
+    learner.card = engine.next_card()
+    if learner.card is None:
+        engine.finish()
+        learner.state = State.START
         return redirect("/")
-    read_and_decode("[Check] ")
-    send('\n')
-    session["state"] = State.REVIEW_BACK
+    front = engine.front(learner.card)
+    # the word has been deleted in the meantime
+    if front is None:
+        return redirect("view_front")
+    learner.state = State.REVIEW_BACK
     return render_template("front.html", front=front)
 
 @app.route("/view_back", methods=["GET", "POST"])
+@with_learner_lock
 def view_back():
-    global out, p
-    state = session["state"]
-    if state != State.REVIEW_BACK:
+    learner = g.learner
+    engine = learner.engine
+    if learner.state != State.REVIEW_BACK:
         abort(403)
+    back = engine.back_html(learner.card) if engine.has_card(learner.card) else None
+    # the word has been deleted in the meantime
+    if back is None:
+        learner.state = State.REVIEW_FRONT
+        return redirect("view_front")
     if request.method == "POST":
-        answer = request.form["submit"]
-        send(answer + '\n')
-        session["state"] = State.REVIEW_FRONT
+        engine.answer(learner.card, request.form["submit"] == "yes")
+        learner.state = State.REVIEW_FRONT
         return redirect("view_front")
-    read_and_decode('?')
-    to = out.rfind('\n')
-    back = out[:to]
-    read_and_decode(": ")
     return render_template("back.html", back=back)
 
+# the whole deck is downloaded as one bundle from /deck and reviewed in the
+# browser, the answers come back in one request to /sync
+@app.route("/offline")
+@with_learner_lock
+def offline():
+    if g.learner.state != State.SELECT:
+        abort(403)
+    deck_url = url_for("deck", select=request.args.get("select", ""), number=request.args.get("number", ""))
+    return render_template("offline.html", deck_url=deck_url)
+
+@app.route("/deck")
+@with_learner_lock
+def deck():
+    engine = g.learner.engine
+    n = request.args.get("number", "")
+    if not n.isdigit():
+        return jsonify({"error": f"invalid number {n}"}), 400
+    try:
+        word_list, _ = engine.select(request.args.get("select", ""))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    words = Bitset()
+    engine.pick(word_list, int(n), words)
+    return jsonify(engine.bundle(words))
+
+@app.route("/sync", methods=["POST"])
+@with_learner_lock
+def sync():
+    data = request.get_json(silent=True) or {}
+    try:
+        applied = g.learner.engine.sync(data["cards"], data["log"])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"applied": applied})
+
 @app.route("/exit")
 def exit():
-    send("b\nexit\n")
-    return leave(True)
+    g.learner.engine.save()
+    return leave()
 
 @app.route("/abort")
-def leave(wait=False):
-    cleanup(wait)
+def leave():
+    cleanup()
     return "<p>session closed</p>"
 
 if __name__ == "__main__":
+    load()
     socketio.run(app, debug=True, host="0.0.0.0")
@@ -0,0 +1,110 @@
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# any number of readers or a single writer; a waiting writer keeps new readers
+# out so that a steady stream of readers can't starve it
+class RWLock:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+# sid -> state created by create(), sessions that have not been used for
+# timeout seconds are evicted and at most limit sessions exist at once; the
+# sessions are kept in the order of their last use, so evicting only looks
+# at the oldest ones
+class SessionManager:
+    def __init__(self, create, timeout, limit):
+        self.create = create
+        self.timeout = timeout
+        self.limit = limit
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # the state of sid, None if sid is new and there are already limit sessions
+    def get(self, sid):
+        now = time.monotonic()
+        with self.lock:
+            self.evict(now)
+            entry = self.sessions.get(sid)
+            if entry is None:
+                if len(self.sessions) >= self.limit:
+                    return None
+                entry = self.sessions[sid] = [now, self.create()]
+            else:
+                entry[0] = now
+                self.sessions.move_to_end(sid)
+            return entry[1]
+
+    # the states of all sessions, also the ones that are about to be evicted
+    def states(self):
+        with self.lock:
+            return [state for _, state in self.sessions.values()]
+
+    def drop(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def evict(self, now):
+        while self.sessions:
+            sid, (last_used, _) = next(iter(self.sessions.items()))
+            if now - last_used < self.timeout:
+                break
+            del self.sessions[sid]
+
+if __name__ == "__main__":
+    sessions = SessionManager(list, 0.05, 2)
+    a = sessions.get("a")
+    print(sessions.get("a") is a, sessions.get("b") is not None, sessions.get("c"), "== True True None")
+    time.sleep(0.06)
+    print(sessions.get("c") is not None, len(sessions), "== True 1")
+    lock = RWLock()
+    log = []
+    def reader():
+        with lock.read():
+            time.sleep(0.02)
+            log.append("r")
+    def writer():
+        with lock.write():
+            log.append("w")
+    threads = [threading.Thread(target=reader) for _ in range(4)] + [threading.Thread(target=writer)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(sorted(log), "== ['r', 'r', 'r', 'r', 'w']")
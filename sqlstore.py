@@ -0,0 +1,286 @@
+import json
+import sqlite3
+from holelist import HoleArray
+from lazy import UNLOADED, LazyList, LazyHoleArray
+from bitset import Bitset
+from reviewqueue import ReviewQueue
+from scheduler import Scheduler, START_EASE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kanji (
+    idx INTEGER PRIMARY KEY,
+    char TEXT NOT NULL,
+    meanings TEXT NOT NULL,
+    categories TEXT NOT NULL,
+    radical INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS kanji_char ON kanji (char);
+CREATE TABLE IF NOT EXISTS kanji_missing (
+    char TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS kanji_parts (
+    kanji INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    part INTEGER NOT NULL,
+    PRIMARY KEY (kanji, pos)
+);
+CREATE TABLE IF NOT EXISTS words (
+    idx INTEGER PRIMARY KEY,
+    word TEXT NOT NULL,
+    furigana TEXT NOT NULL,
+    meanings TEXT NOT NULL,
+    slot INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS words_word ON words (word);
+CREATE INDEX IF NOT EXISTS words_slot ON words (slot);
+CREATE TABLE IF NOT EXISTS word_kanji (
+    word INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    kanji INTEGER NOT NULL,
+    PRIMARY KEY (word, pos)
+);
+CREATE INDEX IF NOT EXISTS word_kanji_kanji ON word_kanji (kanji);
+CREATE TABLE IF NOT EXISTS word_lists (
+    idx INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS word_list_members (
+    list INTEGER NOT NULL,
+    word INTEGER NOT NULL,
+    PRIMARY KEY (list, word)
+);
+CREATE INDEX IF NOT EXISTS word_list_members_word ON word_list_members (word);
+CREATE TABLE IF NOT EXISTS schedule (
+    word INTEGER PRIMARY KEY,
+    due REAL NOT NULL,
+    ease REAL NOT NULL,
+    interval INTEGER NOT NULL
+);
+"""
+
+# the context is stored in normalized tables, the derived indexes (symbol maps,
+# slots, word list sets) are rebuilt when loading while words and kanji are only
+# read when they are needed; saving applies the records of the journal as single
+# statements, so its cost depends on the number of changes
+class SQLiteStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    # state that is only kept in meta and written as a whole on every save
+    def write_state(self, ctx, base):
+        self.set_meta("journal", base)
+        self.set_meta("no_single_kanji_words",
+                sorted(k_idx for k_idx, w_idxs in ctx.single_kanji_words.items() if not w_idxs))
+        self.db.execute("DELETE FROM meta WHERE key IN ('invalid', 'review')")
+        self.set_meta("review_queues", [ctx.review_seed, ctx.review_round,
+                ctx.correct.to_lists(), ctx.incorrect.to_lists(), ctx.stash.to_lists()])
+        self.set_meta("parts_reduced", ctx.parts_reduced)
+        self.set_meta("scheduled", ctx.schedule is not None)
+
+    # raises KeyError if nothing has been saved yet, returns the id of the
+    # journal the data belongs to; only the symbol maps and the indexes are
+    # read, words and kanji are loaded on access and at most cache_size of
+    # each are kept in memory
+    def load(self, ctx, word_cls, kanji_cls, cache_size):
+        base = self.get_meta("journal")
+        if base is None:
+            raise KeyError("context")
+        self.word_cls = word_cls
+        self.kanji_cls = kanji_cls
+        kanjis = []
+        ctx.kanji_idx_by_symbol = {}
+        for idx, char in self.db.execute("SELECT idx, char FROM kanji ORDER BY idx"):
+            while len(kanjis) < idx:
+                kanjis.append(None)
+            kanjis.append(UNLOADED)
+            ctx.kanji_idx_by_symbol[char] = idx
+        for (char,) in self.db.execute("SELECT char FROM kanji_missing"):
+            ctx.kanji_idx_by_symbol[char] = -1
+        ctx.kanjis = LazyList(kanjis, self.load_kanji, cache_size)
+        names = HoleArray()
+        for idx, name in self.db.execute("SELECT idx, name FROM word_lists ORDER BY idx"):
+            names.put(idx, name)
+        ctx.word_list_names = names
+        ctx.word_lists = {name: Bitset() for name in names}
+        for n_idx, w_idx in self.db.execute("SELECT list, word FROM word_list_members"):
+            ctx.word_lists[names[n_idx]].add(w_idx)
+        words = []
+        ctx.word_idx_by_symbols = {}
+        ctx.slots = tuple([Bitset() for _ in range(6)])
+        for idx, word, slot in self.db.execute("SELECT idx, word, slot FROM words ORDER BY idx"):
+            while len(words) < idx:
+                words.append(None)
+            words.append(UNLOADED)
+            ctx.word_idx_by_symbols[word] = idx
+            ctx.slots[slot].add(idx)
+        ctx.words = LazyHoleArray(words, self.load_word, cache_size)
+        ctx.single_kanji_word_lists = tuple([Bitset() for _ in range(14)])
+        ctx.single_kanji_words = {k_idx: set() for k_idx in self.get_meta("no_single_kanji_words", [])}
+        for w_idx, k_idx, categories in self.db.execute("""
+                SELECT single.word, single.kanji, kanji.categories FROM (
+                    SELECT word, min(kanji) AS kanji FROM word_kanji
+                    GROUP BY word HAVING count(*) = 1
+                ) AS single JOIN kanji ON kanji.idx = single.kanji"""):
+            for c in json.loads(categories):
+                ctx.single_kanji_word_lists[c].add(w_idx)
+            ctx.single_kanji_words.setdefault(k_idx, set()).add(w_idx)
+        review = self.get_meta("review_queues")
+        if review is not None:
+            ctx.review_seed, ctx.review_round = review[:2]
+            ctx.correct, ctx.incorrect, ctx.stash = map(ReviewQueue.from_lists, review[2:])
+        else:
+            # saved before ReviewQueue existed
+            invalid = set(self.get_meta("invalid", []))
+            cards = self.get_meta("review", [[], [], []])
+            ctx.correct, ctx.incorrect, ctx.stash = (
+                    ReviewQueue(card for card in l if card[0] not in invalid) for l in cards)
+        ctx.parts_reduced = self.get_meta("parts_reduced", False)
+        ctx.schedule = None
+        if self.get_meta("scheduled", False):
+            ctx.schedule = Scheduler(self.db.execute("SELECT word, due, ease, interval FROM schedule"))
+        return base
+
+    def load_kanji(self, idx):
+        char, meanings, categories, radical = self.db.execute(
+                "SELECT char, meanings, categories, radical FROM kanji WHERE idx = ?",
+                (idx,)).fetchone()
+        parts = [part for (part,) in self.db.execute(
+                "SELECT part FROM kanji_parts WHERE kanji = ? ORDER BY pos", (idx,))]
+        return self.kanji_cls(char, json.loads(meanings), set(json.loads(categories)), parts, radical)
+
+    def load_word(self, idx):
+        word, furigana, meanings, slot = self.db.execute(
+                "SELECT word, furigana, meanings, slot FROM words WHERE idx = ?",
+                (idx,)).fetchone()
+        kanji_index = [k_idx for (k_idx,) in self.db.execute(
+                "SELECT kanji FROM word_kanji WHERE word = ? ORDER BY pos", (idx,))]
+        word_lists = set(n_idx for (n_idx,) in self.db.execute(
+                "SELECT list FROM word_list_members WHERE word = ?", (idx,)))
+        w = self.word_cls(word, json.loads(furigana), json.loads(meanings), kanji_index, word_lists)
+        w.slot = slot
+        return w
+
+    # replaces everything in the database with ctx, words and kanji that
+    # have not been loaded yet are read before anything is deleted
+    def save(self, ctx, base):
+        kanjis = [(idx, k) for idx, k in enumerate(ctx.kanjis) if k]
+        words = list(ctx.words.items())
+        with self.db:
+            for table in ("kanji", "kanji_missing", "kanji_parts", "words",
+                    "word_kanji", "word_lists", "word_list_members", "schedule"):
+                self.db.execute(f"DELETE FROM {table}")
+            missing = [(c,) for c, k_idx in ctx.kanji_idx_by_symbol.items() if k_idx == -1]
+            self.sql_add_kanjis(kanjis, [])
+            self.db.executemany("INSERT INTO kanji_missing VALUES (?)", missing)
+            for n_idx, name in ctx.word_list_names.items():
+                self.sql_list_add(n_idx, name)
+            for idx, w in words:
+                self.sql_add_word(idx, w)
+            if ctx.schedule is not None:
+                self.sql_schedule(list(ctx.schedule.items()))
+            self.write_state(ctx, base)
+
+    # applies the records of a journal in one transaction
+    def apply(self, records, ctx, base):
+        with self.db:
+            for op, args in records:
+                f = getattr(self, "sql_" + op, None)
+                if f:
+                    f(*args)
+            self.write_state(ctx, base)
+
+    def sql_add_kanjis(self, kanjis, missing):
+        for idx, k in kanjis:
+            self.db.execute("INSERT OR REPLACE INTO kanji VALUES (?, ?, ?, ?, ?)",
+                    (idx, k.char, json.dumps(k.meanings), json.dumps(sorted(k.categories)), k.radical))
+            self.db.execute("DELETE FROM kanji_parts WHERE kanji = ?", (idx,))
+            self.db.executemany("INSERT INTO kanji_parts VALUES (?, ?, ?)",
+                    [(idx, pos, part) for pos, part in enumerate(k.parts)])
+        self.db.executemany("INSERT OR IGNORE INTO kanji_missing VALUES (?)", [(c,) for c in missing])
+
+    def sql_reduce_parts(self, changes):
+        for k_idx, parts in changes:
+            self.db.execute("DELETE FROM kanji_parts WHERE kanji = ?", (k_idx,))
+            self.db.executemany("INSERT INTO kanji_parts VALUES (?, ?, ?)",
+                    [(k_idx, pos, part) for pos, part in enumerate(parts)])
+
+    def sql_add_word(self, idx, w):
+        self.db.execute("INSERT OR REPLACE INTO words VALUES (?, ?, ?, ?, ?)",
+                (idx, w.word, json.dumps(w.furigana), json.dumps(w.meanings), w.slot))
+        self.db.execute("DELETE FROM word_kanji WHERE word = ?", (idx,))
+        self.db.executemany("INSERT INTO word_kanji VALUES (?, ?, ?)",
+                [(idx, pos, k_idx) for pos, k_idx in enumerate(w.kanji_index)])
+        self.db.execute("DELETE FROM word_list_members WHERE word = ?", (idx,))
+        self.db.executemany("INSERT INTO word_list_members VALUES (?, ?)",
+                [(n_idx, idx) for n_idx in w.word_lists])
+        # new words are due right away, like in Context.do_add_word
+        self.db.execute("INSERT OR REPLACE INTO schedule VALUES (?, 0, ?, 0)", (idx, START_EASE))
+
+    def sql_delete_word(self, idx):
+        self.db.execute("DELETE FROM words WHERE idx = ?", (idx,))
+        self.db.execute("DELETE FROM word_kanji WHERE word = ?", (idx,))
+        self.db.execute("DELETE FROM word_list_members WHERE word = ?", (idx,))
+        self.db.execute("DELETE FROM schedule WHERE word = ?", (idx,))
+
+    def sql_meanings(self, idx, meanings):
+        self.db.execute("UPDATE words SET meanings = ? WHERE idx = ?", (json.dumps(meanings), idx))
+
+    def sql_slot(self, idx, slot):
+        self.db.execute("UPDATE words SET slot = ? WHERE idx = ?", (slot, idx))
+
+    def sql_schedule(self, entries):
+        self.db.execute("DELETE FROM schedule")
+        self.db.executemany("INSERT INTO schedule VALUES (?, ?, ?, ?)", entries)
+
+    def sql_reschedule(self, idx, due, ease, interval):
+        self.db.execute("INSERT OR REPLACE INTO schedule VALUES (?, ?, ?, ?)", (idx, due, ease, interval))
+
+    def sql_word_list_add(self, idx, n_idx):
+        self.db.execute("INSERT OR IGNORE INTO word_list_members VALUES (?, ?)", (n_idx, idx))
+
+    def sql_word_list_remove(self, idx, n_idx):
+        self.db.execute("DELETE FROM word_list_members WHERE list = ? AND word = ?", (n_idx, idx))
+
+    def sql_list_add(self, n_idx, name):
+        self.db.execute("INSERT OR REPLACE INTO word_lists VALUES (?, ?)", (n_idx, name))
+
+    def sql_list_rename(self, n_idx, new_name):
+        self.db.execute("UPDATE word_lists SET name = ? WHERE idx = ?", (new_name, n_idx))
+
+    def sql_list_delete(self, n_idx):
+        self.db.execute("DELETE FROM word_lists WHERE idx = ?", (n_idx,))
+        self.db.execute("DELETE FROM word_list_members WHERE list = ?", (n_idx,))
+
+if __name__ == "__main__":
+    # one-shot migration of the shelve database to sqlite
+    import os
+    import flashcard
+    flashcard.BACKEND = "shelve"
+    ctx = flashcard.Context()
+    ctx.read_from_file(flashcard.DB_FILE)
+    path = flashcard.DB_FILE + ".sqlite"
+    print(f"Migrating {flashcard.DB_FILE}.db to {path}...")
+    store = SQLiteStore(path)
+    base = os.urandom(8).hex()
+    store.save(ctx, base)
+    store.close()
+    ctx.journal.reset(base)
+    ctx.close(True)
+    print("Done, set BACKEND in flashcard.py to \"sqlite\" to use it")
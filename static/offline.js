@@ -0,0 +1,96 @@
+// the review runs in the browser with the same rules as ReviewState: a card
+// that is answered wrong goes to the stash, which becomes the next round once
+// every card of the current round has been answered; the progress is kept in
+// localStorage so that a reload or a lost connection loses nothing, every
+// deck has a key of its own so that a stored review doesn't replace another deck
+const KEY = "offline-review " + DECK_URL;
+let review = JSON.parse(localStorage.getItem(KEY) || "null");
+let card = null;
+let position = 0;
+
+function element(id) {
+    return document.getElementById(id);
+}
+
+function save() {
+    localStorage.setItem(KEY, JSON.stringify(review));
+}
+
+function status(text) {
+    element("status").textContent = text;
+}
+
+function next() {
+    if (!review.incorrect.length) {
+        review.incorrect = review.stash;
+        review.stash = [];
+        save();
+    }
+    element("back").style.display = "none";
+    element("answer").style.display = "none";
+    if (!review.incorrect.length) {
+        element("front").textContent = "";
+        element("flip").style.display = "none";
+        sync();
+        return;
+    }
+    position = Math.floor(Math.random() * review.incorrect.length);
+    card = review.incorrect[position];
+    status(review.incorrect.length + review.stash.length + " cards left");
+    element("front").textContent = card[1];
+    element("back").textContent = card[2];
+    element("flip").style.display = "";
+}
+
+function flip() {
+    element("back").style.display = "";
+    element("flip").style.display = "none";
+    element("answer").style.display = "";
+}
+
+function answer(correct) {
+    review.incorrect[position] = review.incorrect[review.incorrect.length - 1];
+    review.incorrect.pop();
+    if (!correct) {
+        review.stash.push(card);
+    }
+    review.log.push([card[0], correct]);
+    save();
+    next();
+}
+
+function sync() {
+    status("Sending answers...");
+    element("retry").style.display = "none";
+    fetch(SYNC_URL, {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({cards: review.cards.map(c => [c[0], c[1]]), log: review.log}),
+    }).then(response => response.json()).then(result => {
+        // the review is kept until the server has taken it
+        if (result.error) {
+            status("Error: " + result.error);
+            element("retry").style.display = "";
+            return;
+        }
+        status("Done, " + result.applied + " cards saved");
+        localStorage.removeItem(KEY);
+    }).catch(() => {
+        status("Could not reach the server");
+        element("retry").style.display = "";
+    });
+}
+
+if (review) {
+    next();
+} else {
+    fetch(DECK_URL).then(response => response.json()).then(deck => {
+        if (deck.error) {
+            status("Error: " + deck.error);
+            return;
+        }
+        review = {cards: deck.cards, kanji: deck.kanji, incorrect: deck.cards.slice(), stash: [], log: []};
+        save();
+        next();
+    }).catch(() => status("Could not download the deck"));
+}
@@ -0,0 +1,62 @@
+// cards come with their back and the card after them, so flipping and
+// answering never wait for the server
+const socket = io();
+let card = null;
+let next = null;
+
+function element(id) {
+    return document.getElementById(id);
+}
+
+function show(c) {
+    card = c;
+    element("back").style.display = "none";
+    element("answer").style.display = "none";
+    if (!card) {
+        element("front").textContent = "...";
+        element("flip").style.display = "none";
+        return;
+    }
+    element("front").textContent = card.front;
+    element("back").textContent = card.back;
+    element("flip").style.display = "";
+}
+
+// the answer buttons are disabled while an answer has not been acknowledged
+// and the card after the one on screen is not known yet
+function enable(on) {
+    for (const button of element("answer").querySelectorAll("button")) {
+        button.disabled = !on;
+    }
+}
+
+function update(cards) {
+    if (cards.error || !cards.card) {
+        window.location = "/";
+        return;
+    }
+    enable(true);
+    next = cards.next;
+    if (!card || card.id !== cards.card.id) {
+        show(cards.card);
+    }
+}
+
+function flip() {
+    element("back").style.display = "";
+    element("flip").style.display = "none";
+    element("answer").style.display = "";
+}
+
+function answer(correct) {
+    if (!card) {
+        return;
+    }
+    const id = card.id;
+    show(next);
+    next = null;
+    enable(false);
+    socket.emit("answer", {id: id, correct: correct}, update);
+}
+
+socket.on("connect", () => socket.emit("cards", update));
@@ -0,0 +1,136 @@
+import os
+import time
+import math
+import threading
+import cProfile
+from contextlib import contextmanager, nullcontext
+
+# nothing is measured unless FLASHCARDS_STATS is set, with FLASHCARDS_PROFILE
+# set to a directory every action of main() is profiled into
+# <directory>/<action>-<n>.prof (open it with python -m pstats)
+ENABLED = bool(os.environ.get("FLASHCARDS_STATS"))
+PROFILE_DIR = os.environ.get("FLASHCARDS_PROFILE")
+# latencies are counted in buckets that grow by this factor, starting at 1µs,
+# so percentiles are at most about 20% too high
+BUCKET_GROWTH = 2 ** 0.25
+BUCKET_START = 1e-6
+
+# latency histogram of a stage: count, total and max are exact, percentiles
+# are the upper bound of the bucket they fall into
+class Histogram:
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= BUCKET_START:
+            b = 0
+        else:
+            b = math.ceil(math.log(seconds / BUCKET_START, BUCKET_GROWTH))
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return min(BUCKET_START * BUCKET_GROWTH ** b, self.max)
+        return self.max
+
+stages = {}
+caches = {}
+profiles = 0
+lock = threading.Lock()
+NO_TIMER = nullcontext()
+
+def record(stage, seconds):
+    with lock:
+        h = stages.get(stage)
+        if h is None:
+            h = stages[stage] = Histogram()
+        h.add(seconds)
+
+@contextmanager
+def measure(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+# with timer(stage): ... adds the time spent in the block to the histogram of
+# stage, costs next to nothing while stats are off
+def timer(stage):
+    return measure(stage) if ENABLED else NO_TIMER
+
+def cache(name, hit):
+    if not ENABLED:
+        return
+    with lock:
+        counts = caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+@contextmanager
+def profile(action):
+    global profiles
+    if not PROFILE_DIR:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiles += 1
+        name = "".join(filter(str.isalnum, action)) or "action"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}-{profiles}.prof"))
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f}µs"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    return f"{seconds:.2f}s"
+
+def lines():
+    if not ENABLED:
+        return ["Statistics are off, start with FLASHCARDS_STATS=1 to collect them"]
+    with lock:
+        result = []
+        if not stages and not caches:
+            result.append("Nothing has been measured yet")
+        width = max(map(len, stages), default=0)
+        for stage in sorted(stages):
+            h = stages[stage]
+            ps = " ".join(f"p{p} {format_seconds(h.percentile(p))}" for p in (50, 95, 99))
+            result.append(f"{stage.ljust(width)}  {h.count:6}x  {ps}  max {format_seconds(h.max)}"
+                    f"  total {format_seconds(h.total)}")
+        for name in sorted(caches):
+            hits, misses = caches[name]
+            result.append(f"{name}: {hits / (hits + misses):.0%} hits ({hits}/{hits + misses})")
+        return result
+
+def display():
+    for line in lines():
+        print(line)
+
+if __name__ == "__main__":
+    ENABLED = True
+    for ms in range(1, 101):
+        record("stage", ms / 1000)
+    h = stages["stage"]
+    print(h.count, round(h.total, 2), h.max, "== 100 5.05 0.1")
+    print(all(abs(h.percentile(p) - p / 1000) <= p / 1000 * 0.2 for p in (50, 95, 99)), "== True")
+    for hit in (True, True, True, False):
+        cache("cache", hit)
+    display()